@@ -0,0 +1,215 @@
+#!/usr/bin/env/python3
+
+import asyncio
+import traceback
+from functools import partial
+from typing import *
+from telegram.ext import CallbackContext # type: ignore
+from telegram import Update # type: ignore
+from async_store import AsyncStorage
+from chat_state import ChatState, async_transaction
+from handlers import curry, allowed_to_pin
+from chat_logic import gen_post, pin_from_self, needs_new_post
+from chat_logic import changes_pins, press_button, edit_request
+from outgoing import Priority, on_failure, report_failure
+from fingerprint import Change
+import handlers
+from message_info import MessageInfo
+from view_post import EmptyPost
+from varlock import AsyncVarLock
+from storage_error import StorageError
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: the handlers from handlers.py as coroutines, for storage that
+works on asyncio. A chat waiting for storage doesn't hold a thread, so any
+amount of chats can wait at once. Telegram requests are still blocking, and
+are done in the loop's executor, through the same outbox as in handlers.
+in_loop turns them into ordinary handlers that start them in a running loop
+and return at once.
+"""
+
+
+# A lock for different chats, same as in handlers
+chat_lock = AsyncVarLock()
+
+
+# Ordinary handler that runs coroutine handler in loop. It is running in
+# another thread, the one that runs the loop
+def in_loop(loop: asyncio.AbstractEventLoop, handler):
+    def report(future) -> None:
+        if not future.cancelled() and future.exception() is not None:
+            error = future.exception()
+            traceback.print_exception(type(error), error, error.__traceback__)
+    def r(update: Update, context: CallbackContext) -> None:
+        future = asyncio.run_coroutine_threadsafe(handler(update, context), loop)
+        future.add_done_callback(report)
+    return r
+
+
+# blocking telegram request, done in executor
+async def bot_call(method, *args, **kwargs) -> Any:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, partial(method, *args, **kwargs))
+
+
+# decorator: when storage is unavailable, report it and drop the update
+def drop_on_storage_error(func):
+    async def r(*args, **kwargs):
+        try:
+            return await func(*args, **kwargs)
+        except StorageError as e:
+            print(f"Dropping update: {e}")
+    return r
+
+
+@curry
+@drop_on_storage_error
+async def pinned(storage: AsyncStorage, update: Update, context: CallbackContext):
+    if update.message.from_user.is_bot:
+        return
+
+    bot = handlers.outbox.bot(context.bot)
+
+    chat_id = update.message.chat_id
+    async with chat_lock.lock(chat_id), async_transaction(storage, chat_id) as state:
+        if pin_from_self(state, update):
+            return
+
+        msg_info = MessageInfo(update.message.pinned_message)
+
+        # add pinned message for this chat
+        state.add(msg_info)
+        # send or update the bot's pinned message
+        await send_message(state, bot)
+
+@curry
+@drop_on_storage_error
+async def button_pressed(storage: AsyncStorage, update: Update, context: CallbackContext):
+    bot = handlers.outbox.bot(context.bot)
+    cb = update.callback_query
+    chat_id = cb.message.chat_id
+    answered = await bot_call(handlers.outbox.submit, chat_id, cb.answer, ""
+                             ,priority=Priority.Interactive, limited=False)
+    answered.add_done_callback(report_failure)
+
+    async with chat_lock.lock(chat_id), async_transaction(storage, chat_id) as state:
+        # do nothing if message already destroyed
+        if not state.has_message_id():
+            return
+        msg_id = state.get_message_id()
+
+        if changes_pins(cb.data) and not await bot_call(allowed_to_pin, bot, chat_id, cb.from_user):
+            return
+
+        response_buttons = press_button(state, cb.data)
+        text, layout = gen_post(state, response_buttons)
+        if (text, layout) == EmptyPost:
+            try:
+                await bot_call(bot.unpin_chat_message, chat_id, msg_id)
+                await bot_call(bot.delete_message, chat_id, msg_id)
+                state.remove_message_id()
+                handlers.rendered_posts.forget(chat_id)
+            except Exception as e:
+                tb = traceback.format_exc()
+                print(tb)
+            return
+
+        await edit_post(bot, chat_id, msg_id, text, layout)
+
+@curry
+@drop_on_storage_error
+async def message_edited(storage: AsyncStorage, update: Update, context: CallbackContext):
+    bot = handlers.outbox.bot(context.bot)
+    edited = update.edited_message
+    chat_id = edited.chat_id
+    async with chat_lock.lock(chat_id):
+        # see handlers.message_edited
+        if not await storage.is_pinned(chat_id, edited.message_id):
+            return
+
+        async with async_transaction(storage, chat_id) as state:
+            # do nothing if message is already deleted or never existed
+            if not state.has_message_id():
+                return
+            msg_id = state.get_message_id()
+
+            msg = MessageInfo(edited)
+            state.replace_same_id(msg)
+
+            text, layout = gen_post(state)
+            try:
+                #may fail if message too old, but it doesn't really matter in that case
+                await edit_post(bot, chat_id, msg_id, text, layout)
+            except Exception as e:
+                tb = traceback.format_exc()
+                print(tb)
+
+
+@curry
+@drop_on_storage_error
+async def message(storage: AsyncStorage, update: Update, context: CallbackContext):
+    # see handlers.message
+    if update.message and update.message.chat_id:
+        chat_id = update.message.chat_id
+        if handlers.chatter.wrote(chat_id, update.message.message_id):
+            return
+        async with chat_lock.lock(chat_id):
+            await storage.user_message_added(chat_id)
+            handlers.chatter.written(chat_id)
+
+
+# this function never deletes a message
+async def send_message(state: ChatState, bot) -> None:
+    chat_id = state.chat_id
+    text, layout = gen_post(state)
+
+    handlers.chatter.check(state)
+    has_editable = state.has_message_id()
+    if needs_new_post(state):
+        try:
+            sent_msg = await bot_call(bot.send_message, chat_id, text=text
+                                     ,parse_mode="HTML"
+                                     ,reply_markup=layout)
+            sent_id = sent_msg.message_id
+
+            if has_editable:
+                old_msg = state.get_message_id()
+
+            # remember the message for future edits
+            state.set_message_id(sent_id)
+            handlers.rendered_posts.remember(chat_id, sent_id, text, layout)
+            handlers.chatter.posted(chat_id)
+            await bot_call(bot.pin_chat_message, chat_id, sent_id
+                          ,disable_notification=True)
+
+            # delete old pin message
+            if has_editable:
+                await bot_call(bot.delete_message, chat_id, old_msg)
+        except Exception as e:
+            tb = traceback.format_exc()
+            print(tb)
+    else:
+        msg_id = state.get_message_id()
+        await edit_post(bot, chat_id, msg_id, text, layout)
+        # also repin bot's message
+        await bot_call(bot.pin_chat_message, chat_id, msg_id
+                      ,disable_notification=True)
+
+
+# see handlers.edit_post
+async def edit_post(bot, chat_id: int, msg_id: int, text: str, layout) -> None:
+    rendered_posts = handlers.rendered_posts
+    change = rendered_posts.change(chat_id, msg_id, text, layout)
+    if change == Change.Nothing:
+        return
+    method, kwargs = edit_request(change, chat_id, msg_id, text, layout)
+    try:
+        sent = await bot_call(getattr(bot, method), **kwargs)
+    except Exception:
+        rendered_posts.forget(chat_id)
+        raise
+    rendered_posts.remember(chat_id, msg_id, text, layout)
+    on_failure(sent, lambda: rendered_posts.forget(chat_id))
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+
+from typing import *
+from collections import deque
+from random import uniform
+from redis_pool import PoolConfig
+from storage_error import StorageError
+import asyncio
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: a small redis client for asyncio.
+Requests from all tasks are written to a connection as they come, and
+answers are matched to them in order, so a few connections serve any amount
+of chats at once. A request is a batch of commands written together, so a
+batch of MULTI, commands and EXEC is a transaction taking one round trip.
+"""
+
+
+class ReplyError(Exception):
+    """Error answer from redis, like NOSCRIPT"""
+    pass
+
+
+def encode(arg: Any) -> bytes:
+    if isinstance(arg, bytes):
+        return arg
+    return str(arg).encode()
+
+def pack_command(*args: Any) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in map(encode, args):
+        parts.append(b"$%d\r\n%b\r\n" % (len(arg), arg))
+    return b"".join(parts)
+
+# One answer. Errors are returned, not raised, because they may be inside
+# EXEC results
+async def read_reply(reader: asyncio.StreamReader) -> Any:
+    line = await reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("Connection closed by redis")
+    prefix, rest = line[:1], line[1:-2]
+    if prefix == b"+":
+        return rest
+    elif prefix == b"-":
+        return ReplyError(rest.decode())
+    elif prefix == b":":
+        return int(rest)
+    elif prefix == b"$":
+        length = int(rest)
+        if length == -1:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    elif prefix == b"*":
+        length = int(rest)
+        if length == -1:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise ConnectionError(f"Bad answer from redis: {line!r}")
+
+
+class Connection:
+    _host: str
+    _port: int
+    _db: int
+    _config: PoolConfig
+    _reader: Optional[asyncio.StreamReader]
+    _writer: Optional[asyncio.StreamWriter]
+    _reading: Optional[asyncio.Task]
+    # size of each batch waiting for answers and where to put them, in order
+    _waiting: Deque[Tuple[int, asyncio.Future]]
+    _connecting: asyncio.Lock
+
+    def __init__(self, host: str, port: int, db: int
+                ,config: PoolConfig
+                ) -> None:
+        self._host = host
+        self._port = port
+        self._db = db
+        self._config = config
+        self._reader = None
+        self._writer = None
+        self._reading = None
+        self._waiting = deque()
+        self._connecting = asyncio.Lock()
+
+    # answers to commands, sent in one go
+    async def execute(self, *commands: Sequence[Any]) -> List[Any]:
+        if self._writer is None:
+            await self._connect()
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append((len(commands), future))
+        writer = self._writer
+        writer.write(b"".join(pack_command(*c) for c in commands))
+        try:
+            # when redis reads slower than we write, wait for it instead of
+            # buffering without a limit
+            await asyncio.wait_for(writer.drain(), self._config.socket_timeout)
+            return await asyncio.wait_for( asyncio.shield(future)
+                                         , self._config.socket_timeout
+                                         )
+        except asyncio.TimeoutError:
+            # later answers would go to wrong requests now
+            self._fail(TimeoutError("Timed out waiting for redis"))
+            raise TimeoutError("Timed out waiting for redis")
+        except ConnectionError as e:
+            # writing failed, and the connection is not dropped yet
+            if self._writer is writer:
+                self._fail(ConnectionError(f"Redis connection lost: {e}"))
+            raise
+
+    async def close(self) -> None:
+        reading = self._reading
+        self._fail(ConnectionError("Connection closed"))
+        if reading is not None:
+            await asyncio.gather(reading, return_exceptions=True)
+
+    async def _connect(self) -> None:
+        async with self._connecting:
+            if self._writer is not None:
+                return
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(self._host, self._port),
+                    self._config.socket_connect_timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                raise ConnectionError(f"Error connecting to {self._host}:{self._port}: {e}")
+            if self._db != 0:
+                writer.write(pack_command("SELECT", self._db))
+                await writer.drain()
+                answer = await read_reply(reader)
+                if isinstance(answer, ReplyError):
+                    writer.close()
+                    raise answer
+            self._reader, self._writer = reader, writer
+            self._reading = asyncio.ensure_future(self._read_loop(reader))
+
+    async def _read_loop(self, reader: asyncio.StreamReader) -> None:
+        try:
+            while True:
+                first = await read_reply(reader)
+                size, future = self._waiting.popleft()
+                answers = [first]
+                for _ in range(size - 1):
+                    answers.append(await read_reply(reader))
+                if not future.done():
+                    future.set_result(answers)
+        except asyncio.CancelledError:
+            pass
+        except (OSError, EOFError, IndexError, ValueError) as e:
+            self._fail(ConnectionError(f"Redis connection lost: {e}"))
+
+    # drop the connection, failing everything that waits for it
+    def _fail(self, error: Exception) -> None:
+        if self._writer is not None:
+            self._writer.close()
+        if self._reading is not None and self._reading is not asyncio.current_task():
+            self._reading.cancel()
+        self._reader, self._writer, self._reading = None, None, None
+        waiting, self._waiting = self._waiting, deque()
+        for _, future in waiting:
+            if not future.done():
+                future.set_exception(error)
+
+
+class Client:
+    """Connections to one redis server. Requests are spread over them in
+    turn"""
+    _connections: List[Connection]
+    _next: int
+
+    def __init__(self, host: str, port: int, db: int = 0
+                ,config: PoolConfig = PoolConfig()
+                ) -> None:
+        self.config = config
+        self._connections = [Connection(host, port, db, config)
+                             for _ in range(config.size)]
+        self._next = 0
+
+    async def execute(self, *commands: Sequence[Any]) -> List[Any]:
+        connection = self._connections[self._next]
+        self._next = (self._next + 1) % len(self._connections)
+        return await connection.execute(*commands)
+
+    # answer of one command, raising if it's an error
+    async def call(self, *command: Any) -> Any:
+        answer, = await self.execute(command)
+        if isinstance(answer, ReplyError):
+            raise answer
+        return answer
+
+    # answers of commands done in a transaction. Errors of single commands
+    # are in the answers
+    async def transaction(self, *commands: Sequence[Any]) -> List[Any]:
+        answers = await self.execute(("MULTI",), *commands, ("EXEC",))
+        results = answers[-1]
+        if isinstance(results, ReplyError):
+            raise results
+        if results is None:
+            raise ReplyError("Transaction aborted")
+        return results
+
+    async def close(self) -> None:
+        for connection in self._connections:
+            await connection.close()
+
+
+T = TypeVar('T')
+
+# Same as redis_pool.call_with_retries, waiting without blocking the loop
+async def call_with_retries(config: PoolConfig
+                           ,action: Callable[[], Awaitable[T]]
+                           ,retry: bool = True
+                           ) -> T:
+    attempts = config.retries + 1 if retry else 1
+    for attempt in range(attempts):
+        try:
+            return await action()
+        except (ConnectionError, TimeoutError) as e:
+            if attempt == attempts - 1:
+                raise StorageError(f"Redis unavailable: {e}") from e
+            delay = min(config.backoff_max, config.backoff_base * 2 ** attempt)
+            await asyncio.sleep(uniform(0, delay))
+    # unreachable, attempts is never 0
+    raise StorageError("Redis unavailable")
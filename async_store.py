@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+
+from typing import *
+from hashlib import sha1
+from message_info import MessageInfo
+from chat_state import ChatState, PinOp
+from async_redis import Client, ReplyError, call_with_retries
+from redis_pool import PoolConfig
+from remote_store import Storage as RemoteStorage
+from remote_store import AddScript, RemoveScript, ReplaceScript, KeepLastScript
+from remote_store import IsPinnedScript, CommitScript
+import os
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: storage for handlers running on asyncio.
+AsyncStorage has the same methods as local_store.Storage, but they are
+coroutines, so a chat waiting for storage doesn't hold a thread. There are
+two of them: one that runs any ordinary storage in place, for storages that
+don't wait for anything, and one keeping data in redis the same way as
+remote_store does.
+"""
+
+
+class AsyncStorage(Protocol):
+    async def has(self, chat_id: int) -> bool: ...
+    async def get(self, chat_id: int) -> List[MessageInfo]: ...
+    async def is_pinned(self, chat_id: int, m_id: int) -> bool: ...
+    async def add(self, chat_id: int, msg: MessageInfo) -> None: ...
+    async def clear(self, chat_id: int) -> None: ...
+    async def clear_keep_last(self, chat_id: int) -> None: ...
+    async def remove(self, chat_id: int, m_id: int, hint: int = 0) -> None: ...
+    async def replace_same_id(self, chat_id: int, edited: MessageInfo) -> None: ...
+
+    async def get_message_id(self, chat_id: int) -> int: ...
+    async def set_message_id(self, chat_id: int, m_id: int) -> None: ...
+    async def has_message_id(self, chat_id: int) -> bool: ...
+    async def remove_message_id(self, chat_id: int) -> None: ...
+
+    async def did_user_message(self, chat_id: int) -> bool: ...
+    async def user_message_added(self, chat_id: int) -> None: ...
+
+    async def load(self, chat_id: int) -> ChatState: ...
+    async def commit(self, state: ChatState) -> None: ...
+
+
+class InPlaceStorage:
+    """Runs methods of an ordinary storage right in the loop. Only for
+    storages that don't wait, like local_store"""
+    def __init__(self, storage) -> None:
+        self._storage = storage
+
+    async def has(self, chat_id: int) -> bool:
+        return self._storage.has(chat_id)
+    async def get(self, chat_id: int) -> List[MessageInfo]:
+        return self._storage.get(chat_id)
+    async def is_pinned(self, chat_id: int, m_id: int) -> bool:
+        return self._storage.is_pinned(chat_id, m_id)
+    async def add(self, chat_id: int, msg: MessageInfo) -> None:
+        self._storage.add(chat_id, msg)
+    async def clear(self, chat_id: int) -> None:
+        self._storage.clear(chat_id)
+    async def clear_keep_last(self, chat_id: int) -> None:
+        self._storage.clear_keep_last(chat_id)
+    async def remove(self, chat_id: int, m_id: int, hint: int = 0) -> None:
+        self._storage.remove(chat_id, m_id, hint)
+    async def replace_same_id(self, chat_id: int, edited: MessageInfo) -> None:
+        self._storage.replace_same_id(chat_id, edited)
+
+    async def get_message_id(self, chat_id: int) -> int:
+        return self._storage.get_message_id(chat_id)
+    async def set_message_id(self, chat_id: int, m_id: int) -> None:
+        self._storage.set_message_id(chat_id, m_id)
+    async def has_message_id(self, chat_id: int) -> bool:
+        return self._storage.has_message_id(chat_id)
+    async def remove_message_id(self, chat_id: int) -> None:
+        self._storage.remove_message_id(chat_id)
+
+    async def did_user_message(self, chat_id: int) -> bool:
+        return self._storage.did_user_message(chat_id)
+    async def user_message_added(self, chat_id: int) -> None:
+        self._storage.user_message_added(chat_id)
+
+    async def load(self, chat_id: int) -> ChatState:
+        return self._storage.load(chat_id)
+    async def commit(self, state: ChatState) -> None:
+        self._storage.commit(state)
+
+
+# decorator: run storage coroutine with retries if the connection fails
+def redis_call(retry: bool):
+    def decorator(method):
+        async def wrapped(self, *args, **kwargs):
+            return await call_with_retries( self._client.config
+                                          , lambda: method(self, *args, **kwargs)
+                                          , retry
+                                          )
+        return wrapped
+    return decorator
+
+
+class Script(NamedTuple):
+    text: str
+    sha: str
+
+    @staticmethod
+    def of(text: str) -> 'Script':
+        return Script(text, sha1(text.encode()).hexdigest())
+
+ScriptOf = { "add"             : Script.of(AddScript)
+           , "remove"          : Script.of(RemoveScript)
+           , "replace_same_id" : Script.of(ReplaceScript)
+           , "clear_keep_last" : Script.of(KeepLastScript)
+           , "is_pinned"       : Script.of(IsPinnedScript)
+           , "commit"          : Script.of(CommitScript)
+           }
+
+
+class RedisStorage:
+    """Same layout and scripts as remote_store.Storage, so both can be used
+    on the same data"""
+    _client: Client
+
+    def __init__(self, addr: str = RemoteStorage.RedisAddr
+                ,port: int = RemoteStorage.RedisPort
+                ,db: int = RemoteStorage.RedisDb
+                ,pool_config: PoolConfig = PoolConfig()
+                ) -> None:
+        self._client = Client(addr, port, db, pool_config)
+
+    # Connections are made in the loop where storage is first used
+    @staticmethod
+    def from_env(env: Mapping[str, str] = os.environ) -> 'RedisStorage':
+        return RedisStorage( addr = env.get("REDIS_ADDR", RemoteStorage.RedisAddr)
+                           , port = int(env.get("REDIS_PORT", RemoteStorage.RedisPort))
+                           , db = int(env.get("REDIS_DB", RemoteStorage.RedisDb))
+                           , pool_config = PoolConfig.from_env(env)
+                           )
+
+    async def close(self) -> None:
+        await self._client.close()
+
+    _chat_key = staticmethod(RemoteStorage._chat_key)
+    _pin_keys = staticmethod(RemoteStorage._pin_keys)
+    _pins_key = staticmethod(RemoteStorage._pins_key)
+
+
+    @redis_call(retry=True)
+    async def has(self, chat_id: int) -> bool:
+        return await self._client.call("LLEN", self._pins_key(chat_id)) != 0
+
+    @redis_call(retry=True)
+    async def get(self, chat_id: int) -> List[MessageInfo]:
+        dumps = await self._client.call("LRANGE", self._pins_key(chat_id), 0, -1)
+        return [MessageInfo.loads(dump, chat_id) for dump in dumps]
+
+    @redis_call(retry=True)
+    async def is_pinned(self, chat_id: int, m_id: int) -> bool:
+        return await self._call_script(PinOp("is_pinned", (m_id,), []), chat_id) == 1
+
+    @redis_call(retry=False)
+    async def add(self, chat_id: int, msg: MessageInfo) -> None:
+        await self._call_script(PinOp("add", (msg,), [0]), chat_id)
+
+    @redis_call(retry=True)
+    async def clear(self, chat_id: int) -> None:
+        await self._client.call("DEL", *self._pin_keys(chat_id))
+
+    @redis_call(retry=True)
+    async def clear_keep_last(self, chat_id: int) -> None:
+        await self._call_script(PinOp("clear_keep_last", (), [0]), chat_id)
+
+    @redis_call(retry=False)
+    async def remove(self, chat_id: int, m_id: int, hint: int = 0) -> None:
+        await self._call_script(PinOp("remove", (m_id, hint), []), chat_id)
+
+    @redis_call(retry=True)
+    async def replace_same_id(self, chat_id: int, edited: MessageInfo) -> None:
+        await self._call_script(PinOp("replace_same_id", (edited,), []), chat_id)
+
+
+    # get and set id of message that you need to edit
+    @redis_call(retry=True)
+    async def get_message_id(self, chat_id: int) -> int:
+        value = await self._client.call( "HGET", self._chat_key(chat_id)
+                                       , RemoteStorage.MessageIdField
+                                       )
+        if value is None:
+            raise KeyError(chat_id)
+        return int(value)
+    @redis_call(retry=True)
+    async def set_message_id(self, chat_id: int, m_id: int) -> None:
+        # automatically set that no user has messaged us
+        await self._client.call( "HMSET", self._chat_key(chat_id)
+                               , RemoteStorage.MessageIdField, m_id
+                               , RemoteStorage.NoUserWroteField, "."
+                               )
+    @redis_call(retry=True)
+    async def has_message_id(self, chat_id: int) -> bool:
+        return await self._client.call( "HEXISTS", self._chat_key(chat_id)
+                                      , RemoteStorage.MessageIdField
+                                      ) == 1
+    @redis_call(retry=True)
+    async def remove_message_id(self, chat_id: int) -> None:
+        await self._client.call( "HDEL", self._chat_key(chat_id)
+                               , RemoteStorage.MessageIdField
+                               )
+
+    # status of last message
+    @redis_call(retry=True)
+    async def did_user_message(self, chat_id: int) -> bool:
+        return await self._client.call( "HEXISTS", self._chat_key(chat_id)
+                                      , RemoteStorage.NoUserWroteField
+                                      ) == 0
+    @redis_call(retry=True)
+    async def user_message_added(self, chat_id: int) -> None:
+        await self._client.call( "HDEL", self._chat_key(chat_id)
+                               , RemoteStorage.NoUserWroteField
+                               )
+
+
+    # whole chat state at once, in one round trip
+
+    @redis_call(retry=True)
+    async def load(self, chat_id: int) -> ChatState:
+        dumps, (editable, no_user_wrote) = await self._client.transaction(
+            ("LRANGE", self._pins_key(chat_id), 0, -1),
+            ("HMGET", self._chat_key(chat_id), RemoteStorage.MessageIdField
+                                             , RemoteStorage.NoUserWroteField),
+            )
+        pins = [MessageInfo.loads(dump, chat_id) for dump in dumps]
+        message_id = int(editable) if editable is not None else None
+        return ChatState(chat_id, pins, message_id, no_user_wrote is None)
+
+    @redis_call(retry=False)
+    async def commit(self, state: ChatState) -> None:
+        if not state.changed():
+            return
+        chat_id = state.chat_id
+        keys = self._pin_keys(chat_id) + [self._chat_key(chat_id)]
+        command = ( "EVALSHA", ScriptOf["commit"].sha, len(keys), *keys
+                  , *self._commit_args(state)
+                  )
+        answer, = await self._client.execute(command)
+        # same as in remote_store: nothing was written without the script,
+        # and everything is done again after loading it
+        if self._no_script(answer):
+            await self.load_scripts()
+            answer, = await self._client.execute(command)
+        if isinstance(answer, ReplyError):
+            raise answer
+        state.mark_committed()
+
+    _commit_args = staticmethod(RemoteStorage._commit_args)
+
+    # make the server know the scripts, so that they don't have to be loaded
+    # on first use
+    @redis_call(retry=True)
+    async def load_scripts(self) -> None:
+        for script in ScriptOf.values():
+            await self._client.call("SCRIPT", "LOAD", script.text)
+
+
+    async def _call_script(self, op: PinOp, chat_id: int) -> Any:
+        script, args = self._script_call(op)
+        keys = self._pin_keys(chat_id)
+        answer, = await self._client.execute(("EVALSHA", script.sha, 3, *keys, *args))
+        if self._no_script(answer):
+            answer, = await self._client.execute(("EVAL", script.text, 3, *keys, *args))
+        if isinstance(answer, ReplyError):
+            raise answer
+        return answer
+
+    @staticmethod
+    def _no_script(answer: Any) -> bool:
+        return isinstance(answer, ReplyError) and str(answer).startswith("NOSCRIPT")
+
+    # script and its arguments for a pin operation
+    @staticmethod
+    def _script_call(op: PinOp) -> Tuple[Script, list]:
+        args = RemoteStorage._op_args(op)
+        return (ScriptOf[op.name], args)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: how many pins in different chats are handled per second when
+every storage request takes the same time, with threaded handlers (as many
+threads as the dispatcher has workers) and with async handlers on one loop.
+Storage is local storage with a delay in front of it
+"""
+
+import asyncio
+import async_handlers
+import handlers
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter, sleep
+from typing import *
+from async_store import InPlaceStorage
+from local_store import Storage
+from test.handlers_test import Bot, Context, Update, gen_message
+
+
+Updates = 2000
+
+
+class InFlight:
+    """Counts storage requests waiting at once"""
+    def __init__(self) -> None:
+        self.now = 0
+        self.most = 0
+    def enter(self) -> None:
+        self.now += 1
+        self.most = max(self.most, self.now)
+    def leave(self) -> None:
+        self.now -= 1
+
+class SlowStorage:
+    """Storage answering after a delay, like a remote one"""
+    def __init__(self, latency: float) -> None:
+        self._storage = Storage()
+        self._latency = latency
+        self.in_flight = InFlight()
+    def wait(self) -> None:
+        self.in_flight.enter()
+        sleep(self._latency)
+        self.in_flight.leave()
+    def load(self, chat_id: int):
+        self.wait()
+        return self._storage.load(chat_id)
+    def commit(self, state) -> None:
+        self.wait()
+        self._storage.commit(state)
+
+class AsyncSlowStorage:
+    def __init__(self, latency: float) -> None:
+        self._storage = InPlaceStorage(Storage())
+        self._latency = latency
+        self.in_flight = InFlight()
+    async def wait(self) -> None:
+        self.in_flight.enter()
+        await asyncio.sleep(self._latency)
+        self.in_flight.leave()
+    async def load(self, chat_id: int):
+        await self.wait()
+        return await self._storage.load(chat_id)
+    async def commit(self, state) -> None:
+        await self.wait()
+        await self._storage.commit(state)
+
+
+def gen_updates() -> List[Update]:
+    return [Update(gen_message(), None) for _ in range(Updates)]
+
+
+# pins per second and most storage requests at once
+def threaded(workers: int, latency: float) -> Tuple[float, int]:
+    storage = SlowStorage(latency)
+    handler = handlers.pinned(storage)
+    context = Context(Bot())
+    updates = gen_updates()
+    start = perf_counter()
+    with ThreadPoolExecutor(workers) as pool:
+        for update in updates:
+            pool.submit(handler, update, context)
+    return (Updates / (perf_counter() - start), storage.in_flight.most)
+
+
+def in_loop(latency: float) -> Tuple[float, int]:
+    storage = AsyncSlowStorage(latency)
+    handler = async_handlers.pinned(storage)
+    context = Context(Bot())
+    updates = gen_updates()
+    async def run() -> None:
+        await asyncio.gather(*(handler(update, context) for update in updates))
+    start = perf_counter()
+    asyncio.run(run())
+    return (Updates / (perf_counter() - start), storage.in_flight.most)
+
+
+def main() -> None:
+    print(f"{Updates} pins in different chats")
+    print(f"{'latency':>7} {'handlers':>10} {'pins/s':>8} {'in flight':>9}")
+    for latency in [0.002, 0.02]:
+        ms = f"{latency * 1000:.0f} ms"
+        for workers in [4, 16, 64]:
+            rate, most = threaded(workers, latency)
+            print(f"{ms:>7} {f'{workers} threads':>10} {rate:>8.0f} {most:>9}")
+        rate, most = in_loop(latency)
+        print(f"{ms:>7} {'async':>10} {rate:>8.0f} {most:>9}")
+
+
+if __name__ == '__main__':
+    main()
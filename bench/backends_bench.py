@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: throughput of the storage backends doing what handlers do:
+pinning, editing and unpinning in a chat that already has some pins.
+Redis is measured if there's a running instance on localhost
+"""
+
+import os
+import tempfile
+from random import randrange
+from time import perf_counter
+from typing import *
+from chat_state import transaction
+from local_store import Storage as LocalStorage
+from message_info import MessageInfo
+from remote_store import Storage as RemoteStorage
+from sql_store import Storage as SqlStorage
+from storage_error import StorageError
+from test.handlers_test import gen_same_chat_messages
+
+
+Chats = 20
+PinsPerChat = 50
+Rounds = 200
+
+
+def pin(storage, chat_id: int, info: MessageInfo) -> None:
+    with transaction(storage, chat_id) as state:
+        state.add(info)
+        state.set_message_id(info.m_id)
+
+def edit(storage, chat_id: int, info: MessageInfo) -> None:
+    with transaction(storage, chat_id) as state:
+        state.replace_same_id(info)
+
+def unpin(storage, chat_id: int, info: MessageInfo) -> None:
+    with transaction(storage, chat_id) as state:
+        state.remove(info.m_id, randrange(PinsPerChat))
+
+# operations per second for each kind of operation
+def measure(storage) -> Dict[str, float]:
+    msgs = gen_same_chat_messages(PinsPerChat)
+    infos = [MessageInfo(msg) for msg in msgs]
+    chats = [msgs[0].chat.id + n for n in range(Chats)]
+    for chat_id in chats:
+        storage.clear(chat_id)
+        for info in infos:
+            storage.add(chat_id, info)
+
+    rates = {}
+    for name, action in [("pin", pin), ("edit", edit), ("unpin", unpin)]:
+        start = perf_counter()
+        for n in range(Rounds):
+            action(storage, chats[n % Chats], infos[n % PinsPerChat])
+        rates[name] = Rounds / (perf_counter() - start)
+    for chat_id in chats:
+        storage.clear(chat_id)
+    return rates
+
+
+def main() -> None:
+    print(f"{Chats} chats with {PinsPerChat} pins, ops/s")
+    print(f"{'backend':>8} {'pin':>8} {'edit':>8} {'unpin':>8}")
+    def report(name: str, rates: Dict[str, float]) -> None:
+        print(f"{name:>8} {rates['pin']:>8.0f} {rates['edit']:>8.0f} {rates['unpin']:>8.0f}")
+
+    report("local", measure(LocalStorage()))
+    with tempfile.TemporaryDirectory() as directory:
+        storage = SqlStorage(os.path.join(directory, "pins.sqlite3"))
+        report("sqlite", measure(storage))
+        storage.close()
+    try:
+        report("redis", measure(RemoteStorage(addr="localhost")))
+    except StorageError:
+        print(f"{'redis':>8} not running")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: how long quiet chats wait when one chat gets a burst of pins,
+with handlers run on a thread pool, where threads wait for the busy chat's
+lock, and with handlers run through per-chat mailboxes of ChatExecutor.
+Every telegram request takes a few milliseconds
+"""
+
+import handlers
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import monotonic, perf_counter, sleep
+from typing import *
+from chat_executor import ChatExecutor
+from local_store import Storage
+from test.handlers_test import Bot, Context, Update, gen_message, gen_same_chat_messages
+
+
+Workers = 8
+HotUpdates = 400
+QuietChats = 100
+RequestTime = 0.002
+
+
+class SlowBot(Bot):
+    def send_message(self, *args, **kwargs):
+        sleep(RequestTime)
+        return super().send_message(*args, **kwargs)
+    def edit_message_text(self, *args, **kwargs):
+        sleep(RequestTime)
+        return super().edit_message_text(*args, **kwargs)
+    def pin_chat_message(self, *args, **kwargs):
+        sleep(RequestTime)
+        return super().pin_chat_message(*args, **kwargs)
+
+
+def percentile(values: List[float], part: float) -> float:
+    return sorted(values)[int(part * (len(values) - 1))]
+
+
+# The hot chat's burst comes first, then a pin in each quiet chat
+def gen_updates() -> List[Tuple[bool, Update]]:
+    hot = [(True, Update(msg, None)) for msg in gen_same_chat_messages(HotUpdates)]
+    quiet = [(False, Update(gen_message(), None)) for _ in range(QuietChats)]
+    return hot + quiet
+
+
+# Latencies of quiet chats' updates and the time to handle everything
+def run(submit: Callable[[Update, Callable[[], None]], None]
+       ,wait: Callable[[], None]
+       ) -> Tuple[List[float], float]:
+    handler = handlers.pinned(Storage())
+    context = Context(SlowBot())
+    latencies: List[float] = []
+    lock = Lock()
+    def timed(quiet: bool, update: Update) -> Callable[[], None]:
+        start = monotonic()
+        def r() -> None:
+            handler(update, context)
+            if quiet:
+                with lock:
+                    latencies.append(monotonic() - start)
+        return r
+    start = perf_counter()
+    for quiet_chat, update in gen_updates():
+        submit(update, timed(not quiet_chat, update))
+    wait()
+    return (latencies, perf_counter() - start)
+
+
+def threaded() -> Tuple[List[float], float]:
+    pool = ThreadPoolExecutor(Workers)
+    return run(lambda update, task: pool.submit(task), lambda: pool.shutdown())
+
+
+def mailboxes() -> Tuple[List[float], float]:
+    executor = ChatExecutor(Workers)
+    submit = lambda update, task: executor.submit(update.effective_chat.id, task)
+    result = run(submit, executor.join)
+    executor.stop()
+    return result
+
+
+def main() -> None:
+    print(f"{HotUpdates} pins in one chat, then one pin in each of {QuietChats} chats")
+    print(f"{Workers} workers, {RequestTime * 1000:.0f} ms per telegram request")
+    print(f"{'':>10} {'quiet p50 ms':>12} {'quiet p99 ms':>12} {'total s':>8}")
+    for name, way in [("threads", threaded), ("mailboxes", mailboxes)]:
+        latencies, total = way()
+        p50, p99 = percentile(latencies, 0.5), percentile(latencies, 0.99)
+        print(f"{name:>10} {p50 * 1000:>12.1f} {p99 * 1000:>12.1f} {total:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
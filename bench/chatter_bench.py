@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: user messages a second through the message handler, when each
+one is told to storage, like before, and when only the first one after the
+post is. Several threads handle messages of a few busy chats, with redis
+storage and with local storage.
+Uses a running redis instance on localhost
+"""
+
+import handlers
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from typing import *
+from unittest.mock import patch
+from chatter import Chatter
+from cached_store import Storage as CachedStorage
+from local_store import Storage as LocalStorage
+from remote_store import Storage as RemoteStorage
+from test.handlers_test import Bot, Context, Update, gen_message
+
+
+Messages = 20000
+Chats = 20
+Threads = 8
+
+
+def gen_updates() -> List[Update]:
+    chats = [gen_message().chat.id for _ in range(Chats)]
+    updates = []
+    for number in range(Messages):
+        msg = gen_message()
+        msg.chat.id = chats[number % Chats]
+        updates.append(Update(msg, None))
+    return updates
+
+
+def rate(storage, chatter: Chatter, updates: List[Update]) -> float:
+    handler = handlers.message(storage)
+    context = Context(Bot())
+    with patch.object(handlers, "chatter", chatter):
+        start = perf_counter()
+        with ThreadPoolExecutor(Threads) as pool:
+            list(pool.map(lambda update: handler(update, context), updates))
+        elapsed = perf_counter() - start
+    return len(updates) / elapsed
+
+
+def main() -> None:
+    updates = gen_updates()
+    redis = CachedStorage(RemoteStorage(addr="localhost"))
+    storages = [("redis", redis), ("local", LocalStorage())]
+    print(f"{Messages} user messages in {Chats} chats, {Threads} threads")
+    print(f"{'storage':>8} {'before, msg/s':>14} {'after, msg/s':>13}")
+    for name, storage in storages:
+        # a chatter that remembers nothing tells storage every time
+        before = rate(storage, Chatter(size=0), updates)
+        after = rate(storage, Chatter(), updates)
+        print(f"{name:>8} {before:>14.0f} {after:>13.0f}")
+    for update in updates[:Chats]:
+        redis.drop_chat(update.message.chat_id)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: startup time of durable local storage with many chats, restored
+from log alone and from snapshot, and how group commit lets changes from
+many threads share fsyncs
+"""
+
+import os
+import tempfile
+from threading import Thread
+from time import perf_counter
+from typing import *
+import durable_log
+from local_store import Storage, encode_record
+from message_info import MessageInfo
+from test.handlers_test import gen_same_chat_messages
+
+
+Chats = 100000
+PinsPerChat = 3
+
+
+# what a log of pins in many chats looks like
+def write_log(directory: str, infos: List[MessageInfo]) -> int:
+    records = []
+    for chat_id in range(1, Chats + 1):
+        for info in infos:
+            records.append(encode_record("add", chat_id, (info,)))
+        records.append(encode_record("set_message_id", chat_id, (chat_id,)))
+    data = b"".join(map(durable_log.frame, records))
+    with open(durable_log.log_path(directory, 1), "wb") as file:
+        file.write(data)
+    return len(data)
+
+def timed(action: Callable[[], Any]) -> Tuple[float, Any]:
+    start = perf_counter()
+    result = action()
+    return (perf_counter() - start, result)
+
+
+def startup() -> None:
+    infos = [MessageInfo(msg) for msg in gen_same_chat_messages(PinsPerChat)]
+    with tempfile.TemporaryDirectory() as directory:
+        size = write_log(directory, infos)
+        print(f"{Chats} chats with {PinsPerChat} pins, log of {size // 1024} KiB")
+
+        elapsed, storage = timed(lambda: Storage(directory=directory))
+        print(f"restore from log:      {elapsed:7.3f} s")
+        elapsed, _ = timed(storage.snapshot)
+        print(f"snapshot:              {elapsed:7.3f} s")
+        storage.close()
+
+        size = os.path.getsize(os.path.join(directory, durable_log.SnapshotName))
+        elapsed, storage = timed(lambda: Storage(directory=directory))
+        print(f"restore from snapshot: {elapsed:7.3f} s ({size // 1024} KiB)")
+        storage.close()
+
+
+# adds per second when this many threads add to their own chats
+def write_rate(threads: int, per_thread: int, info: MessageInfo) -> float:
+    with tempfile.TemporaryDirectory() as directory:
+        storage = Storage(directory=directory)
+        def work(chat_id: int) -> None:
+            for _ in range(per_thread):
+                storage.add(chat_id, info)
+        workers = [Thread(target=work, args=(chat_id,))
+                   for chat_id in range(1, threads + 1)]
+        start = perf_counter()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = perf_counter() - start
+        storage.close()
+    return threads * per_thread / elapsed
+
+
+def group_commit() -> None:
+    info = MessageInfo(gen_same_chat_messages(1)[0])
+    print(f"{'threads':>7} {'adds/s':>9}")
+    for threads in [1, 4, 16, 64]:
+        rate = write_rate(threads, 2000 // threads, info)
+        print(f"{threads:>7} {rate:>9.0f}")
+
+
+def main() -> None:
+    startup()
+    print()
+    group_commit()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: cost of adding and removing pins in local storage as the amount
+of pins in a chat grows, compared to the old list-based storage
+"""
+
+from random import shuffle
+from time import perf_counter
+from typing import *
+from local_store import Storage
+from message_info import MessageInfo
+from test.handlers_test import gen_same_chat_messages
+
+
+class OldStorage:
+    """Pin list of the old local storage: newest pins are inserted in front"""
+    def __init__(self) -> None:
+        self._pin_data: Dict[int, List[MessageInfo]] = {}
+
+    def add(self, chat_id: int, msg: MessageInfo) -> None:
+        self._pin_data.setdefault(chat_id, []).insert(0, msg)
+
+    def remove(self, chat_id: int, m_id: int, hint: int = 0) -> None:
+        pins = self._pin_data[chat_id]
+        all_bad = [(abs(index - hint), index)
+                      for index, msg in enumerate(pins)
+                      if msg.m_id == m_id
+                  ]
+        if all_bad == []:
+            return
+        del pins[min(all_bad)[1]]
+
+
+# microseconds per add and per remove of all infos
+def measure(storage, chat_id: int, infos: List[MessageInfo]) -> Tuple[float, float]:
+    start = perf_counter()
+    for info in infos:
+        storage.add(chat_id, info)
+    added = perf_counter()
+
+    to_remove = list(infos)
+    shuffle(to_remove)
+    for index, info in enumerate(to_remove):
+        storage.remove(chat_id, info.m_id, index)
+    removed = perf_counter()
+
+    per_op = 1000 * 1000 / len(infos)
+    return ((added - start) * per_op, (removed - added) * per_op)
+
+
+def main() -> None:
+    print(f"{'pins':>7} {'old add':>9} {'new add':>9} {'old remove':>11} {'new remove':>11}")
+    print(f"{'':>7} {'us/op':>9} {'us/op':>9} {'us/op':>11} {'us/op':>11}")
+    for amount in [100, 1000, 10000, 30000]:
+        msgs = gen_same_chat_messages(1)
+        chat_id = msgs[0].chat.id
+        info = MessageInfo(msgs[0])
+        # copies differ only in id, which is all storage looks at
+        infos = []
+        for m_id in range(amount):
+            copy = MessageInfo.loads(info.dumps(), chat_id)
+            copy.m_id = m_id
+            infos.append(copy)
+
+        old_add, old_remove = measure(OldStorage(), chat_id, infos)
+        new_add, new_remove = measure(Storage(), chat_id, infos)
+        print(f"{amount:>7} {old_add:>9.2f} {new_add:>9.2f} {old_remove:>11.2f} {new_remove:>11.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: size and decoding time of stored pins, in the old json format
+and the current binary one.
+Then time to make previews of messages full of links, like link dumps, with
+the old gather_links and the current one
+"""
+
+from time import perf_counter
+from typing import *
+from message_info import MessageInfo, gather_links
+from test.handlers_test import Entity, gen_message
+from test.message_info_test import old_gather_links
+
+
+def gen_infos() -> List[Tuple[str, int, MessageInfo]]:
+    text = gen_message()
+    text.chat.id = -1001234567890
+
+    link = gen_message()
+    link.text = "see github.com and https://kde.org/ for more"
+    link.entities = [Entity(4, len("github.com")), Entity(19, len("https://kde.org/"))]
+
+    long = gen_message()
+    long.text = "lorem ipsum dolor sit amet " * 20
+
+    return [ (name, msg.chat_id, MessageInfo(msg))
+             for name, msg in [("text", text), ("link", link), ("long", long)]
+           ]
+
+
+def decode_time(dump: Union[str, bytes], chat_id: int, repeat: int) -> float:
+    start = perf_counter()
+    for _ in range(repeat):
+        MessageInfo.loads(dump, chat_id)
+    return (perf_counter() - start) / repeat * 1000 * 1000
+
+
+# message with one link on each line
+def gen_link_dump(links: int) -> Tuple[str, List[Entity]]:
+    text = ""
+    entities = []
+    for number in range(links):
+        link = f"https://example.com/page/{number}"
+        entities.append(Entity(len(text), len(link)))
+        text += f"{link} - page {number} & more\n"
+    return (text, entities)
+
+
+def preview_time(gather: Callable, links: int, repeat: int) -> float:
+    text, entities = gen_link_dump(links)
+    start = perf_counter()
+    for _ in range(repeat):
+        gather(entities, text)
+    return (perf_counter() - start) / repeat * 1000 * 1000
+
+
+def main() -> None:
+    repeat = 20000
+    print(f"{'pin':>6} {'json, B':>8} {'binary, B':>10} {'json, us':>9} {'binary, us':>11}")
+    for name, chat_id, info in gen_infos():
+        json_dump = info.dumps_json().encode("utf-8")
+        binary_dump = info.dumps()
+        json_time = decode_time(json_dump, chat_id, repeat)
+        binary_time = decode_time(binary_dump, chat_id, repeat)
+        print(f"{name:>6} {len(json_dump):>8} {len(binary_dump):>10} "
+              f"{json_time:>9.2f} {binary_time:>11.2f}")
+
+    print()
+    print(f"{'links':>6} {'old, us':>10} {'new, us':>10}")
+    for links in [10, 100, 1000, 5000]:
+        repeat = 20000 // links
+        old = preview_time(old_gather_links, links, repeat)
+        new = preview_time(gather_links, links, repeat)
+        print(f"{links:>6} {old:>10.1f} {new:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
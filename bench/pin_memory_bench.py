@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: memory taken by pins kept in memory, like in local storage, in
+bytes per pin. Pins are loaded from binary dumps with the old layout, where
+objects had a __dict__ and a stored link, and with the current one
+"""
+
+import tracemalloc
+from datetime import datetime
+from random import choice
+from typing import *
+from message_info import MessageInfo, WireHeader, WirePreviewLength, gen_icon, message_link
+from message_kind import Kind
+from test.handlers_test import gen_message
+
+
+Pins = 100000
+Senders = 50
+Chats = 100
+
+
+# the old layout, for comparison
+
+class OldEscaped:
+    def __init__(self, s: str) -> None:
+        self.wrapped = s
+
+class OldMessageInfo:
+    @staticmethod
+    def loads(data: bytes, chat_id: int) -> 'OldMessageInfo':
+        version, kind, m_id, date, sender_len = WireHeader.unpack_from(data)
+        offset = WireHeader.size
+        sender = data[offset : offset + sender_len].decode("utf-8")
+        offset += sender_len
+        preview_len, = WirePreviewLength.unpack_from(data, offset)
+        offset += WirePreviewLength.size
+        preview = data[offset : offset + preview_len].decode("utf-8")
+
+        self = OldMessageInfo()
+        self.m_id    = m_id
+        self.kind    = Kind(kind)
+        self.link    = message_link(chat_id, m_id)
+        self.sender  = OldEscaped(sender)
+        self.icon    = gen_icon(self.kind)
+        self.preview = OldEscaped(preview)
+        self.date    = datetime.utcfromtimestamp(date)
+        return self
+
+
+def gen_dumps() -> List[Tuple[int, bytes]]:
+    chats = [-1001234567890 - number for number in range(Chats)]
+    names = [f"user number {number}" for number in range(Senders)]
+    dumps = []
+    for number in range(Pins):
+        msg = gen_message()
+        msg.from_user.first_name = choice(names)
+        dumps.append((choice(chats), MessageInfo(msg).dumps()))
+    return dumps
+
+
+def per_pin(loads: Callable[[bytes, int], Any], dumps: List[Tuple[int, bytes]]) -> float:
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    pins = [loads(dump, chat_id) for chat_id, dump in dumps]
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    # the list itself is not counted
+    return (after - before) / len(pins) - 8
+
+
+def main() -> None:
+    dumps = gen_dumps()
+    print(f"{Pins} pins of {Senders} senders in {Chats} chats")
+    print(f"{'layout':>7} {'bytes per pin':>14}")
+    for name, loads in [("old", OldMessageInfo.loads), ("new", MessageInfo.loads)]:
+        print(f"{name:>7} {per_pin(loads, dumps):>14.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: compare remove and replace_same_id done with lua scripts against
+the old way of downloading the list and scanning it in python.
+Uses a running redis instance on localhost
+"""
+
+import json
+from time import perf_counter
+from typing import *
+from redis import Redis
+from message_info import MessageInfo
+from remote_store import Storage
+from test.handlers_test import gen_same_chat_messages
+
+
+# the old implementations, for comparison. They store pins as json
+
+def old_remove(redis: Redis, key: str, m_id: int, hint: int = 0) -> None:
+    dumps = redis.lrange(key, 0, -1)
+    all_bad = [(abs(index - hint), index)
+                  for index, dump in enumerate(dumps)
+                  if json.loads(dump)['m_id'] == m_id
+              ]
+    if all_bad == []:
+        return
+    to_delete = min(all_bad)[1]
+    special = "$$DELETED"
+    redis.lset(key, to_delete, special)
+    redis.lrem(key, 0, special)
+
+def old_replace_same_id(redis: Redis, key: str, edited: MessageInfo) -> None:
+    dumps = redis.lrange(key, 0, -1)
+    value = edited.dumps_json()
+    for dump, index in zip(dumps, range(len(dumps))):
+        if json.loads(dump)['m_id'] == edited.m_id:
+            redis.lset(key, index, value)
+
+
+def timed(action: Callable[[], None], repeat: int) -> float:
+    start = perf_counter()
+    for _ in range(repeat):
+        action()
+    return (perf_counter() - start) / repeat * 1000
+
+
+def main() -> None:
+    storage = Storage(addr="localhost")
+    storage.load_scripts()
+    redis = Redis(host="localhost", db=Storage.RedisDb)
+    repeat = 100
+
+    print(f"{'pins':>6} {'operation':>16} {'old, ms':>10} {'new, ms':>10}")
+    for amount in [10, 100, 1000]:
+        msgs = gen_same_chat_messages(amount)
+        chat_id = msgs[0].chat.id
+        # old functions work on a plain list without index
+        key = f"bench:{chat_id}"
+        infos = list(map(MessageInfo, msgs))
+        redis.delete(key)
+        storage.clear(chat_id)
+        for info in infos:
+            redis.lpush(key, info.dumps_json())
+            storage.add(chat_id, info)
+
+        # remove the middle pin and put it back, so the size stays the same
+        middle = infos[amount // 2]
+        def old_rm() -> None:
+            old_remove(redis, key, middle.m_id, amount // 2)
+            redis.lpush(key, middle.dumps_json())
+        def new_rm() -> None:
+            storage.remove(chat_id, middle.m_id, amount // 2)
+            storage.add(chat_id, middle)
+        old_time = timed(old_rm, repeat)
+        new_time = timed(new_rm, repeat)
+        print(f"{amount:>6} {'remove':>16} {old_time:>10.3f} {new_time:>10.3f}")
+
+        old_time = timed(lambda: old_replace_same_id(redis, key, middle), repeat)
+        new_time = timed(lambda: storage.replace_same_id(chat_id, middle), repeat)
+        print(f"{amount:>6} {'replace_same_id':>16} {old_time:>10.3f} {new_time:>10.3f}")
+
+        storage.clear(chat_id)
+        redis.delete(key)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: time to render the text of a post, rendering every pin like
+before and with rendered pins cached. Pins are either the same objects
+every time, like in local storage, or loaded again for each render, like
+from redis.
+Then time to make the whole post with expanded buttons, making new buttons
+like before and with cached buttons and rows
+"""
+
+from time import perf_counter
+from typing import *
+from message_info import MessageInfo
+from view_post import ButtonsStatus, pins_post, pins_text
+from test.view_post_test import gen_pins, old_pins_markup, old_pins_text
+
+
+def timed(render: Callable[[List[MessageInfo]], Any]
+         ,renders: List[List[MessageInfo]]
+         ) -> float:
+    start = perf_counter()
+    for pins in renders:
+        render(pins)
+    return (perf_counter() - start) / len(renders) * 1000 * 1000
+
+
+def main() -> None:
+    print(f"{'pins':>5} {'storage':>8} {'before, us':>11} {'after, us':>10}")
+    for amount in [5, 50, 500]:
+        repeat = 20000 // amount
+        pins = gen_pins(amount)
+        chat_id = -1001234567890
+        same = [pins] * repeat
+        loaded = [ [MessageInfo.loads(pin.dumps(), chat_id) for pin in pins]
+                   for _ in range(repeat)
+                 ]
+        for name, renders in [("same", same), ("loaded", loaded)]:
+            # everything is cached after the first render
+            pins_text(renders[0])
+            before = timed(old_pins_text, renders)
+            after = timed(pins_text, renders)
+            print(f"{amount:>5} {name:>8} {before:>11.1f} {after:>10.1f}")
+
+    print()
+    print(f"{'pins':>5} {'post':>8} {'before, us':>11} {'after, us':>10}")
+    expanded = ButtonsStatus.Expanded
+    for amount in [5, 50, 500]:
+        repeat = 20000 // amount
+        renders = [gen_pins(amount)] * repeat
+        old_post = lambda pins: (old_pins_text(pins), old_pins_markup(pins, expanded))
+        new_post = lambda pins: pins_post(pins, 0, expanded)
+        new_post(renders[0])
+        before = timed(old_post, renders)
+        after = timed(new_post, renders)
+        print(f"{amount:>5} {'expanded':>8} {before:>11.1f} {after:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: time from posting an update to the webhook until its handler is
+done, with several clients posting at once like telegram does. Handlers are
+the real ones with local storage and a fake bot
+"""
+
+import handlers
+import json
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+from threading import Event, Lock, Thread
+from time import monotonic, perf_counter
+from typing import *
+from telegram.ext import Dispatcher, MessageHandler, Filters # type: ignore
+from local_store import Storage
+from webhook import WebhookConfig, WebhookServer
+from test.handlers_test import Bot
+from test.webhook_test import ChatId, Secret, post, recorded_pin
+
+
+Updates = 2000
+Chats = 100
+
+
+def percentile(values: List[float], part: float) -> float:
+    return sorted(values)[int(part * (len(values) - 1))]
+
+
+def run(clients: int) -> Tuple[float, List[float]]:
+    storage = Storage()
+    bot = Bot()
+    queue: Queue = Queue()
+    dispatcher = Dispatcher(bot, queue, workers=8, use_context=True)
+    pinned = handlers.pinned(storage)
+
+    posted: Dict[int, float] = {}
+    latencies: List[float] = []
+    lock = Lock()
+    done = Event()
+    def timed_pinned(update, context):
+        pinned(update, context)
+        with lock:
+            latencies.append(monotonic() - posted[update.update_id])
+            if len(latencies) == Updates:
+                done.set()
+    dispatcher.add_handler(MessageHandler(Filters.status_update.pinned_message, timed_pinned))
+
+    config = WebhookConfig(listen="127.0.0.1", port=0, secret=Secret)
+    server = WebhookServer(config, bot, queue)
+    port = server.start()
+    Thread(target=dispatcher.start, daemon=True).start()
+
+    bodies = [ json.dumps(recorded_pin(i, ChatId - i % Chats, 1000 + i, "text")).encode()
+               for i in range(Updates)
+             ]
+    def send(update_id: int) -> None:
+        with lock:
+            posted[update_id] = monotonic()
+        post(port, config.path, bodies[update_id])
+
+    start = perf_counter()
+    with ThreadPoolExecutor(clients) as pool:
+        list(pool.map(send, range(Updates)))
+    done.wait()
+    elapsed = perf_counter() - start
+
+    server.stop()
+    dispatcher.stop()
+    return (Updates / elapsed, latencies)
+
+
+def main() -> None:
+    print(f"{Updates} pinned updates in {Chats} chats posted to webhook")
+    print(f"{'clients':>7} {'updates/s':>9} {'p50 ms':>7} {'p99 ms':>7} {'max ms':>7}")
+    for clients in [1, 8, 40]:
+        rate, latencies = run(clients)
+        p50, p99 = percentile(latencies, 0.5), percentile(latencies, 0.99)
+        print(f"{clients:>7} {rate:>9.0f} {p50 * 1000:>7.2f} {p99 * 1000:>7.2f} {max(latencies) * 1000:>7.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+from typing import *
+from collections import OrderedDict
+from threading import Lock
+from message_info import MessageInfo
+from chat_state import ChatState
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: a cache in front of another storage, usually the remote one.
+This presents the same interface as local_store. It keeps recently used chats
+in memory as they were last loaded or written, so rendering a post doesn't
+download and decode the pins again. Writes go to the backing storage right
+away and update the cache on the way.
+Ids of pinned messages are kept for many more chats than whole states, so
+most edits of messages that aren't pinned are dropped without asking the
+backing storage.
+Only this process's writes are seen by the cache: when several processes use
+the same backing storage, they must call invalidate for chats changed by
+others.
+"""
+
+
+class Storage:
+    # Least recently used chats are evicted when there are more than this
+    # many chats or pins in the cache
+    MaxChats = 10000
+    MaxPins = 200000
+    # chats whose ids of pinned messages are kept
+    MaxPinnedChats = 200000
+
+    _backend: Any
+    # chat states as they are in backend, least recently used first
+    _chats: 'OrderedDict[int, ChatState]'
+    # ids of pinned messages of chats as they are in backend, least recently
+    # used first. Outlives the states
+    _pinned: 'OrderedDict[int, FrozenSet[int]]'
+    _pin_count: int
+    _lock: Lock
+
+    hits: int
+    misses: int
+    evictions: int
+    invalidations: int
+
+    def __init__(self, backend, max_chats: int = MaxChats
+                ,max_pins: int = MaxPins
+                ,max_pinned_chats: int = MaxPinnedChats
+                ) -> None:
+        self._backend = backend
+        self._max_chats = max_chats
+        self._max_pins = max_pins
+        self._max_pinned_chats = max_pinned_chats
+        self._chats = OrderedDict()
+        self._pinned = OrderedDict()
+        self._pin_count = 0
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return { "chats"         : len(self._chats)
+                   , "pins"          : self._pin_count
+                   , "pinned_chats"  : len(self._pinned)
+                   , "hits"          : self.hits
+                   , "misses"        : self.misses
+                   , "evictions"     : self.evictions
+                   , "invalidations" : self.invalidations
+                   }
+
+    # forget what is known about chat, it will be loaded again on next use
+    def invalidate(self, chat_id: int) -> None:
+        with self._lock:
+            self._pinned.pop(chat_id, None)
+            if chat_id in self._chats:
+                self._forget(chat_id)
+                self.invalidations += 1
+    def invalidate_all(self) -> None:
+        with self._lock:
+            self.invalidations += len(self._chats)
+            self._chats.clear()
+            self._pinned.clear()
+            self._pin_count = 0
+
+
+    # whole chat state at once
+
+    def load(self, chat_id: int) -> ChatState:
+        return self._cached(chat_id).copy()
+
+    def commit(self, state: ChatState) -> None:
+        try:
+            self._backend.commit(state)
+        except Exception:
+            # don't know what's in the backend now
+            self.invalidate(state.chat_id)
+            raise
+        self._remember(state.copy())
+
+
+    def has(self, chat_id: int) -> bool:
+        return self._cached(chat_id).has()
+    def get(self, chat_id: int) -> List[MessageInfo]:
+        return list(self._cached(chat_id).get())
+    # Whether message m_id is among chat's pins. Chats not seen before are
+    # loaded, and then their pins are known
+    def is_pinned(self, chat_id: int, m_id: int) -> bool:
+        with self._lock:
+            if chat_id in self._pinned:
+                self._pinned.move_to_end(chat_id)
+                return m_id in self._pinned[chat_id]
+        return any(pin.m_id == m_id for pin in self._cached(chat_id).pins)
+
+    def add(self, chat_id: int, msg: MessageInfo) -> None:
+        self._backend.add(chat_id, msg)
+        self._update(chat_id, lambda state: state.add(msg))
+
+    def clear(self, chat_id: int) -> None:
+        self._backend.clear(chat_id)
+        self._update(chat_id, lambda state: state.clear())
+
+    def clear_keep_last(self, chat_id: int) -> None:
+        self._backend.clear_keep_last(chat_id)
+        self._update(chat_id, lambda state: state.clear_keep_last())
+
+    def remove(self, chat_id: int, m_id: int, hint: int = 0) -> None:
+        self._backend.remove(chat_id, m_id, hint)
+        self._update(chat_id, lambda state: state.remove(m_id, hint))
+
+    def replace_same_id(self, chat_id: int, edited: MessageInfo) -> None:
+        self._backend.replace_same_id(chat_id, edited)
+        self._update(chat_id, lambda state: state.replace_same_id(edited))
+
+    # get and set id of message that you need to edit
+    def get_message_id(self, chat_id: int) -> int:
+        return self._cached(chat_id).get_message_id()
+    def set_message_id(self, chat_id: int, m_id: int) -> None:
+        self._backend.set_message_id(chat_id, m_id)
+        self._update(chat_id, lambda state: state.set_message_id(m_id))
+    def has_message_id(self, chat_id: int) -> bool:
+        return self._cached(chat_id).has_message_id()
+    def remove_message_id(self, chat_id: int) -> None:
+        self._backend.remove_message_id(chat_id)
+        self._update(chat_id, lambda state: state.remove_message_id())
+
+    # status of last message
+    def did_user_message(self, chat_id: int) -> bool:
+        return self._cached(chat_id).did_user_message()
+    def user_message_added(self, chat_id: int) -> None:
+        self._backend.user_message_added(chat_id)
+        self._update(chat_id, lambda state: state.user_message_added())
+
+
+    # chats that have anything stored
+    def chats(self) -> Iterator[int]:
+        return self._backend.chats()
+
+    # forget everything about chat
+    def drop_chat(self, chat_id: int) -> None:
+        try:
+            self._backend.drop_chat(chat_id)
+        finally:
+            self.invalidate(chat_id)
+
+
+    # cached state of chat, loaded from backend if missing. Don't modify it
+    def _cached(self, chat_id: int) -> ChatState:
+        with self._lock:
+            if chat_id in self._chats:
+                self.hits += 1
+                self._chats.move_to_end(chat_id)
+                return self._chats[chat_id]
+            self.misses += 1
+        state = self._backend.load(chat_id)
+        self._remember(state.copy())
+        return state
+
+    # apply a change that was already written to backend, if chat is cached
+    def _update(self, chat_id: int, change: Callable[[ChatState], None]) -> None:
+        with self._lock:
+            if chat_id not in self._chats:
+                # the ids can't be changed without the state
+                self._pinned.pop(chat_id, None)
+                return
+            state = self._chats[chat_id]
+            self._pin_count -= len(state.pins)
+            change(state)
+            state.mark_committed()
+            self._pin_count += len(state.pins)
+            self._chats.move_to_end(chat_id)
+            self._remember_pinned(state)
+            self._evict()
+
+    def _remember(self, state: ChatState) -> None:
+        state.mark_committed()
+        with self._lock:
+            if state.chat_id in self._chats:
+                self._forget(state.chat_id)
+            self._chats[state.chat_id] = state
+            self._pin_count += len(state.pins)
+            self._remember_pinned(state)
+            self._evict()
+
+    # must hold the lock for these
+    def _forget(self, chat_id: int) -> None:
+        state = self._chats.pop(chat_id)
+        self._pin_count -= len(state.pins)
+    def _remember_pinned(self, state: ChatState) -> None:
+        self._pinned[state.chat_id] = frozenset(pin.m_id for pin in state.pins)
+        self._pinned.move_to_end(state.chat_id)
+        while len(self._pinned) > self._max_pinned_chats:
+            self._pinned.popitem(last=False)
+    def _evict(self) -> None:
+        while len(self._chats) > 1 and ( len(self._chats) > self._max_chats
+                                      or self._pin_count > self._max_pins):
+            chat_id = next(iter(self._chats))
+            self._forget(chat_id)
+            self.evictions += 1
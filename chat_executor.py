@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+from typing import *
+from collections import OrderedDict, deque
+from threading import Condition, Lock, Thread
+from time import monotonic
+import os
+import traceback
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: running handlers for each chat one after another, without
+threads waiting for each other.
+Each chat has a mailbox of updates waiting to be handled. Chats with
+updates take turns for the worker threads: a worker handles one update of
+a chat and puts the chat back at the end of the line, so a chat with many
+updates doesn't hold up the others, and two updates of one chat are never
+handled at once. A worker is never waiting for a chat lock, because it
+only takes chats that nobody is handling.
+Errors of handlers go to on_error with the update, like dispatcher's error
+handlers get them.
+"""
+
+
+Task = Callable[[], None]
+# called with the update, or None for submitted tasks, and the error
+ErrorHandler = Callable[[Any, Exception], None]
+
+
+def print_error(update: Any, error: Exception) -> None:
+    traceback.print_exception(type(error), error, error.__traceback__)
+
+
+class ChatStats:
+    """How long updates of one chat waited in its mailbox"""
+    __slots__ = ["handled", "total_wait", "max_wait"]
+
+    def __init__(self) -> None:
+        self.handled = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def add(self, wait: float) -> None:
+        self.handled += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def as_dict(self) -> Dict[str, float]:
+        return { "handled"      : self.handled
+               , "average_wait" : self.total_wait / max(self.handled, 1)
+               , "max_wait"     : self.max_wait
+               }
+
+
+class ChatExecutor:
+    # threads handling updates
+    Workers = 8
+    # how many chats to keep stats for
+    StatChats = 10000
+
+    # updates of each chat waiting to be handled, with when they came
+    _mailboxes: Dict[Any, Deque[Tuple[float, Task]]]
+    # chats with updates that nobody is handling, in turn order
+    _ready: Deque[Any]
+    _lock: Lock
+    _changed: Condition
+    _threads: List[Thread]
+    _stopping: bool
+    # stats of recently busy chats, least recently busy first
+    _chat_stats: 'OrderedDict[Any, ChatStats]'
+
+    submitted: int
+    # most updates in one mailbox at once
+    max_depth: int
+    total: ChatStats
+
+    def __init__(self, workers: int = Workers, stat_chats: int = StatChats
+                ,on_error: ErrorHandler = print_error
+                ) -> None:
+        self._workers = workers
+        self._stat_chats = stat_chats
+        self._on_error = on_error
+        self._mailboxes = {}
+        self._ready = deque()
+        self._lock = Lock()
+        self._changed = Condition(self._lock)
+        self._threads = []
+        self._stopping = False
+        self._chat_stats = OrderedDict()
+        self.submitted = 0
+        self.max_depth = 0
+        self.total = ChatStats()
+
+    # CHAT_WORKERS sets the amount of threads
+    @staticmethod
+    def from_env( env: Mapping[str, str] = os.environ
+                , on_error: ErrorHandler = print_error
+                ) -> 'ChatExecutor':
+        return ChatExecutor( int(env.get("CHAT_WORKERS", ChatExecutor.Workers))
+                           , on_error = on_error
+                           )
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return { "mailboxes" : len(self._mailboxes)
+                   , "waiting"   : sum(map(len, self._mailboxes.values()))
+                   , "max_depth" : self.max_depth
+                   , "submitted" : self.submitted
+                   , **self.total.as_dict()
+                   }
+
+    def chat_stats(self, chat_id: Any) -> Dict[str, float]:
+        with self._lock:
+            return self._chat_stats.get(chat_id, ChatStats()).as_dict()
+
+    # Handler that puts updates into their chat's mailbox and returns at once
+    def handler(self, handler: Callable[[Any, Any], None]) -> Callable[[Any, Any], None]:
+        def r(update, context) -> None:
+            chat = update.effective_chat
+            chat_id = chat.id if chat is not None else None
+            def task() -> None:
+                try:
+                    handler(update, context)
+                except Exception as error:
+                    self._on_error(update, error)
+            self.submit(chat_id, task)
+        return r
+
+    # Run task after everything submitted for the chat before it
+    def submit(self, chat_id: Any, task: Task) -> None:
+        with self._lock:
+            if self._stopping:
+                raise RuntimeError("Executor is stopped")
+            self._start()
+            self.submitted += 1
+            if chat_id not in self._mailboxes:
+                self._mailboxes[chat_id] = deque()
+                self._ready.append(chat_id)
+                self._changed.notify()
+            mailbox = self._mailboxes[chat_id]
+            mailbox.append((monotonic(), task))
+            self.max_depth = max(self.max_depth, len(mailbox))
+
+    # Handle everything submitted and stop the threads
+    def stop(self) -> None:
+        with self._lock:
+            self._stopping = True
+            self._changed.notify_all()
+            threads = self._threads
+        for thread in threads:
+            thread.join()
+
+    # wait until all mailboxes are empty
+    def join(self) -> None:
+        with self._lock:
+            while self._mailboxes != {}:
+                self._changed.wait()
+
+    # must hold the lock
+    def _start(self) -> None:
+        if self._threads == []:
+            self._threads = [Thread(target=self._work, daemon=True)
+                             for _ in range(self._workers)]
+            for thread in self._threads:
+                thread.start()
+
+    def _work(self) -> None:
+        while True:
+            with self._lock:
+                while not self._ready:
+                    if self._stopping and self._mailboxes == {}:
+                        return
+                    self._changed.wait()
+                # the chat is not in ready while it's handled, so no other
+                # worker takes it
+                chat_id = self._ready.popleft()
+                enqueued, task = self._mailboxes[chat_id].popleft()
+                self._wait_done(chat_id, monotonic() - enqueued)
+            try:
+                task()
+            except Exception as error:
+                try:
+                    self._on_error(None, error)
+                except Exception:
+                    traceback.print_exc()
+            with self._lock:
+                if self._mailboxes[chat_id]:
+                    self._ready.append(chat_id)
+                else:
+                    del self._mailboxes[chat_id]
+                self._changed.notify_all()
+
+    # must hold the lock
+    def _wait_done(self, chat_id: Any, wait: float) -> None:
+        self.total.add(wait)
+        if chat_id not in self._chat_stats:
+            self._chat_stats[chat_id] = ChatStats()
+            if len(self._chat_stats) > self._stat_chats:
+                self._chat_stats.popitem(last=False)
+        self._chat_stats[chat_id].add(wait)
+        self._chat_stats.move_to_end(chat_id)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+from typing import *
+from telegram import InlineKeyboardMarkup # type: ignore
+from chat_state import ChatState
+from control import parse_unpin_data
+from control import UnpinAll, KeepLast, ButtonsExpand, ButtonsCollapse
+from fingerprint import Change
+from view_post import ButtonsStatus, EmptyPost, pins_post
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: what handlers do with a chat, apart from talking to telegram.
+Both handlers and async_handlers decide everything here, and only make the
+requests their own way.
+"""
+
+
+def gen_post(state: ChatState
+            ,button_status: ButtonsStatus = ButtonsStatus.Collapsed
+            ) -> Tuple[str, InlineKeyboardMarkup]:
+    if not state.has():
+        return EmptyPost
+    else:
+        pins = state.get()
+        return pins_post(pins, state.chat_id, button_status)
+
+
+def pin_from_self(state: ChatState, update) -> bool:
+    msg = update.message.pinned_message
+
+    if not state.has_message_id():
+        return False
+    old_msg_id = state.get_message_id()
+    if old_msg_id == msg.message_id:
+        return True
+
+    return False
+
+
+# There recently was a user message, or there is no bot's pinned message to
+# edit. Then a new post is sent instead of editing the old one
+def needs_new_post(state: ChatState) -> bool:
+    return state.did_user_message() or not state.has_message_id()
+
+
+# expanding and collapsing changes nothing, so anyone may do it
+def changes_pins(data: str) -> bool:
+    return data not in [ButtonsExpand, ButtonsCollapse]
+
+# Do what the button with data does to the chat. Returns how the post shows
+# buttons after it
+def press_button(state: ChatState, data: str) -> ButtonsStatus:
+    if data == UnpinAll:
+        state.clear()
+        return ButtonsStatus.Collapsed
+    elif data == KeepLast:
+        state.clear_keep_last()
+        return ButtonsStatus.Collapsed
+    elif data == ButtonsExpand:
+        return ButtonsStatus.Expanded
+    elif data == ButtonsCollapse:
+        return ButtonsStatus.Collapsed
+    else:
+        to_unpin_id, msg_index = parse_unpin_data(data)
+        state.remove(to_unpin_id, msg_index)
+        return ButtonsStatus.Expanded
+
+
+# Bot method and its arguments that make the post show text and layout,
+# for a change that is not Change.Nothing. Only buttons are sent if the text
+# is the same
+def edit_request(change: Change, chat_id: int, msg_id: int
+                ,text: str, layout: InlineKeyboardMarkup
+                ) -> Tuple[str, Dict[str, Any]]:
+    if change == Change.Markup:
+        return ("edit_message_reply_markup", { "chat_id"      : chat_id
+                                             , "message_id"   : msg_id
+                                             , "reply_markup" : layout
+                                             })
+    else:
+        return ("edit_message_text", { "chat_id"      : chat_id
+                                     , "message_id"   : msg_id
+                                     , "text"         : text
+                                     , "parse_mode"   : "HTML"
+                                     , "reply_markup" : layout
+                                     })
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+
+from typing import *
+from contextlib import asynccontextmanager, contextmanager
+from message_info import MessageInfo
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: a snapshot of everything stored for one chat.
+Handlers load it from storage in one go, work with it in memory and then
+commit it back. This way a handler costs one read and one write, no matter
+how many storage methods it would have called otherwise.
+The snapshot remembers what happened to the pins, so that storage can replay
+these changes on commit instead of rewriting the whole list.
+"""
+
+
+# a change to the list of pins, recorded for replaying on commit.
+# name and args are the storage method and its arguments (without chat id),
+# indices are positions in the list the change touched at the moment it
+# happened
+class PinOp(NamedTuple):
+    name: str
+    args: tuple
+    indices: List[int]
+
+
+class ChatState:
+    chat_id: int
+    # pinned messages, latest first
+    pins: List[MessageInfo]
+    # msg_id of the bot's message with pins, None if there's none
+    message_id: Optional[int]
+    # whether someone wrote something to chat after bot's pin
+    user_wrote: bool
+    # changes to pins since load
+    pin_ops: List[PinOp]
+    # storage drops oldest pins when there are more than this
+    max_pins: Optional[int]
+
+    _loaded_message_id: Optional[int]
+    _loaded_user_wrote: bool
+
+    def __init__(self, chat_id: int, pins: List[MessageInfo]
+                ,message_id: Optional[int], user_wrote: bool
+                ,max_pins: Optional[int] = None
+                ) -> None:
+        self.chat_id = chat_id
+        self.pins = pins
+        self.message_id = message_id
+        self.user_wrote = user_wrote
+        self.pin_ops = []
+        self.max_pins = max_pins
+        self._loaded_message_id = message_id
+        self._loaded_user_wrote = user_wrote
+
+    # a snapshot with the same data, as if loaded again
+    def copy(self) -> 'ChatState':
+        return ChatState( self.chat_id, list(self.pins)
+                        , self.message_id, self.user_wrote
+                        , self.max_pins
+                        )
+
+    # the same interface as storage has, but without chat ids
+
+    def has(self) -> bool:
+        return self.pins != []
+    def get(self) -> List[MessageInfo]:
+        return self.pins
+
+    def add(self, msg: MessageInfo) -> None:
+        self.pins.insert(0, msg)
+        self.pin_ops.append(PinOp("add", (msg,), [0]))
+        if self.max_pins is not None:
+            del self.pins[self.max_pins:]
+
+    def clear(self) -> None:
+        self.pins = []
+        self.pin_ops.append(PinOp("clear", (), []))
+
+    def clear_keep_last(self) -> None:
+        self.pins = self.pins[:1]
+        self.pin_ops.append(PinOp("clear_keep_last", (), [0]))
+
+    def remove(self, m_id: int, hint: int = 0) -> None:
+        # calculate indicies to drop
+        all_bad = [(abs(index - hint), index)
+                      for index, msg in enumerate(self.pins)
+                      if msg.m_id == m_id
+                  ]
+        if all_bad == []:
+            return
+
+        to_delete = min(all_bad)[1]
+        del self.pins[to_delete]
+        self.pin_ops.append(PinOp("remove", (m_id, hint), [to_delete]))
+
+    def replace_same_id(self, edited: MessageInfo) -> None:
+        indices = [index for index, msg in enumerate(self.pins)
+                         if msg.m_id == edited.m_id
+                  ]
+        if indices == []:
+            return
+        for index in indices:
+            self.pins[index] = edited
+        self.pin_ops.append(PinOp("replace_same_id", (edited,), indices))
+
+    # get and set id of message that you need to edit
+    def get_message_id(self) -> int:
+        if self.message_id is None:
+            raise KeyError(self.chat_id)
+        return self.message_id
+    def set_message_id(self, m_id: int) -> None:
+        self.message_id = m_id
+        # automatically set that no user has messaged us
+        self.user_wrote = False
+    def has_message_id(self) -> bool:
+        return self.message_id is not None
+    def remove_message_id(self) -> None:
+        self.message_id = None
+
+    # status of last message
+    def did_user_message(self) -> bool:
+        return self.user_wrote
+    def user_message_added(self) -> None:
+        self.user_wrote = True
+
+    # used by storage on commit
+
+    def message_id_changed(self) -> bool:
+        return self.message_id != self._loaded_message_id
+    def user_wrote_changed(self) -> bool:
+        return self.user_wrote != self._loaded_user_wrote
+    def changed(self) -> bool:
+        return (self.pin_ops != []
+                or self.message_id_changed()
+                or self.user_wrote_changed())
+    # storage has all the changes now
+    def mark_committed(self) -> None:
+        self.pin_ops = []
+        self._loaded_message_id = self.message_id
+        self._loaded_user_wrote = self.user_wrote
+
+
+# Load chat state and commit it back when done. The state is committed even
+# if the block raises: some telegram requests may fail after storage was
+# already changed, and these changes are still valid
+@contextmanager
+def transaction(storage, chat_id: int) -> Iterator[ChatState]:
+    state = storage.load(chat_id)
+    try:
+        yield state
+    finally:
+        storage.commit(state)
+
+
+# Same for asyncio storage
+@asynccontextmanager
+async def async_transaction(storage, chat_id: int) -> AsyncIterator[ChatState]:
+    state = await storage.load(chat_id)
+    try:
+        yield state
+    finally:
+        await storage.commit(state)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+from typing import *
+from collections import OrderedDict
+from threading import Lock
+from chat_state import ChatState
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: users writing in chats, as seen by this process.
+Storage only needs to know if a user wrote after the bot's post, so it's
+told about the first user message after the post, and the following ones
+cost nothing. Another process may send a new post without this one knowing,
+which is found out when the post is rendered: message ids grow in each
+chat, so a user wrote after the post in storage if their last message has
+a larger id than it.
+This is kept in memory for the most recently active chats; a forgotten chat
+just tells storage again.
+"""
+
+
+class Chatter:
+    # how many chats to remember
+    Size = 100000
+
+    # chat id to id of the last user message, and whether storage knows that
+    # a user wrote after the post
+    _chats: 'OrderedDict[int, List[Any]]'
+    _lock: Lock
+
+    messages: int
+    stored: int
+
+    def __init__(self, size: int = Size) -> None:
+        self._size = size
+        self._chats = OrderedDict()
+        self._lock = Lock()
+        self.messages = 0
+        self.stored = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return { "chats"    : len(self._chats)
+                   , "messages" : self.messages
+                   , "stored"   : self.stored
+                   }
+
+    # Remember a user message. Returns whether storage already knows that a
+    # user wrote after the post; if it doesn't, tell it and call written
+    def wrote(self, chat_id: int, m_id: int) -> bool:
+        with self._lock:
+            self.messages += 1
+            entry = self._chats.get(chat_id)
+            if entry is None:
+                entry = [m_id, False]
+                self._chats[chat_id] = entry
+                if len(self._chats) > self._size:
+                    self._chats.popitem(last=False)
+            else:
+                entry[0] = max(entry[0], m_id)
+                self._chats.move_to_end(chat_id)
+            return entry[1]
+
+    # Call after storage was told that a user wrote
+    def written(self, chat_id: int) -> None:
+        with self._lock:
+            self.stored += 1
+            if chat_id in self._chats:
+                self._chats[chat_id][1] = True
+
+    # Call after the bot sent a new post
+    def posted(self, chat_id: int) -> None:
+        with self._lock:
+            if chat_id in self._chats:
+                self._chats[chat_id][1] = False
+
+    # Mark in state that a user wrote after the post if they did, which
+    # storage may not know if the post was sent by someone else
+    def check(self, state: ChatState) -> None:
+        with self._lock:
+            entry = self._chats.get(state.chat_id)
+            if entry is None or state.message_id is None:
+                return
+            if entry[0] > state.message_id:
+                state.user_message_added()
+            entry[1] = state.did_user_message()
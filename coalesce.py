@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+from typing import *
+from concurrent.futures import ThreadPoolExecutor
+from enum import IntEnum
+from heapq import heappop, heappush
+from threading import Condition, Lock, Thread
+from time import monotonic
+import os
+import traceback
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: delaying renders of the bot's post, so that one render shows
+many changes.
+When something changes in a chat, the post is rendered after a short window
+instead of right away. Changes to the same chat during the window don't
+render again, and the render shows the chat as it is when the window ends.
+With a window of 0 nothing is delayed.
+"""
+
+
+# What to do to the post. Bigger kinds do everything smaller ones do
+class Render(IntEnum):
+    # edit text of the post
+    Edit = 1
+    # edit or resend the post, and pin it again
+    Post = 2
+
+
+# renders post in chat with the kind of render
+Renderer = Callable[[int, Render], None]
+
+
+class Coalescer:
+    # seconds between the first change and the render
+    Window = 0.0
+    # threads doing renders
+    Workers = 4
+
+    window: float
+    # what is waiting to be rendered for each chat
+    _pending: Dict[int, Tuple[Render, Renderer]]
+    # when each chat's window ends, earliest first
+    _due: List[Tuple[float, int]]
+    _lock: Lock
+    _changed: Condition
+    _timer: Optional[Thread]
+    _pool: Optional[ThreadPoolExecutor]
+
+    deferred: int
+    coalesced: int
+    rendered: int
+
+    def __init__(self, window: float = Window, workers: int = Workers) -> None:
+        self.window = window
+        self._workers = workers
+        self._pending = {}
+        self._due = []
+        self._lock = Lock()
+        self._changed = Condition(self._lock)
+        self._timer = None
+        self._pool = None
+        self.deferred = 0
+        self.coalesced = 0
+        self.rendered = 0
+
+    # POST_RENDER_WINDOW sets the window in seconds
+    @staticmethod
+    def from_env(env: Mapping[str, str] = os.environ) -> 'Coalescer':
+        return Coalescer(float(env.get("POST_RENDER_WINDOW", Coalescer.Window)))
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return { "pending"   : len(self._pending)
+                   , "deferred"  : self.deferred
+                   , "coalesced" : self.coalesced
+                   , "rendered"  : self.rendered
+                   }
+
+    # Render chat's post when the window ends. Returns False without doing
+    # anything if there's no window: then the caller renders right away
+    def defer(self, chat_id: int, kind: Render, render: Renderer) -> bool:
+        if self.window <= 0:
+            return False
+        with self._lock:
+            self.deferred += 1
+            if chat_id in self._pending:
+                pending_kind, _ = self._pending[chat_id]
+                self._pending[chat_id] = (max(kind, pending_kind), render)
+                self.coalesced += 1
+                return True
+            self._pending[chat_id] = (kind, render)
+            heappush(self._due, (monotonic() + self.window, chat_id))
+            self._start()
+            self._changed.notify()
+        return True
+
+    # render everything pending now
+    def flush(self) -> None:
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._due = []
+        for chat_id, (kind, render) in pending.items():
+            self._render(chat_id, kind, render)
+
+    # must hold the lock
+    def _start(self) -> None:
+        if self._timer is None:
+            self._pool = ThreadPoolExecutor(self._workers)
+            self._timer = Thread(target=self._wait_for_windows, daemon=True)
+            self._timer.start()
+
+    def _wait_for_windows(self) -> None:
+        while True:
+            with self._lock:
+                while self._due == [] or self._due[0][0] > monotonic():
+                    timeout = None if self._due == [] else self._due[0][0] - monotonic()
+                    self._changed.wait(timeout)
+                _, chat_id = heappop(self._due)
+                if chat_id not in self._pending:
+                    # flushed meanwhile
+                    continue
+                kind, render = self._pending.pop(chat_id)
+            self._pool.submit(self._render, chat_id, kind, render)
+
+    def _render(self, chat_id: int, kind: Render, render: Renderer) -> None:
+        try:
+            render(chat_id, kind)
+        except Exception:
+            traceback.print_exc()
+        with self._lock:
+            self.rendered += 1
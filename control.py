@@ -17,7 +17,10 @@ ButtonsExpand = "$$EXPAND"
 ButtonsCollapse = "$$COLLAPSE"
 
 def unpin_message_data(msg: Message, index: int) -> str:
-    return f"{str(msg.m_id)}:{index}"
+    return unpin_data(msg.m_id, index)
+
+def unpin_data(m_id: int, index: int) -> str:
+    return f"{str(m_id)}:{index}"
 
 # for data packed with function above: retrieve id and index
 def parse_unpin_data(data: str) -> Tuple[int, int]:
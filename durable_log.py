@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+
+from typing import *
+from threading import Condition, Lock, Thread
+import os
+import struct
+import zlib
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: append-only log of records on disk, with snapshots.
+Records are opaque bytes. Appending returns a ticket, and waiting for the
+ticket returns when the record is on disk. One background thread does the
+fsyncs, so records appended by many threads while it's busy get synced
+together.
+
+A directory holds log files log.{generation} and a snapshot file. A snapshot
+of generation G contains the state before log G, so the state is restored
+from the snapshot followed by logs G, G+1 and so on. Whatever was being
+written during a crash is found broken and ignored.
+"""
+
+
+# length and crc32 of record
+RecordHeader = struct.Struct("<II")
+SnapshotMagic = b"PINSNAP1"
+SnapshotHeader = struct.Struct("<8sQ")
+LogPrefix = "log."
+SnapshotName = "snapshot"
+
+
+def frame(record: bytes) -> bytes:
+    return RecordHeader.pack(len(record), zlib.crc32(record)) + record
+
+# Records of a framed file, starting from offset. Stops at the first broken
+# record, which can only be the last one
+def read_records(path: str, offset: int = 0) -> Iterator[bytes]:
+    with open(path, "rb") as file:
+        data = file.read()
+    while offset + RecordHeader.size <= len(data):
+        length, crc = RecordHeader.unpack_from(data, offset)
+        start = offset + RecordHeader.size
+        record = data[start : start + length]
+        if len(record) != length or zlib.crc32(record) != crc:
+            return
+        yield record
+        offset = start + length
+
+def log_path(directory: str, generation: int) -> str:
+    return os.path.join(directory, f"{LogPrefix}{generation}")
+
+def log_generations(directory: str) -> List[int]:
+    gens = [ int(name[len(LogPrefix):]) for name in os.listdir(directory)
+             if name.startswith(LogPrefix) and name[len(LogPrefix):].isdigit()
+           ]
+    return sorted(gens)
+
+def fsync_directory(directory: str) -> None:
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def write_snapshot(directory: str, generation: int
+                  ,records: Iterable[bytes]
+                  ) -> None:
+    path = os.path.join(directory, SnapshotName)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as file:
+        file.write(SnapshotHeader.pack(SnapshotMagic, generation))
+        file.write(b"".join(map(frame, records)))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_path, path)
+    fsync_directory(directory)
+
+# generation and records of snapshot. Without one it's generation 0 with
+# no records
+def read_snapshot(directory: str) -> Tuple[int, Iterator[bytes]]:
+    path = os.path.join(directory, SnapshotName)
+    if not os.path.exists(path):
+        return (0, iter([]))
+    with open(path, "rb") as file:
+        header = file.read(SnapshotHeader.size)
+    magic, generation = SnapshotHeader.unpack(header)
+    if magic != SnapshotMagic:
+        raise ValueError(f"{path} is not a snapshot")
+    return (generation, read_records(path, SnapshotHeader.size))
+
+# Everything stored in directory, in order
+def read_all(directory: str) -> Iterator[bytes]:
+    generation, records = read_snapshot(directory)
+    yield from records
+    for log_gen in log_generations(directory):
+        if log_gen >= generation:
+            yield from read_records(log_path(directory, log_gen))
+
+
+class Log:
+    directory: str
+    generation: int
+    # records appended to current generation
+    appended: int
+
+    _file: BinaryIO
+    # protects writing and counters
+    _lock: Lock
+    _changed: Condition
+    # held while syncing, so the file isn't switched meanwhile
+    _sync_lock: Lock
+    # tickets are numbers of records appended, over all generations
+    _written: int
+    _synced: int
+    _closed: bool
+
+    # Starts a new generation after everything existing in directory
+    def __init__(self, directory: str) -> None:
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        snapshot_gen, _ = read_snapshot(directory)
+        self.generation = max(log_generations(directory) + [snapshot_gen]) + 1
+        self.appended = 0
+        self._file = open(log_path(directory, self.generation), "ab")
+        fsync_directory(directory)
+
+        self._lock = Lock()
+        self._changed = Condition(self._lock)
+        self._sync_lock = Lock()
+        self._written = 0
+        self._synced = 0
+        self._closed = False
+        self._syncer = Thread(target=self._sync_loop, daemon=True)
+        self._syncer.start()
+
+    def append(self, record: bytes) -> int:
+        with self._lock:
+            if self._closed:
+                raise ValueError("Log is closed")
+            self._file.write(frame(record))
+            self._written += 1
+            self.appended += 1
+            self._changed.notify_all()
+            return self._written
+
+    # wait until the record with this ticket is on disk
+    def wait(self, ticket: int) -> None:
+        with self._lock:
+            while self._synced < ticket:
+                self._changed.wait()
+
+    # Sync everything and continue in a new generation. Returns it
+    def rotate(self) -> int:
+        with self._sync_lock, self._lock:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._synced = self._written
+            self._changed.notify_all()
+
+            self.generation += 1
+            self.appended = 0
+            self._file = open(log_path(self.directory, self.generation), "ab")
+            fsync_directory(self.directory)
+            return self.generation
+
+    # remove logs that are in snapshot of generation
+    def remove_before(self, generation: int) -> None:
+        for log_gen in log_generations(self.directory):
+            if log_gen < generation:
+                os.remove(log_path(self.directory, log_gen))
+
+    def close(self) -> None:
+        with self._sync_lock, self._lock:
+            if self._closed:
+                return
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._synced = self._written
+            self._closed = True
+            self._changed.notify_all()
+        self._syncer.join()
+
+    def _sync_loop(self) -> None:
+        while True:
+            with self._lock:
+                while self._synced == self._written and not self._closed:
+                    self._changed.wait()
+                if self._closed:
+                    return
+            with self._sync_lock:
+                with self._lock:
+                    if self._closed:
+                        return
+                    target = self._written
+                    self._file.flush()
+                    fd = self._file.fileno()
+                # others keep appending while we wait for disk
+                os.fsync(fd)
+                with self._lock:
+                    self._synced = max(self._synced, target)
+                    self._changed.notify_all()
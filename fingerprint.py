@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+from typing import *
+from collections import OrderedDict
+from enum import IntEnum
+from hashlib import blake2b
+from threading import Lock
+from telegram import InlineKeyboardMarkup # type: ignore
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: what each chat's post shows now.
+The text and buttons last sent to a post are remembered as short hashes, so
+an edit that would show the same thing is never sent, and an edit that only
+changes buttons sends only buttons. This is kept in memory for the most
+recently rendered chats; a forgotten chat is just edited fully again.
+"""
+
+
+# what an edit changes in the post
+class Change(IntEnum):
+    Nothing = 0
+    Markup = 1
+    Text = 2
+
+
+def digest(data: str) -> bytes:
+    return blake2b(data.encode(), digest_size=16).digest()
+
+# hashes of text and markup
+Fingerprint = Tuple[bytes, bytes]
+
+def fingerprint(text: str, markup: InlineKeyboardMarkup) -> Fingerprint:
+    return (digest(text), digest(markup.to_json()))
+
+
+class RenderedPosts:
+    # how many chats to remember
+    Size = 100000
+
+    # chat id to post's message id and what it shows
+    _posts: 'OrderedDict[int, Tuple[int, Fingerprint]]'
+    _lock: Lock
+
+    checked: int
+    skipped: int
+    markup_only: int
+
+    def __init__(self, size: int = Size) -> None:
+        self._size = size
+        self._posts = OrderedDict()
+        self._lock = Lock()
+        self.checked = 0
+        self.skipped = 0
+        self.markup_only = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return { "posts"       : len(self._posts)
+                   , "checked"     : self.checked
+                   , "skipped"     : self.skipped
+                   , "markup_only" : self.markup_only
+                   }
+
+    # What should be edited in the post to show text and markup
+    def change(self, chat_id: int, message_id: int
+              ,text: str, markup: InlineKeyboardMarkup
+              ) -> Change:
+        new_text, new_markup = fingerprint(text, markup)
+        with self._lock:
+            self.checked += 1
+            if chat_id not in self._posts:
+                return Change.Text
+            old_id, (old_text, old_markup) = self._posts[chat_id]
+            if old_id != message_id or old_text != new_text:
+                return Change.Text
+            if old_markup != new_markup:
+                self.markup_only += 1
+                return Change.Markup
+            self.skipped += 1
+            return Change.Nothing
+
+    # Call after the post was sent or edited successfully
+    def remember(self, chat_id: int, message_id: int
+                ,text: str, markup: InlineKeyboardMarkup
+                ) -> None:
+        shown = fingerprint(text, markup)
+        with self._lock:
+            self._posts[chat_id] = (message_id, shown)
+            self._posts.move_to_end(chat_id)
+            if len(self._posts) > self._size:
+                self._posts.popitem(last=False)
+
+    # Call when the post is deleted, or when it's not known what it shows
+    def forget(self, chat_id: int) -> None:
+        with self._lock:
+            self._posts.pop(chat_id, None)
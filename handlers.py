@@ -7,12 +7,20 @@ from telegram import ( InlineKeyboardButton, InlineKeyboardMarkup # type: ignore
                      , Update, User
                      )
 from local_store import Storage
+from chat_state import ChatState, transaction
 from enum import Enum
-from control import parse_unpin_data
 from control import UnpinAll, KeepLast, ButtonsExpand, ButtonsCollapse
 from message_info import MessageInfo
-from view_post import ButtonsStatus, EmptyPost, pins_post
+from view_post import EmptyPost
+from chat_logic import gen_post, pin_from_self, needs_new_post
+from chat_logic import changes_pins, press_button, edit_request
 from varlock import VarLock
+from storage_error import StorageError
+from coalesce import Coalescer, Render
+from outgoing import Outbox, Priority, on_failure, report_failure
+from fingerprint import Change, RenderedPosts
+from permissions import Permissions
+from chatter import Chatter
 
 """
 Author: d86leader@mail.com, 2019
@@ -26,6 +34,24 @@ Description: main handlers for telegram
 # have access to same chats.
 chat_lock = VarLock()
 
+# Delays renders of posts so that bursts of changes render once. Doesn't delay
+# anything unless given a window
+post_renders = Coalescer()
+
+# All requests to telegram go through it, to keep within telegram's limits.
+# Doesn't limit anything unless given limits
+outbox = Outbox()
+
+# What posts show now, to not send edits that change nothing
+rendered_posts = RenderedPosts()
+
+# Answers about who may pin, to not ask on every button press
+permissions = Permissions()
+
+# Users writing in chats, to tell storage only about the first message after
+# the post
+chatter = Chatter()
+
 
 # decorator: curry first positional argument of function
 def curry(func):
@@ -36,6 +62,16 @@ def curry(func):
     return curried1
 
 
+# decorator: when storage is unavailable, report it and drop the update
+def drop_on_storage_error(func):
+    def r(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except StorageError as e:
+            print(f"Dropping update: {e}")
+    return r
+
+
 def start(update: Update, context: CallbackContext):
     update.message.reply_text("Hi!")
 
@@ -55,122 +91,156 @@ I'm a bot, see my github in the link above. If you want to use this bot in your
 def error(logger, update: Update, context: CallbackContext):
     logger.warning(f"Update '{update}' caused error: {context.error}")
 
+# job for job queue: log how the caches and queues do
+@curry
+def report_stats(logger, context: CallbackContext):
+    logger.info(f"Post renders: {post_renders.stats()}")
+    logger.info(f"Outbox: {outbox.stats()}")
+    logger.info(f"Rendered posts: {rendered_posts.stats()}")
+    logger.info(f"Permissions: {permissions.stats()}")
+    logger.info(f"Chatter: {chatter.stats()}")
+
 
 @curry
+@drop_on_storage_error
 def pinned(storage: Storage, update: Update, context: CallbackContext):
     if update.message.from_user.is_bot:
         return
-    if pin_from_self(storage, update):
-        return
 
-    bot = context.bot
+    bot = outbox.bot(context.bot)
 
     chat_id = update.message.chat_id
-    with chat_lock.lock(chat_id):
+    with chat_lock.lock(chat_id), transaction(storage, chat_id) as state:
+        if pin_from_self(state, update):
+            return
+
         msg_info = MessageInfo(update.message.pinned_message)
 
         # add pinned message for this chat
-        storage.add(chat_id, msg_info)
-        # send or update the bot's pinned message
-        send_message(storage, bot, chat_id)
+        state.add(msg_info)
+        # send or update the bot's pinned message, maybe together with the
+        # following pins
+        if not post_renders.defer(chat_id, Render.Post, render_later(storage, bot)):
+            send_message(state, bot)
 
 @curry
+@drop_on_storage_error
 def button_pressed(storage: Storage, update: Update, context: CallbackContext):
-    bot = context.bot
+    bot = outbox.bot(context.bot)
     cb = update.callback_query
-    cb.answer("")
     chat_id = cb.message.chat_id
+    answered = outbox.submit(chat_id, cb.answer, "", priority=Priority.Interactive
+                            ,limited=False)
+    answered.add_done_callback(report_failure)
 
-    with chat_lock.lock(chat_id):
+    with chat_lock.lock(chat_id), transaction(storage, chat_id) as state:
         # do nothing if message already destroyed
-        if not storage.has_message_id(chat_id):
+        if not state.has_message_id():
             return
-        msg_id = storage.get_message_id(chat_id)
+        msg_id = state.get_message_id()
 
-        if not allowed_to_pin(bot, chat_id, cb.from_user):
+        if changes_pins(cb.data) and not allowed_to_pin(bot, chat_id, cb.from_user):
             return
 
-        # default status of response buttons. May be changed in handling below
-        response_buttons = ButtonsStatus.Collapsed
-        if cb.data == UnpinAll:
-            storage.clear(chat_id)
-        elif cb.data == KeepLast:
-            storage.clear_keep_last(chat_id)
-        elif cb.data == ButtonsExpand:
-            response_buttons = ButtonsStatus.Expanded
-        elif cb.data == ButtonsCollapse:
-            response_buttons = ButtonsStatus.Collapsed
-        else:
-            to_unpin_id, msg_index = parse_unpin_data(cb.data)
-            storage.remove(chat_id, to_unpin_id, msg_index)
-            response_buttons = ButtonsStatus.Expanded
-
-        text, layout = gen_post(storage, chat_id, response_buttons)
+        response_buttons = press_button(state, cb.data)
+        text, layout = gen_post(state, response_buttons)
         if (text, layout) == EmptyPost:
             try:
                 bot.unpin_chat_message(chat_id, msg_id)
                 bot.delete_message(chat_id, msg_id)
-                storage.remove_message_id(chat_id)
+                state.remove_message_id()
+                rendered_posts.forget(chat_id)
             except Exception as e:
                 tb = traceback.format_exc()
                 print(tb)
             return
 
-        bot.edit_message_text(
-            chat_id       = chat_id
-            ,message_id   = msg_id
-            ,text         = text
-            ,parse_mode   = "HTML"
-            ,reply_markup = layout
-            )
+        edit_post(bot, chat_id, msg_id, text, layout)
 
 @curry
+@drop_on_storage_error
 def message_edited(storage: Storage, update: Update, context: CallbackContext):
+    bot = outbox.bot(context.bot)
     edited = update.edited_message
     chat_id = edited.chat_id
+    with chat_lock.lock(chat_id):
+        # most edited messages aren't pinned, and there's nothing to do for
+        # them. Checked under the lock, so that a pin of this message being
+        # handled is seen
+        if not storage.is_pinned(chat_id, edited.message_id):
+            return
 
-    # do nothing if message is already deleted or never existed
-    if not storage.has_message_id(chat_id):
-        return
-    msg_id = storage.get_message_id(chat_id)
+        with transaction(storage, chat_id) as state:
+            # do nothing if message is already deleted or never existed
+            if not state.has_message_id():
+                return
+            msg_id = state.get_message_id()
 
-    msg = MessageInfo(edited)
-    storage.replace_same_id(chat_id, msg)
+            msg = MessageInfo(edited)
+            state.replace_same_id(msg)
+
+            if not post_renders.defer(chat_id, Render.Edit, render_later(storage, bot)):
+                edit_message(state, bot)
 
-    text, layout = gen_post(storage, chat_id)
-    try:
-        #may fail if message too old, but it doesn't really matter in that case
-        context.bot.edit_message_text(
-            chat_id       = chat_id
-            ,message_id   = msg_id
-            ,text         = text
-            ,parse_mode   = "HTML"
-            ,reply_markup = layout
-            )
-    except Exception as e:
-        tb = traceback.format_exc()
-        print(tb)
+
+# Users joining or leaving may have other permissions when they are back
+def members_changed(update: Update, context: CallbackContext):
+    msg = update.message
+    users = list(msg.new_chat_members or [])
+    if msg.left_chat_member is not None:
+        users.append(msg.left_chat_member)
+    for user in users:
+        permissions.member_changed(msg.chat_id, user.id)
+        if user.id == context.bot.id:
+            # the bot itself is added to a chat, or removed from it
+            permissions.chat_changed(msg.chat_id)
 
 
 @curry
+@drop_on_storage_error
 def message(storage: Storage, update: Update, context: CallbackContext):
     # this is in this `if` statement because current api version doesn't
     # support a filter like this, even thought docs say it does
     if update.message and update.message.chat_id:
         chat_id = update.message.chat_id
+        if chatter.wrote(chat_id, update.message.message_id):
+            return
         with chat_lock.lock(chat_id):
             storage.user_message_added(chat_id)
-
+            chatter.written(chat_id)
+
+
+# Renderer for post_renders. Button presses are never delayed, users expect
+# to see what they pressed at once
+def render_later(storage: Storage, bot) -> Callable[[int, Render], None]:
+    @drop_on_storage_error
+    def render(chat_id: int, kind: Render) -> None:
+        with chat_lock.lock(chat_id), transaction(storage, chat_id) as state:
+            # the post could be gone already
+            if kind == Render.Post:
+                if state.has():
+                    send_message(state, bot)
+            elif state.has_message_id():
+                edit_message(state, bot)
+    return render
+
+def edit_message(state: ChatState, bot) -> None:
+    text, layout = gen_post(state)
+    try:
+        #may fail if message too old, but it doesn't really matter in that case
+        edit_post(bot, state.chat_id, state.get_message_id(), text, layout)
+    except Exception as e:
+        tb = traceback.format_exc()
+        print(tb)
 
 # this function never deletes a message
-def send_message(storage: Storage, bot, chat_id: int) -> None:
-    text, layout = gen_post(storage, chat_id)
-
-    new_message = storage.did_user_message(chat_id)
-    has_editable = storage.has_message_id(chat_id)
-    if new_message or not has_editable:
-        # There recently was a user message, or there is no bot's pinned
-        # message to edit. We need to send a new one
+def send_message(state: ChatState, bot) -> None:
+    chat_id = state.chat_id
+    text, layout = gen_post(state)
+
+    chatter.check(state)
+    has_editable = state.has_message_id()
+    if needs_new_post(state):
         try:
             sent_msg = bot.send_message(chat_id, text=text
                                        ,parse_mode="HTML"
@@ -179,10 +249,12 @@ def send_message(storage: Storage, bot, chat_id: int) -> None:
 
             # remember the message for future edits
             if has_editable:
-                old_msg = storage.get_message_id(chat_id)
+                old_msg = state.get_message_id()
 
             # remember the message for future edits
-            storage.set_message_id(chat_id, sent_id)
+            state.set_message_id(sent_id)
+            rendered_posts.remember(chat_id, sent_id, text, layout)
+            chatter.posted(chat_id)
             bot.pin_chat_message(chat_id, sent_id, disable_notification=True)
 
             # delete old pin message
@@ -192,44 +264,35 @@ def send_message(storage: Storage, bot, chat_id: int) -> None:
             tb = traceback.format_exc()
             print(tb)
     else:
-        msg_id = storage.get_message_id(chat_id)
-        bot.edit_message_text(
-            chat_id       = chat_id
-            ,message_id   = msg_id
-            ,text         = text
-            ,parse_mode   = "HTML"
-            ,reply_markup = layout
-            )
+        msg_id = state.get_message_id()
+        edit_post(bot, chat_id, msg_id, text, layout)
         # also repin bot's message
         bot.pin_chat_message(chat_id, msg_id, disable_notification=True)
 
-def gen_post(storage, chat_id: int
-            ,button_status: ButtonsStatus = ButtonsStatus.Collapsed
-            ) -> Tuple[str, InlineKeyboardMarkup]:
-    if not storage.has(chat_id):
-        return EmptyPost
-    else:
-        pins = storage.get(chat_id)
-        return pins_post(pins, chat_id, button_status)
-
-
-def pin_from_self(storage, update) -> bool:
-    msg = update.message.pinned_message
-    chat_id = msg.chat_id
-
-    if not storage.has_message_id(chat_id):
-        return False
-    old_msg_id = storage.get_message_id(chat_id)
-    if old_msg_id == msg.message_id:
-        return True
-
-    return False
+# Make bot's post show text and layout. Sends nothing if it shows them
+# already, and only the buttons if the text is the same
+def edit_post(bot, chat_id: int, msg_id: int
+             ,text: str, layout: InlineKeyboardMarkup
+             ) -> None:
+    change = rendered_posts.change(chat_id, msg_id, text, layout)
+    if change == Change.Nothing:
+        return
+    method, kwargs = edit_request(change, chat_id, msg_id, text, layout)
+    try:
+        sent = getattr(bot, method)(**kwargs)
+    except Exception:
+        # the post may show anything now
+        rendered_posts.forget(chat_id)
+        raise
+    rendered_posts.remember(chat_id, msg_id, text, layout)
+    # queued edits fail later
+    on_failure(sent, lambda: rendered_posts.forget(chat_id))
 
 def allowed_to_pin(bot, chat_id: int, user: User) -> bool:
     try:
-        chat = bot.get_chat(chat_id)
+        chat = permissions.get_chat(bot, chat_id)
         everyone_pins = chat.permissions.can_pin_messages
-        member = bot.get_chat_member(chat_id, user.id)
+        member = permissions.get_chat_member(bot, chat_id, user.id)
         user_pins = member.can_pin_messages
 
         if everyone_pins and user_pins != False:
@@ -1,93 +1,339 @@
 #!/usr/bin/env python3
 
 from typing import *
+from threading import RLock, Thread
 from message_info import MessageInfo
+from chat_state import ChatState
+import durable_log
+import struct
 
 """
 Author: d86leader@mail.com, 2019
 License: published under GNU GPL-3
 
-Description: proxy class to a means of storage. For now i'm using python
-dict, but this should be replaced with something persistant very soon
+Description: proxy class to a means of storage. Data is kept in python dicts,
+and optionally made durable with a log on disk
 The Storage class stores different kinds of objects, but each is indexed with
 chat id
 """
 
 
+# Every change to durable storage is logged as a record: method code and chat
+# id, followed by method arguments
+RecordHead = struct.Struct("<Bq")
+RemoveArgs = struct.Struct("<qq")
+MessageIdArg = struct.Struct("<q")
+
+def encode_message(msg: MessageInfo) -> bytes:
+    return msg.dumps()
+def decode_message(data: bytes, chat_id: int) -> Tuple[MessageInfo]:
+    return (MessageInfo.loads(data, chat_id),)
+
+def encode_remove(m_id: int, hint: int = 0) -> bytes:
+    return RemoveArgs.pack(m_id, hint)
+def decode_remove(data: bytes, chat_id: int) -> Tuple[int, int]:
+    return RemoveArgs.unpack(data)
+
+def encode_message_id(m_id: int) -> bytes:
+    return MessageIdArg.pack(m_id)
+def decode_message_id(data: bytes, chat_id: int) -> Tuple[int]:
+    return MessageIdArg.unpack(data)
+
+def encode_nothing() -> bytes:
+    return b""
+def decode_nothing(data: bytes, chat_id: int) -> Tuple:
+    return ()
+
+# code in record: method name, argument encoder and decoder
+LoggedMethods: Dict[int, Tuple[str, Callable, Callable]] = {
+    1: ("add", encode_message, decode_message),
+    2: ("clear", encode_nothing, decode_nothing),
+    3: ("clear_keep_last", encode_nothing, decode_nothing),
+    4: ("remove", encode_remove, decode_remove),
+    5: ("replace_same_id", encode_message, decode_message),
+    6: ("set_message_id", encode_message_id, decode_message_id),
+    7: ("remove_message_id", encode_nothing, decode_nothing),
+    8: ("user_message_added", encode_nothing, decode_nothing),
+    9: ("drop_chat", encode_nothing, decode_nothing),
+}
+MethodCodes = {name: code for code, (name, _, _) in LoggedMethods.items()}
+
+def encode_record(name: str, chat_id: int, args: tuple) -> bytes:
+    code = MethodCodes[name]
+    encode = LoggedMethods[code][1]
+    return RecordHead.pack(code, chat_id) + encode(*args)
+
+def decode_record(record: bytes) -> Tuple[str, int, tuple]:
+    code, chat_id = RecordHead.unpack_from(record)
+    name, _, decode = LoggedMethods[code]
+    return (name, chat_id, decode(record[RecordHead.size:], chat_id))
+
+
+# Decorator for storage methods that change data. In durable mode the change
+# is written to log, and the method returns when it's on disk
+def logged(method):
+    def wrapper(self, chat_id: int, *args) -> None:
+        if self._log is None:
+            return method(self, chat_id, *args)
+        with self._write_lock:
+            method(self, chat_id, *args)
+            ticket = self._log.append(encode_record(method.__name__, chat_id, args))
+            need_snapshot = self._log.appended >= self._snapshot_every
+        self._log.wait(ticket)
+        if need_snapshot:
+            self._start_snapshot()
+    wrapper.__name__ = method.__name__
+    wrapper.unlogged = method
+    return wrapper
+
+
+class PinList:
+    """Pins of a single chat, together with an index of where each message id
+    is. Every pin gets a sequence number when added, and newer pins get
+    bigger numbers. Sequence numbers never change, so the index doesn't need
+    updates when other pins come and go"""
+    # pins by sequence number, oldest first
+    _pins: Dict[int, MessageInfo]
+    # sequence numbers of pins with this message id
+    _ids: Dict[int, List[int]]
+    _next_seq: int
+    # oldest pins are dropped when there are more than this
+    _max_pins: Optional[int]
+
+    def __init__(self, max_pins: Optional[int] = None) -> None:
+        self._pins = {}
+        self._ids = {}
+        self._next_seq = 0
+        self._max_pins = max_pins
+
+    def __len__(self) -> int:
+        return len(self._pins)
+
+    def __contains__(self, m_id: int) -> bool:
+        return m_id in self._ids
+
+    # latest first
+    def get(self) -> List[MessageInfo]:
+        return list(reversed(self._pins.values()))
+
+    def add(self, msg: MessageInfo) -> None:
+        seq = self._next_seq
+        self._next_seq += 1
+        self._pins[seq] = msg
+        self._ids.setdefault(msg.m_id, []).append(seq)
+        if self._max_pins is not None and len(self._pins) > self._max_pins:
+            self._drop(next(iter(self._pins)))
+
+    def clear_keep_last(self) -> None:
+        if self._pins == {}:
+            return
+        seq = next(reversed(self._pins))
+        msg = self._pins[seq]
+        self._pins = {seq: msg}
+        self._ids = {msg.m_id: [seq]}
+
+    def remove(self, m_id: int, hint: int = 0) -> None:
+        seqs = self._ids.get(m_id, [])
+        if seqs == []:
+            return
+        elif len(seqs) == 1:
+            to_delete = seqs[0]
+        else:
+            # Same message pinned several times. Only now positions are
+            # needed, to find the one closest to hint
+            indices = {seq: index
+                       for index, seq in enumerate(reversed(self._pins))}
+            to_delete = min(seqs, key=lambda seq:
+                            (abs(indices[seq] - hint), indices[seq]))
+        self._drop(to_delete)
+
+    def replace_same_id(self, edited: MessageInfo) -> None:
+        for seq in self._ids.get(edited.m_id, []):
+            self._pins[seq] = edited
+
+    def _drop(self, seq: int) -> None:
+        m_id = self._pins.pop(seq).m_id
+        seqs = self._ids[m_id]
+        seqs.remove(seq)
+        if seqs == []:
+            del self._ids[m_id]
+
+
 class Storage:
     # pinned messages
-    _pin_data: Dict[int, List[MessageInfo]]
+    _pin_data: Dict[int, PinList]
     # msg_id of the bot's message with pins
     _editables: Dict[int, int]
     # whether someone wrote something to chat after bot's pin
     # key exists if nobody wrote
     _no_chat_messages_added: Dict[int, Tuple]
+    # how many pins a chat can have, unlimited if None
+    _max_pins: Optional[int]
+
+    # log of changes, None if storage is not durable
+    _log: Optional[durable_log.Log]
+    # held while changing data and logging it, so that snapshots see data
+    # that matches the log
+    _write_lock: RLock
+    # snapshot is taken after this many records in log
+    _snapshot_every: int
+    _snapshotter: Optional[Thread]
 
-    def __init__(self) -> None:
+    # With directory, storage is durable: data is restored from it on start,
+    # and every change is written there
+    def __init__(self, max_pins: Optional[int] = None
+                ,directory: Optional[str] = None
+                ,snapshot_every: int = 100000
+                ) -> None:
+        self._max_pins  = max_pins
         self._pin_data  = {}
         self._editables = {}
         self._no_chat_messages_added = {}
+        self._log = None
+        self._write_lock = RLock()
+        self._snapshot_every = snapshot_every
+        self._snapshotter = None
+        if directory is not None:
+            self._log = durable_log.Log(directory)
+            self._restore(directory)
 
     def has(self, chat_id: int) -> bool:
-        return chat_id in self._pin_data and self._pin_data[chat_id] != []
+        return chat_id in self._pin_data and len(self._pin_data[chat_id]) != 0
     def get(self, chat_id: int) -> List[MessageInfo]:
-        return self._pin_data[chat_id]
+        return self._pin_data[chat_id].get()
+    # whether message m_id is among chat's pins
+    def is_pinned(self, chat_id: int, m_id: int) -> bool:
+        return chat_id in self._pin_data and m_id in self._pin_data[chat_id]
 
+    @logged
     def add(self, chat_id: int, msg: MessageInfo) -> None:
         if chat_id not in self._pin_data:
-            self._pin_data[chat_id] = [msg]
-        else:
-            self._pin_data[chat_id].insert(0, msg)
+            self._pin_data[chat_id] = PinList(self._max_pins)
+        self._pin_data[chat_id].add(msg)
 
+    @logged
     def clear(self, chat_id: int) -> None:
         if chat_id in self._pin_data:
             del self._pin_data[chat_id]
 
+    @logged
     def clear_keep_last(self, chat_id: int) -> None:
         if chat_id in self._pin_data:
-            # latest messages are pushed to the back, so we just delete
-            # everything but very last message
-            self._pin_data[chat_id] = self._pin_data[chat_id][:1]
+            self._pin_data[chat_id].clear_keep_last()
 
+    @logged
     def remove(self, chat_id: int, m_id: int, hint: int = 0) -> None:
-        if chat_id not in self._pin_data:
-            return
-
-        pins = self._pin_data[chat_id]
-        # calculate indicies to drop
-        all_bad = [(abs(index - hint), index)
-                      for index, msg in enumerate(pins)
-                      if msg.m_id == m_id
-                  ]
-        if all_bad == []:
-            return
-
-        to_delete = min(all_bad)[1]
-        del pins[to_delete]
+        if chat_id in self._pin_data:
+            self._pin_data[chat_id].remove(m_id, hint)
 
+    @logged
     def replace_same_id(self, chat_id: int, edited: MessageInfo) -> None:
-        if chat_id not in self._pin_data:
-            return
-        messages = self._pin_data[chat_id]
-        for message, i in zip(messages, range(len(messages))):
-            if message.m_id == edited.m_id:
-                messages[i] = edited
+        if chat_id in self._pin_data:
+            self._pin_data[chat_id].replace_same_id(edited)
 
     # get and set id of message that you need to edit
     def get_message_id(self, chat_id: int) -> int:
         return self._editables[chat_id]
+    @logged
     def set_message_id(self, chat_id: int, m_id: int) -> None:
         self._editables[chat_id] = m_id
         # automatically set that no user has messaged us
         self._no_chat_messages_added[chat_id] = ()
     def has_message_id(self, chat_id: int) -> bool:
         return chat_id in self._editables
+    @logged
     def remove_message_id(self, chat_id: int) -> None:
         del self._editables[chat_id]
 
     # status of last message
     def did_user_message(self, chat_id: int) -> bool:
         return chat_id not in self._no_chat_messages_added
+    @logged
     def user_message_added(self, chat_id: int) -> None:
         if chat_id in self._no_chat_messages_added:
             del self._no_chat_messages_added[chat_id]
+
+    # chats that have anything stored
+    def chats(self) -> Iterator[int]:
+        return iter(set(self._pin_data)
+                    | set(self._editables)
+                    | set(self._no_chat_messages_added))
+
+    # forget everything about chat
+    @logged
+    def drop_chat(self, chat_id: int) -> None:
+        self._pin_data.pop(chat_id, None)
+        self._editables.pop(chat_id, None)
+        self._no_chat_messages_added.pop(chat_id, None)
+
+    # whole chat state at once
+    def load(self, chat_id: int) -> ChatState:
+        pins = self.get(chat_id) if chat_id in self._pin_data else []
+        return ChatState( chat_id
+                        , pins
+                        , self._editables.get(chat_id)
+                        , self.did_user_message(chat_id)
+                        , self._max_pins
+                        )
+
+    def commit(self, state: ChatState) -> None:
+        chat_id = state.chat_id
+        for op in state.pin_ops:
+            getattr(self, op.name)(chat_id, *op.args)
+
+        # only logged methods are used, so that the log has everything. The
+        # flag is only reset by setting message id, maybe to the same one
+        id_changed = state.message_id_changed()
+        if id_changed and state.message_id is None:
+            self.remove_message_id(chat_id)
+        elif id_changed or (state.user_wrote_changed() and not state.user_wrote):
+            self.set_message_id(chat_id, state.message_id)
+        if state.user_wrote and (id_changed or state.user_wrote_changed()):
+            self.user_message_added(chat_id)
+        state.mark_committed()
+
+    # durability
+
+    # Write all data as a snapshot and remove logs that it replaces. Changes
+    # are only blocked while data is copied, not while it's written
+    def snapshot(self) -> None:
+        if self._log is None:
+            return
+        with self._write_lock:
+            records = list(self._snapshot_records())
+            generation = self._log.rotate()
+        durable_log.write_snapshot(self._log.directory, generation, records)
+        self._log.remove_before(generation)
+
+    def close(self) -> None:
+        if self._snapshotter is not None:
+            self._snapshotter.join()
+        if self._log is not None:
+            self._log.close()
+
+    def _start_snapshot(self) -> None:
+        with self._write_lock:
+            if self._snapshotter is not None and self._snapshotter.is_alive():
+                return
+            self._snapshotter = Thread(target=self.snapshot, daemon=True)
+            self._snapshotter.start()
+
+    # records that restore current data
+    def _snapshot_records(self) -> Iterator[bytes]:
+        for chat_id, pins in self._pin_data.items():
+            for msg in reversed(pins.get()):
+                yield encode_record("add", chat_id, (msg,))
+        for chat_id, m_id in self._editables.items():
+            yield encode_record("set_message_id", chat_id, (m_id,))
+            if chat_id not in self._no_chat_messages_added:
+                yield encode_record("user_message_added", chat_id, ())
+        # the flag outlives removed message id, and only setting an id sets it
+        for chat_id in self._no_chat_messages_added:
+            if chat_id not in self._editables:
+                yield encode_record("set_message_id", chat_id, (0,))
+                yield encode_record("remove_message_id", chat_id, ())
+
+    def _restore(self, directory: str) -> None:
+        for record in durable_log.read_all(directory):
+            name, chat_id, args = decode_record(record)
+            getattr(Storage, name).unlogged(self, chat_id, *args)
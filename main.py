@@ -9,41 +9,156 @@ Press Ctrl-C on the command line or send a signal to the process to stop the
 bot.
 """
 
+import asyncio
 import logging
 import handlers
+import async_handlers
+import os
 import sys
+from threading import Thread
 from telegram.ext import CommandHandler, CallbackQueryHandler # type: ignore
 from telegram.ext import Updater, MessageHandler, Filters # type: ignore
 from remote_store import Storage
 from local_store import Storage as LocalStorage
-from typing import Union
+from cached_store import Storage as CachedStorage
+from sql_store import Storage as SqlStorage
+from sharded_store import Storage as ShardedStorage
+from async_store import RedisStorage as AsyncStorage
+from async_store import InPlaceStorage
+from coalesce import Coalescer
+from permissions import Permissions
+from webhook import WebhookConfig, WebhookServer
+from chat_executor import ChatExecutor
+from workers import Handler, Supervisor, Worker
+from functools import partial
+from telegram import Bot # type: ignore
+from outgoing import Limits, Outbox
+from typing import *
+
+
+# Storage chosen by command line. Each worker process gets its own directory
+# for local storage, because nobody else writes its chats
+def make_storage(worker: Optional[int] = None) -> Union[CachedStorage, LocalStorage, SqlStorage]:
+    # this is the only process using redis for its chats, so cache never
+    # needs invalidation
+    storage: Union[CachedStorage, LocalStorage, SqlStorage] = CachedStorage(Storage.from_env())
+    if "REDIS_SHARDS" in os.environ:
+        storage = CachedStorage(ShardedStorage.from_env())
+    if "sqlite" in sys.argv:
+        storage = SqlStorage(os.environ.get("SQLITE_PATH", SqlStorage.DefaultPath))
+        print("Running with sqlite storage")
+    elif "local" in sys.argv:
+        # kept on disk if there's a directory for it
+        directory = os.environ.get("LOCAL_STORE_DIR")
+        if directory is not None and worker is not None:
+            directory = os.path.join(directory, f"worker{worker}")
+            os.makedirs(directory, exist_ok=True)
+        storage = LocalStorage(directory=directory)
+        print("Running with local storage")
+    return storage
+
+
+# Set up what handlers share. Requests of the bot are divided between worker
+# processes, each one gets its part of the overall limit
+def configure_handlers(processes: int = 1) -> None:
+    handlers.post_renders = Coalescer.from_env()
+    limits = Limits.from_env()
+    handlers.outbox = Outbox(limits._replace( global_rate = limits.global_rate / processes
+                                            , global_burst = limits.global_burst / processes
+                                            ))
+    handlers.permissions = Permissions.from_env()
+
+
+# Storage for async handlers. Local storage never waits, so it runs right in
+# the loop, and redis has a client of its own. Others would block the loop
+def make_async_storage(storage) -> Union[AsyncStorage, InPlaceStorage]:
+    if "sqlite" in sys.argv or "REDIS_SHARDS" in os.environ:
+        sys.exit("async works only with redis without shards or local storage")
+    if "local" in sys.argv:
+        return InPlaceStorage(storage)
+    return AsyncStorage.from_env()
+
+
+# Handlers of chat updates by name. Updates of each chat are handled in
+# order, different chats at once
+def make_handlers(storage, chat_executor: ChatExecutor) -> Dict[str, Handler]:
+    return { "pinned"          : chat_executor.handler(handlers.pinned(storage))
+           , "button_pressed"  : chat_executor.handler(handlers.button_pressed(storage))
+           , "message_edited"  : chat_executor.handler(handlers.message_edited(storage))
+           , "members_changed" : handlers.members_changed
+           , "message"         : chat_executor.handler(handlers.message(storage))
+           }
+
+
+# Worker process of the processes mode
+def setup_worker(token: str, index: int, processes: int) -> Worker:
+    logging.basicConfig(
+          format=f'%(asctime)s - worker {index} - %(name)s - %(levelname)s - %(message)s'
+        , level=logging.INFO
+        )
+    storage = make_storage(index)
+    configure_handlers(processes)
+    # workers have no dispatcher, so handler errors are logged right here
+    logger = logging.getLogger(__name__)
+    log_error = lambda update, error: logger.warning(f"Update '{update}' caused error: {error}")
+    chat_executor = ChatExecutor.from_env(on_error = log_error)
+    return Worker(Bot(token), make_handlers(storage, chat_executor), chat_executor.stop)
 
 
 def main(token: str) -> None:
     updater = Updater(token, use_context=True)
     dp = updater.dispatcher
 
-    storage: Union[Storage, LocalStorage] = Storage()
-    if "local" in sys.argv:
-        storage = LocalStorage()
-        print("Running with local storage")
-
     # mundane handlers
     dp.add_handler(CommandHandler("start", handlers.start))
     dp.add_handler(CommandHandler("help", handlers.help))
 
+    supervisor: Optional[Supervisor] = None
+    # errors in handlers go to the error handlers of the dispatcher, like
+    # when the dispatcher runs handlers itself
+    chat_executor = ChatExecutor.from_env(on_error = dp.dispatch_error)
+    if "processes" in sys.argv:
+        # this process only receives updates, and worker processes handle
+        # them, each one its own chats
+        if "async" in sys.argv:
+            sys.exit("async can't be used with processes")
+        supervisor = Supervisor.from_env(partial(setup_worker, token))
+        names = ["pinned", "button_pressed", "message_edited", "members_changed", "message"]
+        named = {name: supervisor.handler(name) for name in names}
+        supervisor.start()
+        print(f"Running with {supervisor.workers} worker processes")
+    else:
+        storage = make_storage()
+        configure_handlers()
+        named = make_handlers(storage, chat_executor)
+    if "async" in sys.argv:
+        # Handlers wait for redis in a loop of their own, and dispatcher
+        # threads only start them
+        async_storage = make_async_storage(storage)
+        loop = asyncio.new_event_loop()
+        Thread(target=loop.run_forever, daemon=True).start()
+        for name in ["pinned", "button_pressed", "message_edited", "message"]:
+            curried = getattr(async_handlers, name)
+            named[name] = async_handlers.in_loop(loop, curried(async_storage))
+        print("Running with async handlers")
+
     # catch messages pinned
     pin_filter = Filters.status_update.pinned_message
-    dp.add_handler(MessageHandler(pin_filter, handlers.pinned(storage)))
+    dp.add_handler(MessageHandler(pin_filter, named["pinned"]))
     # catch presses of "unpin" buttons
-    dp.add_handler(CallbackQueryHandler(handlers.button_pressed(storage)))
+    dp.add_handler(CallbackQueryHandler(named["button_pressed"]))
     # catch edited messages
     edit_filter = Filters.update.edited_message
-    edit_handler = MessageHandler(edit_filter, handlers.message_edited(storage))
+    edit_handler = MessageHandler(edit_filter, named["message_edited"])
     dp.add_handler(edit_handler)
+    # catch users joining and leaving
+    members_filter = ( Filters.status_update.new_chat_members
+                     | Filters.status_update.left_chat_member
+                     )
+    dp.add_handler(MessageHandler(members_filter, named["members_changed"]))
     # catch any user message
     msg_filter = ~Filters.status_update
-    dp.add_handler(MessageHandler(msg_filter, handlers.message(storage)))
+    dp.add_handler(MessageHandler(msg_filter, named["message"]))
 
     # Enable logging
     logging.basicConfig(
@@ -52,10 +167,37 @@ def main(token: str) -> None:
         )
     logger = logging.getLogger(__name__)
     dp.add_error_handler(handlers.error(logger))
+    # STATS_INTERVAL is seconds between reports, 0 to never report
+    stats_interval = float(os.environ.get("STATS_INTERVAL", 600))
+    if stats_interval > 0:
+        updater.job_queue.run_repeating(handlers.report_stats(logger), stats_interval)
+        report_chats = lambda context: logger.info(f"Chat executor: {chat_executor.stats()}")
+        updater.job_queue.run_repeating(report_chats, stats_interval)
+        if supervisor is not None:
+            report_workers = lambda context: logger.info(f"Workers: {supervisor.stats()}")
+            updater.job_queue.run_repeating(report_workers, stats_interval)
 
-
-    updater.start_polling()
-    updater.idle()
+    if "webhook" in sys.argv:
+        # telegram posts updates to our server, they go right to dispatcher
+        server = WebhookServer(WebhookConfig.from_env(), updater.bot, updater.update_queue)
+        updater.job_queue.start()
+        Thread(target=dp.start, name="dispatcher", daemon=True).start()
+        port = server.start()
+        if server.config.url != "":
+            server.set_webhook()
+        if stats_interval > 0:
+            report = lambda context: logger.info(f"Webhook: {server.stats()}")
+            updater.job_queue.run_repeating(report, stats_interval)
+        print(f"Receiving updates on port {port}")
+        # so that updater stops dispatcher and job queue on a signal
+        updater.running = True
+        updater.idle()
+        server.stop()
+    else:
+        updater.start_polling()
+        updater.idle()
+    if supervisor is not None:
+        supervisor.stop()
 
 
 if __name__ == '__main__':
@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 
 from typing import *
-from datetime import datetime
+from datetime import datetime, timezone
 from html import escape
 from message_kind import Kind
 from telegram import Message, MessageEntity # type: ignore
 import message_kind
+import calendar
 import json
+import struct
+import sys
 
 """
 Author: d86leader@mail.com, 2019
@@ -14,14 +17,28 @@ License: published under GNU GPL-3
 
 Desctiption: structure with essential message data
 and methods for generating it from tg message.
-Also this structure is json-serializable through special methods.
+Also this structure is serializable through special methods. It used to be
+serialized to json, and now it's a compact binary format, but json can still
+be read.
+Many pins are kept in memory, so they have no __dict__, links and icons
+are made when asked for, and names of senders are shared between pins.
 """
 
 
 MaxLength = 280
 
+# Binary format, all little-endian:
+# version: u8, kind: u8, m_id: i64, date: i64,
+# sender length: u16, sender: utf-8, preview length: u32, preview: utf-8
+# Link and icon are not stored: they are generated from chat id and kind.
+# Json dumps start with '{', which is never a version
+WireVersion = 1
+WireHeader = struct.Struct("<BBqqH")
+WirePreviewLength = struct.Struct("<I")
+
 # a wrapper class: the wrapped string is html-escaped
 class Escaped:
+    __slots__ = ["wrapped"]
     wrapped: str
     def __init__(self, s: str) -> None:
         self.wrapped = escape(s)
@@ -49,110 +66,120 @@ def gen_icon(kind: Kind) -> str:
         return "📍"
 
 def gen_preview(msg: Message) -> Escaped:
-    if msg.entities != [] and has_links_in(msg.entities):
-        return gather_links(msg.entities, msg.text)
+    return classify(msg)[1]
+
+# Kind and preview of message. Links in text are looked for only once
+def classify(msg: Message) -> Tuple[Kind, Escaped]:
+    text_links = msg.entities != [] and has_links_in(msg.entities)
+    if msg.photo and len(msg.photo) > 0:
+        kind = Kind.Photo
+    elif msg.document:
+        kind = Kind.File
+    elif msg.sticker:
+        kind = Kind.Sticker
+    elif text_links:
+        kind = Kind.Link
+    elif msg.text and len(msg.text) > 0:
+        kind = Kind.Text
+    else:
+        kind = Kind.Default
+
+    if text_links:
+        preview = gather_links(msg.entities, msg.text)
     elif msg.caption_entities != [] and has_links_in(msg.caption_entities):
-        return gather_links(msg.caption_entities, msg.caption)
+        preview = gather_links(msg.caption_entities, msg.caption)
     elif msg.text:
         if len(msg.text) > MaxLength:
-            return Escaped(msg.text[:MaxLength] + "...")
+            preview = Escaped(msg.text[:MaxLength] + "...")
         else:
-            return Escaped(msg.text)
+            preview = Escaped(msg.text)
     elif msg.caption:
         if len(msg.caption) > MaxLength:
-            return Escaped(msg.caption[:MaxLength] + "...")
+            preview = Escaped(msg.caption[:MaxLength] + "...")
         else:
-            return Escaped(msg.caption)
+            preview = Escaped(msg.caption)
     elif msg.document:
-        return gather_file(msg.document)
+        preview = gather_file(msg.document)
     elif msg.sticker:
-        return Escaped(msg.sticker.emoji)
+        preview = Escaped(msg.sticker.emoji)
     else:
-        return Escaped("")
+        preview = Escaped("")
+    return (kind, preview)
+
 
 def is_link(entity):
     return entity.type == "url" or entity.type == "text_link"
 def has_links_in(entities) -> bool:
     return any(map(is_link, entities))
-def link_text(entity, all_text: str) -> Escaped:
-    start: int = entity.offset
-    end: int = start + entity.length
-    return Escaped(all_text[start : end])
-def make_link(href: Escaped, body: Escaped) -> Escaped:
-    return Escaped.from_escaped(f'<a href="{href}">{body}</a>')
-
-class MessagePart(NamedTuple):
-    """Used to get links from messages and join all together"""
-    text_repr: Escaped
-    repr_length: int
-    start: int
 
+# Text with links made clickable, cut to MaxLength. Links that don't fit are
+# listed after the cut, one on a line.
+# The result is made of fragments joined once at the end, and its length
+# is counted on the way
 def gather_links(entities, text: str) -> Escaped:
-    # start and end of entity
-    ent_parts: List[MessagePart] = []
-    # assertion: no entities overlap
-
-    for ent in entities:
-        if ent.url:
-            # manual says this only works for "text_link", but i say if it has
-            # url, that must be a correct url
-            body = link_text(ent, text)
-            url = Escaped(ent.url)
-            part = MessagePart( text_repr = make_link(url, body)
-                              , repr_length = len(body.wrapped)
-                              , start = ent.offset
-                              )
-            ent_parts.append(part)
-        elif is_link(ent):
-            # it's a text_link or url, but doesn't have an own url. Extract one
-            # from text body
-            href = link_text(ent, text)
-            part = MessagePart( text_repr = make_link(href, href)
-                              , repr_length = len(href.wrapped)
-                              , start = ent.offset
-                              )
-            ent_parts.append(part)
-        else:
-            continue
-    ent_parts.sort(key = lambda x: x.start)
-
-    result = ""
+    # assertion: no entities overlap. Telegram sends them in order already,
+    # so sorting takes one pass
+    links = sorted( (ent for ent in entities if ent.url or is_link(ent))
+                  , key = lambda ent: ent.offset
+                  )
+    fragments: List[str] = []
+    length = 0
     cur_start = 0
     too_long = False
-    for ent in ent_parts:
-        if not too_long:
-            cur_text = text[cur_start : ent.start]
-            result += cur_text
-            if len(result) > MaxLength:
-                result = result[:MaxLength].strip() + "...\n"
-                too_long = True
-            result += ent.text_repr.wrapped
-            if len(result) > MaxLength:
-                # if became too long after adding link, we shouldn't cut
-                result = result.strip()
-                too_long = True
-            cur_start = ent.start + ent.repr_length
-        else:
-            result += "\n" + ent.text_repr.wrapped
-    if len(result) <= MaxLength:
+    for ent in links:
+        start = ent.offset
+        body = escape(text[start : start + ent.length])
+        # manual says url only works for "text_link", but i say if it has
+        # url, that must be a correct url. Otherwise it's in text body
+        href = escape(ent.url) if ent.url else body
+        link = f'<a href="{href}">{body}</a>'
+        if too_long:
+            # text between links is not shown anymore
+            fragments += ["\n", link]
+            length += 1 + len(link)
+            continue
+        cur_text = text[cur_start : start]
+        fragments.append(cur_text)
+        length += len(cur_text)
+        if length > MaxLength:
+            cut = "".join(fragments)[:MaxLength].strip() + "...\n"
+            fragments = [cut]
+            length = len(cut)
+            too_long = True
+        fragments.append(link)
+        length += len(link)
+        if length > MaxLength:
+            # if became too long after adding link, we shouldn't cut
+            whole = "".join(fragments).strip()
+            fragments = [whole]
+            length = len(whole)
+            too_long = True
+        # as it always was, skips length of escaped link body
+        cur_start = start + len(body)
+
+    if length <= MaxLength:
         # append last text
         cur_text = text[cur_start:]
-        result += Escaped(cur_text).wrapped
-        if len(result) + len(cur_text) > MaxLength:
-            result = result[:MaxLength].strip() + "..."
-
-    return Escaped.from_escaped(result)
+        if len(cur_text) > MaxLength:
+            # it's cut anyway, and escaping never makes text shorter
+            escaped = escape(cur_text[:MaxLength])
+        else:
+            escaped = escape(cur_text)
+        fragments.append(escaped)
+        if length + len(escaped) + len(cur_text) > MaxLength:
+            return Escaped.from_escaped("".join(fragments)[:MaxLength].strip() + "...")
+    return Escaped.from_escaped("".join(fragments))
 
 def gather_file(document) -> Escaped:
     name_str = f"<b>{document.file_name}</b>"
     return Escaped.from_escaped(name_str)
 
 class MessageInfo:
+    __slots__ = ["m_id", "kind", "chat_id", "sender", "preview", "date"]
     m_id:    int
     kind:    Kind
-    link:    str
+    chat_id: int
     sender:  Escaped
-    icon:    str
     preview: Escaped
     date:    datetime
 
@@ -161,54 +188,80 @@ class MessageInfo:
             return
 
         self.m_id = msg.message_id
-        self.kind = self.gen_kind(msg)
-        self.link = self.gen_link(msg)
-        self.icon = gen_icon(self.kind)
-        self.preview = gen_preview(msg)
+        self.kind, self.preview = classify(msg)
+        self.chat_id = msg.chat_id
         self.date = msg.date
 
         # generate sender info
         sender = msg.from_user.first_name
         if msg.from_user.last_name:
             sender += " " + msg.from_user.last_name
-        self.sender = Escaped(sender)
+        self.sender = Escaped.from_escaped(sys.intern(escape(sender)))
+
+    @property
+    def link(self) -> str:
+        return message_link(self.chat_id, self.m_id)
 
+    @property
+    def icon(self) -> str:
+        return gen_icon(self.kind)
 
     @staticmethod
     def gen_kind(msg) -> Kind:
-        if msg.photo and len(msg.photo) > 0:
-            return Kind.Photo
-        elif msg.document:
-            return Kind.File
-        elif msg.sticker:
-            return Kind.Sticker
-        elif has_links_in(msg.entities):
-            return Kind.Link
-        elif msg.text and len(msg.text) > 0:
-            return Kind.Text
-        else:
-            return Kind.Default
+        return classify(msg)[0]
 
     @staticmethod
     def gen_link(msg) -> str:
-        chat_id = msg.chat_id
-        # this api adapter uses strage int representation. Citation:
-        # botapi prefixes:
-        # + for pms
-        # - for small group chats
-        # -100 for channels and megagroups
-        # we need to make a positive out of this
-        if chat_id < 0:
-            chat_id = -chat_id
-            chat_s = str(chat_id)
-            if chat_s[0:3] == "100":
-                chat_s = chat_s[3:]
-                chat_id = int(chat_s)
-        return f"https://t.me/c/{chat_id}/{msg.message_id}"
-
-    # JSON methods
-
-    def dumps(self) -> str:
+        return message_link(msg.chat_id, msg.message_id)
+
+    # Binary methods
+
+    def dumps(self) -> bytes:
+        sender = self.sender.wrapped.encode("utf-8")
+        preview = self.preview.wrapped.encode("utf-8")
+        header = WireHeader.pack( WireVersion, int(self.kind), self.m_id
+                                , unix_time(self.date), len(sender)
+                                )
+        return b"".join([ header, sender
+                        , WirePreviewLength.pack(len(preview)), preview
+                        ])
+
+    # chat_id is needed for binary data, which doesn't store the link
+    @staticmethod
+    def loads(data: Union[str, bytes], chat_id: int) -> 'MessageInfo':
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        if data[:1] == b"{":
+            return MessageInfo.loads_json(data, chat_id)
+        if data[0] != WireVersion:
+            raise ValueError(f"Unknown MessageInfo version {data[0]}")
+
+        version, kind, m_id, date, sender_len = WireHeader.unpack_from(data)
+        offset = WireHeader.size
+        sender = data[offset : offset + sender_len].decode("utf-8")
+        offset += sender_len
+        preview_len, = WirePreviewLength.unpack_from(data, offset)
+        offset += WirePreviewLength.size
+        preview = data[offset : offset + preview_len].decode("utf-8")
+
+        self = MessageInfo(None)
+        self.m_id    = m_id
+        self.kind    = Kind(kind)
+        self.chat_id = chat_id
+        self.sender  = Escaped.from_escaped(sys.intern(sender))
+        self.preview = Escaped.from_escaped(preview)
+        self.date    = datetime.fromtimestamp(date, timezone.utc)
+        return self
+
+    @staticmethod
+    def is_json(data: Union[str, bytes]) -> bool:
+        if isinstance(data, str):
+            return data[:1] == "{"
+        return data[:1] == b"{"
+
+    # JSON methods, the old format
+
+    def dumps_json(self) -> str:
         self_dict = {
              'm_id'    : self.m_id
             ,'kind'    : int(self.kind)
@@ -216,22 +269,46 @@ class MessageInfo:
             ,'sender'  : self.sender.wrapped
             ,'icon'    : self.icon
             ,'preview' : self.preview.wrapped
-            ,'date'    : int(self.date.timestamp())
+            ,'date'    : unix_time(self.date)
             }
         return json.dumps(self_dict)
 
+    # Without chat id, it's taken from the stored link. Several chats have the
+    # same link, and any of them makes it again
     @staticmethod
-    def loads(text: Union[str, bytes]) -> 'MessageInfo':
+    def loads_json(text: Union[str, bytes], chat_id: Optional[int] = None) -> 'MessageInfo':
         dict = json.loads(text)
         self = MessageInfo(None)
 
         self.m_id = dict['m_id']
         self.kind    = Kind(dict['kind'])
-        self.link    = dict['link']
-        self.sender  = Escaped.from_escaped(dict['sender'])
-        self.icon    = dict['icon']
+        if chat_id is None:
+            chat_id = int(dict['link'].split("/")[-2])
+        self.chat_id = chat_id
+        self.sender  = Escaped.from_escaped(sys.intern(dict['sender']))
         self.preview = Escaped.from_escaped(dict['preview'])
-        self.date    = datetime.utcfromtimestamp(dict['date'])
+        self.date    = datetime.fromtimestamp(dict['date'], timezone.utc)
 
         return self
 
+
+def message_link(chat_id: int, m_id: int) -> str:
+    # this api adapter uses strage int representation. Citation:
+    # botapi prefixes:
+    # + for pms
+    # - for small group chats
+    # -100 for channels and megagroups
+    # we need to make a positive out of this
+    if chat_id < 0:
+        chat_id = -chat_id
+        chat_s = str(chat_id)
+        if chat_s[0:3] == "100":
+            chat_s = chat_s[3:]
+            chat_id = int(chat_s)
+    return f"https://t.me/c/{chat_id}/{m_id}"
+
+
+# Dates are loaded in UTC, like telegram gives them. Naive dates are in UTC
+# too, not in local time
+def unix_time(date: datetime) -> int:
+    return calendar.timegm(date.utctimetuple())
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Usage:
+python3 migrate.py [redis address]
+Rewrites data in redis storage to the current layout and formats. Can be run
+again if interrupted.
+Moving to the current layout must be done while the bot is stopped, because
+an older bot would keep writing the old layout. Rewriting pins to the current
+format can be done while the bot is running.
+"""
+
+import sys
+from typing import *
+from redis import Redis
+from remote_store import Storage
+
+
+# Before, chat data was kept under bare chat id keys in three databases
+OldPinsDb = 0
+OldEditablesDb = 1
+OldNoUserWroteDb = 2
+
+BatchSize = 1000
+
+
+# split an iterator into lists of at most size elements
+def batches(it: Iterable, size: int = BatchSize) -> Iterator[list]:
+    batch = []
+    for x in it:
+        batch.append(x)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch != []:
+        yield batch
+
+# chat id and key suffix of an old key, or None if it's not an old key
+def parse_old_key(key: bytes) -> Optional[Tuple[int, str]]:
+    chat, _, suffix = key.decode().partition(":")
+    try:
+        return (int(chat), suffix)
+    except ValueError:
+        return None
+
+
+# Returns the amount of moved keys
+def migrate_layout(addr: str, port: int = Storage.RedisPort) -> int:
+    pins_db = Redis(host=addr, port=port, db=OldPinsDb)
+    editables_db = Redis(host=addr, port=port, db=OldEditablesDb)
+    no_user_wrote_db = Redis(host=addr, port=port, db=OldNoUserWroteDb)
+    moved = 0
+
+    # pins and their index were in the same database, they are just renamed
+    for keys in batches(pins_db.scan_iter(count=BatchSize)):
+        pipe = pins_db.pipeline(transaction=False)
+        for key in keys:
+            parsed = parse_old_key(key)
+            if parsed is None:
+                continue
+            chat_id, suffix = parsed
+            new_key = f"chat:{chat_id}:{suffix or 'pins'}"
+            pipe.renamenx(key, new_key)
+        moved += sum(pipe.execute())
+
+    # other values become fields of chat hash
+    def move_to_field(old_db: Redis, field: str) -> int:
+        moved = 0
+        for keys in batches(old_db.scan_iter(count=BatchSize)):
+            keys = [key for key in keys if parse_old_key(key) is not None]
+            values = old_db.mget(keys)
+            pipe = pins_db.pipeline(transaction=False)
+            for key, value in zip(keys, values):
+                if value is not None:
+                    chat_id, _ = parse_old_key(key)
+                    pipe.hset(Storage._chat_key(chat_id), field, value)
+            pipe.execute()
+            if keys != []:
+                old_db.delete(*keys)
+            moved += len(keys)
+        return moved
+
+    moved += move_to_field(editables_db, Storage.MessageIdField)
+    moved += move_to_field(no_user_wrote_db, Storage.NoUserWroteField)
+    return moved
+
+
+# Returns the amount of checked chats and rewritten pins
+def migrate_pins(storage: Storage) -> Tuple[int, int]:
+    chats = 0
+    pins = 0
+    for chat_id in storage.pinned_chats():
+        pins += storage.migrate_pins(chat_id)
+        chats += 1
+        if chats % BatchSize == 0:
+            print(f"{chats} chats checked, {pins} pins rewritten")
+    return (chats, pins)
+
+
+def main(addr: str) -> None:
+    moved = migrate_layout(addr)
+    print(f"Moved {moved} keys to the current layout")
+
+    storage = Storage(addr=addr)
+    chats, pins = migrate_pins(storage)
+    print(f"Done: {chats} chats checked, {pins} pins rewritten")
+
+
+if __name__ == '__main__':
+    addr = sys.argv[1] if len(sys.argv) > 1 else Storage.RedisAddr
+    main(addr)
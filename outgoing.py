@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+
+from typing import *
+from concurrent.futures import Future, ThreadPoolExecutor
+from enum import IntEnum
+from collections import deque
+from threading import Condition, Lock, Thread
+from time import monotonic
+from telegram.error import RetryAfter # type: ignore
+import os
+import traceback
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: the queue of requests to telegram.
+Telegram limits how often a bot may send: about 30 requests a second overall
+and 20 messages a minute to a group. Requests wait in the queue until both
+limits allow them, more urgent ones first, and requests to one chat go one
+at a time, in order. When telegram answers to retry later anyway, nothing
+goes for the given time, and then the request goes again.
+The queue holds a limited amount of requests: when it's full, handlers wait
+for room, and give up after a while.
+Without limits requests are made right away, and nothing is queued.
+"""
+
+
+class Priority(IntEnum):
+    # the user waits for it, like answers to button presses
+    Interactive = 0
+    Normal = 1
+    # nobody will notice if it's late, like deleting old posts
+    Background = 2
+
+
+# requests that post to chats, and count for chat's limit
+ChatMethods = { "send_message", "edit_message_text", "edit_message_reply_markup"
+              , "pin_chat_message", "unpin_chat_message", "delete_message"
+              }
+MethodPriority = { "answer_callback_query" : Priority.Interactive
+                 , "get_chat"              : Priority.Interactive
+                 , "get_chat_member"       : Priority.Interactive
+                 , "delete_message"        : Priority.Background
+                 }
+# Requests whose answers handlers don't use. Handlers don't wait for them,
+# so a chat isn't locked while they wait in the queue
+NoWaitMethods = { "edit_message_text", "edit_message_reply_markup"
+                , "pin_chat_message", "unpin_chat_message", "delete_message"
+                , "answer_callback_query"
+                }
+
+
+class OutboxFull(Exception):
+    pass
+
+
+class TokenBucket:
+    """Allows rate requests a second on average, and up to burst at once"""
+    def __init__(self, rate: float, burst: float) -> None:
+        self._rate = rate
+        self._burst = burst
+        self._tokens = burst
+        self._updated = monotonic()
+        self._paused_until = 0.0
+
+    # seconds until a request can go, 0 if it can go now
+    def wait_time(self, now: float) -> float:
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+        self._updated = now
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self._rate
+
+    # call after wait_time returned 0
+    def take(self) -> None:
+        self._tokens -= 1
+
+    # nothing goes until then
+    def pause(self, until: float) -> None:
+        self._paused_until = max(self._paused_until, until)
+        self._tokens = 0
+        self._updated = self._paused_until
+
+
+class Request:
+    def __init__(self, seq: int, chat_id: int, priority: Priority
+                ,limited: bool, call: Callable[[], Any]
+                ) -> None:
+        self.seq = seq
+        self.chat_id = chat_id
+        self.priority = priority
+        # whether it counts for chat's limit
+        self.limited = limited
+        self.call = call
+        self.future: Future = Future()
+        self.attempts = 0
+        self.enqueued = monotonic()
+        self.not_before = 0.0
+
+
+class Limits(NamedTuple):
+    # requests a second for the whole bot
+    global_rate: float = 30.0
+    global_burst: float = 30.0
+    # messages a second for one chat
+    chat_rate: float = 20 / 60
+    chat_burst: float = 5.0
+    # most requests waiting at once
+    queue_size: int = 1000
+    # seconds to wait for room in the queue
+    put_timeout: float = 10.0
+    # how many times to repeat a request after being told to retry later
+    retries: int = 3
+    # threads making requests
+    workers: int = 8
+
+    # Each field can be set with an environment variable, OUTBOX_ followed
+    # by the field name in uppercase, like OUTBOX_GLOBAL_RATE=20
+    @staticmethod
+    def from_env(env: Mapping[str, str] = os.environ) -> 'Limits':
+        values: Dict[str, Any] = {}
+        for field, kind in Limits.__annotations__.items():
+            name = "OUTBOX_" + field.upper()
+            if name in env:
+                values[field] = kind(env[name])
+        return Limits(**values)
+
+
+class Outbox:
+    limits: Optional[Limits]
+    # waiting requests of each priority, in order
+    _queues: Dict[Priority, Deque[Request]]
+    _global: Optional[TokenBucket]
+    _chats: Dict[int, TokenBucket]
+    # chats with a limited request being made
+    _busy: Set[int]
+    # requests being made
+    _running: int
+    _lock: Lock
+    _changed: Condition
+    _seq: int
+    _dispatcher: Optional[Thread]
+    _pool: Optional[ThreadPoolExecutor]
+
+    submitted: int
+    sent: int
+    retried: int
+    failed: int
+    rejected: int
+    max_depth: int
+    total_wait: float
+
+    # Without limits, requests are made right away
+    def __init__(self, limits: Optional[Limits] = None) -> None:
+        self.limits = limits
+        self._queues = {priority: deque() for priority in Priority}
+        self._global = None
+        if limits is not None:
+            self._global = TokenBucket(limits.global_rate, limits.global_burst)
+        self._chats = {}
+        self._busy = set()
+        self._running = 0
+        self._lock = Lock()
+        self._changed = Condition(self._lock)
+        self._seq = 0
+        self._dispatcher = None
+        self._pool = None
+        self.submitted = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_depth = 0
+        self.total_wait = 0.0
+
+    @staticmethod
+    def from_env(env: Mapping[str, str] = os.environ) -> 'Outbox':
+        return Outbox(Limits.from_env(env))
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return { "depth"        : self._depth()
+                   , "max_depth"    : self.max_depth
+                   , "submitted"    : self.submitted
+                   , "sent"         : self.sent
+                   , "retried"      : self.retried
+                   , "failed"       : self.failed
+                   , "rejected"     : self.rejected
+                   , "average_wait" : self.total_wait / max(self.sent, 1)
+                   }
+
+    # bot that makes its requests through the queue
+    def bot(self, bot) -> 'QueuedBot':
+        return QueuedBot(bot, self)
+
+    # Make request to chat when limits allow, and return its result
+    # Keyword arguments are passed to func, so chat is not named chat_id
+    def call(self, chat: int, func: Callable, *args
+            ,priority: Priority = Priority.Normal
+            ,limited: bool = True
+            ,**kwargs
+            ) -> Any:
+        return self.submit(chat, func, *args, priority=priority
+                          ,limited=limited, **kwargs).result()
+
+    # Wait until every submitted request is made. Returns False on timeout
+    def join(self, timeout: Optional[float] = None) -> bool:
+        with self._lock:
+            return self._changed.wait_for(
+                lambda: self._depth() == 0 and self._running == 0, timeout)
+
+    def submit(self, chat: int, func: Callable, *args
+              ,priority: Priority = Priority.Normal
+              ,limited: bool = True
+              ,**kwargs
+              ) -> Future:
+        if self.limits is None:
+            future: Future = Future()
+            try:
+                future.set_result(func(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        with self._lock:
+            deadline = monotonic() + self.limits.put_timeout
+            while self._depth() >= self.limits.queue_size:
+                left = deadline - monotonic()
+                if left <= 0:
+                    self.rejected += 1
+                    raise OutboxFull(f"{self._depth()} requests already waiting")
+                self._changed.wait(left)
+            self._seq += 1
+            request = Request( self._seq, chat, priority, limited
+                             , lambda: func(*args, **kwargs)
+                             )
+            self._queues[priority].append(request)
+            self.submitted += 1
+            self.max_depth = max(self.max_depth, self._depth())
+            self._start()
+            self._changed.notify_all()
+        return request.future
+
+    # must hold the lock for these
+
+    def _depth(self) -> int:
+        return sum(map(len, self._queues.values()))
+
+    def _start(self) -> None:
+        if self._dispatcher is None:
+            self._pool = ThreadPoolExecutor(self.limits.workers)
+            self._dispatcher = Thread(target=self._dispatch, daemon=True)
+            self._dispatcher.start()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        if chat_id not in self._chats:
+            self._chats[chat_id] = TokenBucket( self.limits.chat_rate
+                                              , self.limits.chat_burst
+                                              )
+        return self._chats[chat_id]
+
+    # Next request that limits allow, and None with seconds to wait if there
+    # is none
+    def _next(self, now: float) -> Tuple[Optional[Request], Optional[float]]:
+        global_wait = self._global.wait_time(now)
+        if global_wait > 0:
+            return (None, global_wait)
+        wait: Optional[float] = None
+        # chats whose requests can't go now, so later ones can't either
+        blocked: Set[int] = set(self._busy)
+        for priority in Priority:
+            queue = self._queues[priority]
+            for request in queue:
+                if request.limited and request.chat_id in blocked:
+                    continue
+                request_wait = request.not_before - now
+                if request.limited:
+                    bucket = self._chat_bucket(request.chat_id)
+                    request_wait = max(request_wait, bucket.wait_time(now))
+                if request_wait <= 0:
+                    queue.remove(request)
+                    self._global.take()
+                    if request.limited:
+                        bucket.take()
+                        self._busy.add(request.chat_id)
+                    self._running += 1
+                    return (request, None)
+                if request.limited:
+                    blocked.add(request.chat_id)
+                wait = request_wait if wait is None else min(wait, request_wait)
+        return (None, wait)
+
+    def _dispatch(self) -> None:
+        while True:
+            with self._lock:
+                while True:
+                    request, wait = self._next(monotonic())
+                    if request is not None:
+                        break
+                    self._changed.wait(wait)
+                self._changed.notify_all()
+            self._pool.submit(self._run, request)
+
+    def _run(self, request: Request) -> None:
+        try:
+            result = request.call()
+        except RetryAfter as e:
+            with self._lock:
+                request.attempts += 1
+                if request.attempts <= self.limits.retries:
+                    # goes again first, when telegram allows. Flood limits
+                    # of telegram are not only per chat, so nothing else
+                    # goes until then either
+                    self.retried += 1
+                    request.not_before = monotonic() + e.retry_after
+                    self._global.pause(request.not_before)
+                    if request.limited:
+                        self._chat_bucket(request.chat_id).pause(request.not_before)
+                    self._queues[request.priority].appendleft(request)
+                    self._finished(request)
+                    return
+                self.failed += 1
+            request.future.set_exception(e)
+        except Exception as e:
+            with self._lock:
+                self.failed += 1
+            request.future.set_exception(e)
+        else:
+            with self._lock:
+                self.sent += 1
+                self.total_wait += monotonic() - request.enqueued
+            request.future.set_result(result)
+        # after callbacks of the future, so that join waits for them
+        with self._lock:
+            self._finished(request)
+
+    # must hold the lock
+    def _finished(self, request: Request) -> None:
+        self._running -= 1
+        if request.limited:
+            self._busy.discard(request.chat_id)
+        self._changed.notify_all()
+
+
+# done callback for requests nobody waits for
+def report_failure(future: Future) -> None:
+    error = future.exception()
+    if error is not None:
+        traceback.print_exception(type(error), error, error.__traceback__)
+
+# Call action if a request made without waiting fails
+def on_failure(sent: Any, action: Callable[[], None]) -> None:
+    if isinstance(sent, Future):
+        def check(future: Future) -> None:
+            if future.exception() is not None:
+                action()
+        sent.add_done_callback(check)
+
+
+class QueuedBot:
+    """Bot with the same methods, making requests through outbox. Chat id is
+    the first argument or chat_id keyword argument. Methods in NoWaitMethods
+    return a Future at once, and their failures are only printed"""
+    def __init__(self, bot, outbox: Outbox) -> None:
+        self._bot = bot
+        self._outbox = outbox
+
+    def __getattr__(self, name: str) -> Callable:
+        method = getattr(self._bot, name)
+        priority = MethodPriority.get(name, Priority.Normal)
+        limited = name in ChatMethods
+        def queued(*args, **kwargs):
+            chat_id = kwargs["chat_id"] if "chat_id" in kwargs else args[0]
+            if name not in NoWaitMethods:
+                return self._outbox.call( chat_id, method, *args
+                                        , priority=priority, limited=limited
+                                        , **kwargs)
+            future = self._outbox.submit( chat_id, method, *args
+                                        , priority=priority, limited=limited
+                                        , **kwargs)
+            future.add_done_callback(report_failure)
+            return future
+        return queued
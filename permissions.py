@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+from typing import *
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+import os
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: remembering what telegram said about chats and their members.
+Checking whether a user may press buttons takes two requests to telegram.
+Their answers are kept for a while, so repeated presses don't ask again.
+Telegram doesn't tell bots when permissions change, so answers are only
+forgotten when they get old, or when a user joins or leaves the chat.
+"""
+
+
+K = TypeVar('K')
+V = TypeVar('V')
+
+class TtlCache(Generic[K, V]):
+    """Values that are loaded again when older than ttl seconds. Least
+    recently used are dropped when there are more than size"""
+    _values: 'OrderedDict[K, Tuple[float, V]]'
+    _lock: Lock
+
+    hits: int
+    misses: int
+
+    def __init__(self, ttl: float, size: int) -> None:
+        self._ttl = ttl
+        self._size = size
+        self._values = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return { "size"   : len(self._values)
+                   , "hits"   : self.hits
+                   , "misses" : self.misses
+                   }
+
+    # Value of key, calling load if it's missing or old. Exceptions from
+    # load are not remembered
+    def get(self, key: K, load: Callable[[], V]) -> V:
+        now = monotonic()
+        with self._lock:
+            if key in self._values:
+                loaded, value = self._values[key]
+                if now - loaded < self._ttl:
+                    self.hits += 1
+                    self._values.move_to_end(key)
+                    return value
+                del self._values[key]
+            self.misses += 1
+        value = load()
+        with self._lock:
+            self._values[key] = (now, value)
+            self._values.move_to_end(key)
+            if len(self._values) > self._size:
+                self._values.popitem(last=False)
+        return value
+
+    def invalidate(self, key: K) -> None:
+        with self._lock:
+            self._values.pop(key, None)
+
+
+class Permissions:
+    # seconds to remember answers
+    Ttl = 300.0
+    # how many chats and members to remember
+    Size = 10000
+
+    # chat id to its chat
+    chats: TtlCache[int, Any]
+    # chat id and user id to their chat member
+    members: TtlCache[Tuple[int, int], Any]
+
+    def __init__(self, ttl: float = Ttl, size: int = Size) -> None:
+        self.chats = TtlCache(ttl, size)
+        self.members = TtlCache(ttl, size)
+
+    # PERMISSION_TTL sets seconds to remember answers, 0 to always ask
+    @staticmethod
+    def from_env(env: Mapping[str, str] = os.environ) -> 'Permissions':
+        return Permissions(float(env.get("PERMISSION_TTL", Permissions.Ttl)))
+
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        return {"chats" : self.chats.stats(), "members" : self.members.stats()}
+
+    def get_chat(self, bot, chat_id: int) -> Any:
+        return self.chats.get(chat_id, lambda: bot.get_chat(chat_id))
+
+    def get_chat_member(self, bot, chat_id: int, user_id: int) -> Any:
+        return self.members.get( (chat_id, user_id)
+                               , lambda: bot.get_chat_member(chat_id, user_id)
+                               )
+
+    # user joined or left chat, or got other permissions
+    def member_changed(self, chat_id: int, user_id: int) -> None:
+        self.members.invalidate((chat_id, user_id))
+
+    def chat_changed(self, chat_id: int) -> None:
+        self.chats.invalidate(chat_id)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Usage:
+REDIS_SHARDS=addr:port,... python3 rebalance.py [addr:port]...
+Moves every chat to the shard that owns it, after shards were added to
+REDIS_SHARDS. Shards given as arguments are being removed: all their
+chats are moved to shards in REDIS_SHARDS.
+Must be done while the bot is stopped, because the bot would look for moving
+chats on their new shards before they are there. Can be run again if
+interrupted.
+"""
+
+import os
+import sys
+from typing import *
+from sharded_store import Storage as ShardedStorage
+
+ProgressEvery = 1000
+
+
+# Replace whatever target has for chat with what source has, and remove it
+# from source
+def move_chat(source, target, chat_id: int) -> None:
+    state = source.load(chat_id)
+    target.drop_chat(chat_id)
+    moved = target.load(chat_id)
+    for msg in reversed(state.pins):
+        moved.add(msg)
+    # the flag is only kept with message id, that's all handlers look at
+    if state.message_id is not None:
+        moved.set_message_id(state.message_id)
+        if state.user_wrote:
+            moved.user_message_added()
+    target.commit(moved)
+    source.drop_chat(chat_id)
+
+
+# Returns the amount of moved chats
+def rebalance(storage: ShardedStorage
+             ,removed: Dict[str, Any] = {}
+             ) -> int:
+    moved = 0
+    sources = list(storage.shards.items()) + list(removed.items())
+    for name, shard in sources:
+        # chats are listed before moving, so that a shard doesn't see the
+        # chats it takes in
+        for chat_id in list(shard.chats()):
+            if name in storage.shards and storage.shard_name(chat_id) == name:
+                continue
+            move_chat(shard, storage.shard(chat_id), chat_id)
+            moved += 1
+            if moved % ProgressEvery == 0:
+                print(f"{moved} chats moved")
+    return moved
+
+
+def main(removed_nodes: List[str]) -> None:
+    storage = ShardedStorage.from_env()
+    removed = {}
+    if removed_nodes != []:
+        # connected the same way as the others
+        env = dict(os.environ, REDIS_SHARDS=",".join(removed_nodes))
+        removed = ShardedStorage.from_env(env).shards
+    moved = rebalance(storage, removed)
+    print(f"Done: {moved} chats moved")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
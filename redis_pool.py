@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+
+from typing import *
+from random import uniform
+from threading import Lock
+from time import monotonic, sleep
+from redis.connection import BlockingConnectionPool, Connection
+from redis.exceptions import ConnectionError, TimeoutError
+from storage_error import StorageError
+import os
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: connection pool for remote storage and the means to use it
+without getting stuck. Redis calls have timeouts, waiting for a free
+connection has a timeout, connections unused for a while are checked before
+use, and failed calls are retried with backoff before giving up with
+StorageError.
+"""
+
+
+class PoolConfig(NamedTuple):
+    # most connections open at once
+    size: int = 16
+    # seconds to wait for a free connection
+    wait_timeout: float = 2.0
+    # seconds to wait for redis to answer
+    socket_timeout: float = 5.0
+    socket_connect_timeout: float = 2.0
+    # connections unused for this many seconds are pinged before use
+    health_check_interval: float = 30.0
+    # how many times to repeat a failed call, and the delays between them.
+    # Delays grow twice each time up to backoff_max, and are randomized
+    retries: int = 2
+    backoff_base: float = 0.05
+    backoff_max: float = 1.0
+
+    # Each field can be set with an environment variable, REDIS_POOL_
+    # followed by the field name in uppercase, like REDIS_POOL_SIZE=32
+    @staticmethod
+    def from_env(env: Mapping[str, str] = os.environ) -> 'PoolConfig':
+        values: Dict[str, Any] = {}
+        for field, kind in PoolConfig.__annotations__.items():
+            name = "REDIS_POOL_" + field.upper()
+            if name in env:
+                values[field] = kind(env[name])
+        return PoolConfig(**values)
+
+
+class Pool(BlockingConnectionPool):
+    """Blocking pool that checks connections unused for a while, and keeps
+    statistics of how it's used"""
+
+    def __init__(self, config: PoolConfig, **connection_kwargs) -> None:
+        self._config = config
+        self._stats_lock = Lock()
+        # when each connection was last released
+        self._released_at: Dict[Connection, float] = {}
+        self._in_use: Set[Connection] = set()
+        self.checkouts = 0
+        self.max_in_use = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.timeouts = 0
+        self.failed_health_checks = 0
+        super().__init__( max_connections = config.size
+                        , timeout = config.wait_timeout
+                        , socket_timeout = config.socket_timeout
+                        , socket_connect_timeout = config.socket_connect_timeout
+                        , **connection_kwargs
+                        )
+
+    def get_connection(self, command_name, *keys, **options):
+        start = monotonic()
+        try:
+            connection = super().get_connection(command_name, *keys, **options)
+        except ConnectionError:
+            with self._stats_lock:
+                if monotonic() - start >= self._config.wait_timeout:
+                    self.timeouts += 1
+            raise
+        waited = monotonic() - start
+
+        with self._stats_lock:
+            self.checkouts += 1
+            self._in_use.add(connection)
+            self.max_in_use = max(self.max_in_use, len(self._in_use))
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+            released_at = self._released_at.get(connection, start)
+        if start - released_at >= self._config.health_check_interval:
+            self._check_health(connection)
+        return connection
+
+    def release(self, connection) -> None:
+        with self._stats_lock:
+            self._in_use.discard(connection)
+            self._released_at[connection] = monotonic()
+        super().release(connection)
+
+    def disconnect(self) -> None:
+        with self._stats_lock:
+            self._released_at.clear()
+        super().disconnect()
+
+    # A connection idle for long may have been dropped without us knowing.
+    # Ping it, and reconnect if it doesn't answer
+    def _check_health(self, connection) -> None:
+        try:
+            connection.send_command("PING")
+            if connection.read_response() != b"PONG":
+                raise ConnectionError("Bad answer to health check")
+        except (ConnectionError, TimeoutError):
+            with self._stats_lock:
+                self.failed_health_checks += 1
+            connection.disconnect()
+            try:
+                connection.connect()
+            except:
+                self.release(connection)
+                raise
+
+    def stats(self) -> Dict[str, float]:
+        with self._stats_lock:
+            checkouts = self.checkouts
+            return { "size"                 : self._config.size
+                   , "in_use"               : len(self._in_use)
+                   , "max_in_use"           : self.max_in_use
+                   , "checkouts"            : checkouts
+                   , "average_wait"         : self.total_wait / max(checkouts, 1)
+                   , "max_wait"             : self.max_wait
+                   , "timeouts"             : self.timeouts
+                   , "failed_health_checks" : self.failed_health_checks
+                   }
+
+
+T = TypeVar('T')
+
+# Call action, retrying it if redis can't be reached. Only actions that can
+# be safely repeated should be retried: if the connection breaks while
+# waiting for an answer, the action may already be done on the server
+def call_with_retries(config: PoolConfig, action: Callable[[], T]
+                     ,retry: bool = True
+                     ) -> T:
+    attempts = config.retries + 1 if retry else 1
+    for attempt in range(attempts):
+        try:
+            return action()
+        except (ConnectionError, TimeoutError) as e:
+            if attempt == attempts - 1:
+                raise StorageError(f"Redis unavailable: {e}") from e
+            delay = min(config.backoff_max, config.backoff_base * 2 ** attempt)
+            sleep(uniform(0, delay))
+    # unreachable, attempts is never 0
+    raise StorageError("Redis unavailable")
@@ -2,8 +2,11 @@
 
 from typing import *
 from redis import Redis
+from redis.exceptions import NoScriptError
 from message_info import MessageInfo
-import json
+from chat_state import ChatState, PinOp
+from redis_pool import Pool, PoolConfig, call_with_retries
+import os
 
 """
 Author: d86leader@mail.com, 2019
@@ -11,105 +14,528 @@ License: published under GNU GPL-3
 
 Description: proxy types to the means of storage.
 This presents the same interface as local_store, but uses the remote redis
-server for storing data
+server for storing data.
+Storage methods raise StorageError when redis can't be reached. Methods that
+can be safely repeated are retried before that
+"""
+
+
+# decorator: run storage method with retries if the connection fails
+def redis_call(retry: bool):
+    def decorator(method):
+        def wrapped(self, *args, **kwargs):
+            return call_with_retries( self._pool_config
+                                    , lambda: method(self, *args, **kwargs)
+                                    , retry
+                                    )
+        return wrapped
+    return decorator
+
+
+# Lua scripts for operations on pins. They run on the server atomically, so
+# nothing is downloaded and no other client can change the pins in between.
+#
+# Besides the list of pins, each chat has an index of where each message id
+# is. Every pin gets a sequence number, newer pins get bigger numbers, and the
+# index consists of:
+# - order: sorted set of "seq:m_id" members scored with seq. Rank of a member
+#   from the top is the position of the pin in the list
+# - ids: hash from m_id to space-separated members of order with this m_id
+# So the position of a message is found with HGET and ZREVRANK, without
+# looking at the list.
+#
+# All scripts take the same keys:
+# KEYS[1] - list of pins, KEYS[2] - order, KEYS[3] - ids
+
+IndexLib = """
+local list, order, ids = KEYS[1], KEYS[2], KEYS[3]
+
+local function members_of(m_id)
+    local members = {}
+    local joined = redis.call("HGET", ids, m_id)
+    if joined then
+        for member in string.gmatch(joined, "%S+") do
+            table.insert(members, member)
+        end
+    end
+    return members
+end
+
+local function index_add(seq, m_id)
+    local member = seq .. ":" .. m_id
+    redis.call("ZADD", order, seq, member)
+    local joined = redis.call("HGET", ids, m_id)
+    if joined then
+        joined = joined .. " " .. member
+    else
+        joined = member
+    end
+    redis.call("HSET", ids, m_id, joined)
+end
+
+local function index_remove(member, m_id)
+    redis.call("ZREM", order, member)
+    local rest = {}
+    for _, other in ipairs(members_of(m_id)) do
+        if other ~= member then
+            table.insert(rest, other)
+        end
+    end
+    if #rest == 0 then
+        redis.call("HDEL", ids, m_id)
+    else
+        redis.call("HSET", ids, m_id, table.concat(rest, " "))
+    end
+end
+
+-- m_id of a dumped MessageInfo, in either of its formats
+local function dump_m_id(dump)
+    local m_id
+    if string.sub(dump, 1, 1) == "{" then
+        m_id = cjson.decode(dump)["m_id"]
+    else
+        local version, kind
+        version, kind, m_id = struct.unpack("<BBi8", dump)
+    end
+    return string.format("%d", m_id)
+end
+
+-- pins stored before the index existed are indexed on first use
+local function ensure_index()
+    if redis.call("EXISTS", order) == 1 then
+        return
+    end
+    local dumps = redis.call("LRANGE", list, 0, -1)
+    for i, dump in ipairs(dumps) do
+        index_add(#dumps - i, dump_m_id(dump))
+    end
+end
+"""
+
+# Pin operations, each is a function taking the arguments of its script
+PinOpsLib = IndexLib + """
+local function add(value, m_id)
+    local top = redis.call("ZREVRANGE", order, 0, 0, "WITHSCORES")
+    local seq = 0
+    if #top > 0 then
+        seq = tonumber(top[2]) + 1
+    end
+    redis.call("LPUSH", list, value)
+    index_add(seq, m_id)
+end
+
+local function remove(m_id, hint, deleted)
+    hint = tonumber(hint)
+    local to_delete = nil
+    local best_distance = nil
+    local best_member = nil
+    for _, member in ipairs(members_of(m_id)) do
+        local index = redis.call("ZREVRANK", order, member)
+        local distance = math.abs(index - hint)
+        if to_delete == nil or distance < best_distance
+           or (distance == best_distance and index < to_delete) then
+            to_delete = index
+            best_distance = distance
+            best_member = member
+        end
+    end
+    if to_delete == nil then
+        return 0
+    end
+    redis.call("LSET", list, to_delete, deleted)
+    redis.call("LREM", list, 0, deleted)
+    index_remove(best_member, m_id)
+    return 1
+end
+
+local function replace_same_id(m_id, value)
+    local members = members_of(m_id)
+    for _, member in ipairs(members) do
+        local index = redis.call("ZREVRANK", order, member)
+        redis.call("LSET", list, index, value)
+    end
+    return #members
+end
+
+local function clear_keep_last()
+    redis.call("LTRIM", list, 0, 0)
+    redis.call("ZREMRANGEBYRANK", order, 0, -2)
+    redis.call("DEL", ids)
+    local last = redis.call("ZRANGE", order, 0, 0)
+    if #last > 0 then
+        local m_id = string.match(last[1], ":(.*)")
+        redis.call("HSET", ids, m_id, last[1])
+    end
+end
+
+local function clear()
+    redis.call("DEL", list, order, ids)
+end
+"""
+
+# ARGV[1] - new value, ARGV[2] - its m_id
+AddScript = PinOpsLib + """
+ensure_index()
+add(ARGV[1], ARGV[2])
+"""
+
+# ARGV[1] - m_id to remove, ARGV[2] - hint, ARGV[3] - special deleted value
+# Removes the pin with m_id closest to hint, returns 1 if removed
+RemoveScript = PinOpsLib + """
+ensure_index()
+return remove(ARGV[1], ARGV[2], ARGV[3])
+"""
+
+# ARGV[1] - m_id of edited message, ARGV[2] - new value
+# Returns the amount of replaced pins
+ReplaceScript = PinOpsLib + """
+ensure_index()
+return replace_same_id(ARGV[1], ARGV[2])
+"""
+
+# ARGV[1] - m_id. Returns 1 if a pin has this m_id
+# Only reads: pins stored before the index existed are looked through, and
+# get the index with the next write
+IsPinnedScript = IndexLib + """
+if redis.call("EXISTS", order) == 1 then
+    return redis.call("HEXISTS", ids, ARGV[1])
+end
+for _, dump in ipairs(redis.call("LRANGE", list, 0, -1)) do
+    if dump_m_id(dump) == ARGV[1] then
+        return 1
+    end
+end
+return 0
+"""
+
+# Deletes everything but the latest pin
+KeepLastScript = PinOpsLib + """
+ensure_index()
+clear_keep_last()
+"""
+
+# Writes the whole chat state at once: a MULTI isn't undone when one of its
+# scripts is unknown to the server, and this either runs whole or not at all
+# KEYS[4] - hash of the chat
+# ARGV - operations one after another, each is its name and then arguments:
+# pin operations with the arguments of their scripts, "clear", and
+# "hset" field value and "hdel" field for the chat hash
+CommitScript = PinOpsLib + """
+local chat = KEYS[4]
+local function hset(field, value)
+    redis.call("HSET", chat, field, value)
+end
+local function hdel(field)
+    redis.call("HDEL", chat, field)
+end
+local ops = { add = {add, 2}, remove = {remove, 3}
+            , replace_same_id = {replace_same_id, 2}
+            , clear_keep_last = {clear_keep_last, 0}, clear = {clear, 0}
+            , hset = {hset, 2}, hdel = {hdel, 1}
+            }
+
+ensure_index()
+local i = 1
+while i <= #ARGV do
+    local op = ops[ARGV[i]]
+    if op == nil then
+        return redis.error_reply("unknown operation " .. ARGV[i])
+    end
+    local run, arity = op[1], op[2]
+    run(unpack(ARGV, i + 1, i + arity))
+    i = i + 1 + arity
+end
+"""
+
+# Not for pins operations: rewrites values in place
+# KEYS[1] - list of pins
+# ARGV - pairs of old and new values
+# Returns the amount of rewritten pins
+RewriteScript = """
+local new_values = {}
+for i = 1, #ARGV, 2 do
+    new_values[ARGV[i]] = ARGV[i + 1]
+end
+local dumps = redis.call("LRANGE", KEYS[1], 0, -1)
+local rewritten = 0
+for i, dump in ipairs(dumps) do
+    local new_value = new_values[dump]
+    if new_value then
+        redis.call("LSET", KEYS[1], i - 1, new_value)
+        rewritten = rewritten + 1
+    end
+end
+return rewritten
 """
 
 class Storage:
+    """All data of a chat is kept under keys starting with "chat:{chat_id}":
+    - chat:{chat_id} - hash with the id of the bot's message and the flag
+      that nobody wrote after it
+    - chat:{chat_id}:pins - list of pins, latest first
+    - chat:{chat_id}:order and chat:{chat_id}:ids - index of pins
+    Everything is in one database, so a chat can be read or changed in a
+    single transaction"""
     RedisAddr = "redis"
     RedisPort = 6379
+    RedisDb = 0
+    # fields of the chat hash
+    MessageIdField = "message_id"
+    # exists if nobody wrote something to chat after bot's pin
+    NoUserWroteField = "no_user_wrote"
+    # value that is set to list element before deleting it
+    Deleted = "$$DELETED"
 
-    def __init__(self, addr=RedisAddr, port=RedisPort) -> None:
+    def __init__(self, addr=RedisAddr, port=RedisPort, db=RedisDb
+                ,pool_config: PoolConfig = PoolConfig()
+                ) -> None:
+        self._pool_config = pool_config
+        self._pool = Pool(pool_config, host=addr, port=port, db=db)
         # manual said it's thread-safe to do this
-        self._pins_db = Redis(host=addr, port=port, db=0)
-        self._editables_db = Redis(host=addr, port=port, db=1)
-        self._no_user_wrote = Redis(host=addr, port=port, db=2)
+        self._redis = Redis(connection_pool=self._pool)
+        # scripts are loaded on first use, or with load_scripts
+        register = self._redis.register_script
+        self._add_script = register(AddScript)
+        self._remove_script = register(RemoveScript)
+        self._replace_script = register(ReplaceScript)
+        self._keep_last_script = register(KeepLastScript)
+        self._is_pinned_script = register(IsPinnedScript)
+        self._rewrite_script = register(RewriteScript)
+        self._commit_script = register(CommitScript)
+
+    # Address is set with REDIS_ADDR, REDIS_PORT and REDIS_DB environment
+    # variables, and the pool as in PoolConfig.from_env
+    @staticmethod
+    def from_env(env: Mapping[str, str] = os.environ) -> 'Storage':
+        return Storage( addr = env.get("REDIS_ADDR", Storage.RedisAddr)
+                      , port = int(env.get("REDIS_PORT", Storage.RedisPort))
+                      , db = int(env.get("REDIS_DB", Storage.RedisDb))
+                      , pool_config = PoolConfig.from_env(env)
+                      )
+
+    def pool_stats(self) -> Dict[str, float]:
+        return self._pool.stats()
+
+    @staticmethod
+    def _chat_key(chat_id: int) -> str:
+        return f"chat:{chat_id}"
+    # keys of a chat's pins and their index
+    @staticmethod
+    def _pin_keys(chat_id: int) -> List[str]:
+        key = f"chat:{chat_id}"
+        return [key + ":pins", key + ":order", key + ":ids"]
+    @staticmethod
+    def _pins_key(chat_id: int) -> str:
+        return f"chat:{chat_id}:pins"
 
 
+    @redis_call(retry=True)
     def has(self, chat_id: int) -> bool:
-        redis = self._pins_db
-        key = str(chat_id)
+        redis = self._redis
+        key = self._pins_key(chat_id)
         return redis.llen(key) != 0
 
+    @redis_call(retry=True)
     def get(self, chat_id: int) -> List[MessageInfo]:
-        redis = self._pins_db
-        key = str(chat_id)
+        redis = self._redis
+        key = self._pins_key(chat_id)
         dumps = redis.lrange(key, 0, -1)
-        return list(map(MessageInfo.loads, dumps))
+        return [MessageInfo.loads(dump, chat_id) for dump in dumps]
 
+    # Whether message m_id is among chat's pins. Only looks at the index
+    @redis_call(retry=True)
+    def is_pinned(self, chat_id: int, m_id: int) -> bool:
+        return self._call_script(PinOp("is_pinned", (m_id,), []), chat_id) == 1
+
+    @redis_call(retry=False)
     def add(self, chat_id: int, msg: MessageInfo) -> None:
-        redis = self._pins_db
-        key = str(chat_id)
-        value = msg.dumps()
-        redis.lpush(key, value)
+        self._call_script(PinOp("add", (msg,), [0]), chat_id)
 
+    @redis_call(retry=True)
     def clear(self, chat_id: int) -> None:
-        redis = self._pins_db
-        key = str(chat_id)
-        redis.delete(key)
+        redis = self._redis
+        redis.delete(*self._pin_keys(chat_id))
 
+    @redis_call(retry=True)
     def clear_keep_last(self, chat_id: int) -> None:
-        redis = self._pins_db
-        key = str(chat_id)
-        redis.ltrim(key, 0, 0)
+        self._call_script(PinOp("clear_keep_last", (), [0]), chat_id)
 
+    @redis_call(retry=False)
     def remove(self, chat_id: int, m_id: int, hint: int = 0) -> None:
-        redis = self._pins_db
-        key = str(chat_id)
-        dumps = redis.lrange(key, 0, -1)
+        self._call_script(PinOp("remove", (m_id, hint), []), chat_id)
 
-        # calculate indicies to drop
-        all_bad = [(abs(index - hint), index)
-                      for index, dump in enumerate(dumps)
-                      if json.loads(dump)['m_id'] == m_id
-                  ]
-        if all_bad == []:
-            return
+    @redis_call(retry=True)
+    def replace_same_id(self, chat_id: int, edited: MessageInfo) -> None:
+        self._call_script(PinOp("replace_same_id", (edited,), []), chat_id)
 
-        to_delete = min(all_bad)[1]
-        # set the indicies to special value
-        special = "$$DELETED"
-        redis.lset(key, to_delete, special)
-        # delete the special value
-        redis.lrem(key, 0, special)
+    # Rewrite pins stored in older formats with the current one. Safe to run
+    # while the bot works: values are replaced atomically, and pins that
+    # changed since they were read are left alone
+    @redis_call(retry=True)
+    def migrate_pins(self, chat_id: int) -> int:
+        key = self._pins_key(chat_id)
+        dumps = self._redis.lrange(key, 0, -1)
+        pairs = []
+        for dump in set(dumps):
+            if MessageInfo.is_json(dump):
+                pairs += [dump, MessageInfo.loads(dump, chat_id).dumps()]
+        if pairs == []:
+            return 0
+        return self._rewrite_script(keys=[key], args=pairs)
 
-    def replace_same_id(self, chat_id: int, edited: MessageInfo) -> None:
-        redis = self._pins_db
-        key = str(chat_id)
-        dumps = redis.lrange(key, 0, -1)
-        value = edited.dumps()
+    # chats that have pins
+    def pinned_chats(self) -> Iterator[int]:
+        for key in self._redis.scan_iter(match="chat:*:pins", count=1000):
+            yield int(key.split(b":")[1])
 
-        for dump, index in zip(dumps, range(len(dumps))):
-            if json.loads(dump)['m_id'] == edited.m_id:
-                redis.lset(key, index, value)
+    # chats that have anything stored
+    def chats(self) -> Iterator[int]:
+        seen: Set[int] = set()
+        for key in self._redis.scan_iter(match="chat:*", count=1000):
+            chat_id = int(key.split(b":")[1])
+            if chat_id not in seen:
+                seen.add(chat_id)
+                yield chat_id
+
+    # forget everything about chat
+    @redis_call(retry=True)
+    def drop_chat(self, chat_id: int) -> None:
+        self._redis.delete(self._chat_key(chat_id), *self._pin_keys(chat_id))
 
 
     # get and set id of message that you need to edit
+    @redis_call(retry=True)
     def get_message_id(self, chat_id: int) -> int:
-        redis = self._editables_db
-        key = str(chat_id)
-        return int(redis.get(key))
+        redis = self._redis
+        key = self._chat_key(chat_id)
+        return int(redis.hget(key, self.MessageIdField))
+    @redis_call(retry=True)
     def set_message_id(self, chat_id: int, m_id: int) -> None:
-        redis = self._editables_db
-        key = str(chat_id)
-        val = str(m_id)
-        redis.set(key, val)
+        redis = self._redis
+        key = self._chat_key(chat_id)
         # automatically set that no user has messaged us
-        self._no_user_wrote.set(key, ".")
+        redis.hmset(key, { self.MessageIdField   : str(m_id)
+                         , self.NoUserWroteField : "."
+                         })
+    @redis_call(retry=True)
     def has_message_id(self, chat_id: int) -> bool:
-        redis = self._editables_db
-        key = str(chat_id)
-        return redis.get(key) is not None
+        redis = self._redis
+        key = self._chat_key(chat_id)
+        return redis.hexists(key, self.MessageIdField)
+    @redis_call(retry=True)
     def remove_message_id(self, chat_id: int) -> None:
-        redis = self._editables_db
-        key = str(chat_id)
-        redis.delete(key)
+        redis = self._redis
+        key = self._chat_key(chat_id)
+        redis.hdel(key, self.MessageIdField)
 
     # status of last message
+    @redis_call(retry=True)
     def did_user_message(self, chat_id: int) -> bool:
-        redis = self._no_user_wrote
-        key = str(chat_id)
-        return redis.get(key) is None
+        redis = self._redis
+        key = self._chat_key(chat_id)
+        return not redis.hexists(key, self.NoUserWroteField)
+    @redis_call(retry=True)
     def user_message_added(self, chat_id: int) -> None:
-        redis = self._no_user_wrote
-        key = str(chat_id)
-        redis.delete(key)
+        redis = self._redis
+        key = self._chat_key(chat_id)
+        redis.hdel(key, self.NoUserWroteField)
+
+
+    # whole chat state at once
+
+    @redis_call(retry=True)
+    def load(self, chat_id: int) -> ChatState:
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.lrange(self._pins_key(chat_id), 0, -1)
+        pipe.hmget(self._chat_key(chat_id)
+                  ,[self.MessageIdField, self.NoUserWroteField])
+        dumps, (editable, no_user_wrote) = pipe.execute()
+
+        pins = [MessageInfo.loads(dump, chat_id) for dump in dumps]
+        message_id = int(editable) if editable is not None else None
+        return ChatState(chat_id, pins, message_id, no_user_wrote is None)
+
+    @redis_call(retry=False)
+    def commit(self, state: ChatState) -> None:
+        if not state.changed():
+            return
+        keys = self._pin_keys(state.chat_id) + [self._chat_key(state.chat_id)]
+        args = self._commit_args(state)
+        try:
+            # Script object would check that the script exists with an
+            # additional round trip
+            self._redis.evalsha(self._commit_script.sha, len(keys), *keys, *args)
+        except NoScriptError:
+            # Scripts are not known to a fresh or restarted server. Nothing
+            # was written then, so everything is done again
+            self.load_scripts()
+            self._redis.evalsha(self._commit_script.sha, len(keys), *keys, *args)
+        state.mark_committed()
+
+    # arguments of CommitScript that write the changes of the state
+    @staticmethod
+    def _commit_args(state: ChatState) -> list:
+        args: list = []
+        for op in state.pin_ops:
+            if op.name == "clear":
+                args.append("clear")
+            else:
+                args += [op.name, *Storage._op_args(op)]
+
+        if state.message_id_changed():
+            if state.message_id is None:
+                args += ["hdel", Storage.MessageIdField]
+            else:
+                args += ["hset", Storage.MessageIdField, str(state.message_id)]
+        if state.message_id_changed() or state.user_wrote_changed():
+            if state.user_wrote:
+                args += ["hdel", Storage.NoUserWroteField]
+            else:
+                args += ["hset", Storage.NoUserWroteField, "."]
+        return args
+
+    # make the server know the scripts, so that they don't have to be loaded
+    # on first use
+    @redis_call(retry=True)
+    def load_scripts(self) -> None:
+        scripts = [ self._add_script, self._remove_script
+                  , self._replace_script, self._keep_last_script
+                  , self._is_pinned_script, self._commit_script
+                  ]
+        for script in scripts:
+            script.sha = self._redis.script_load(script.script)
+
+    def _call_script(self, op: PinOp, chat_id: int) -> Any:
+        script, args = self._script_call(op)
+        return script(keys=self._pin_keys(chat_id), args=args)
+
+    # script and its arguments for a pin operation
+    def _script_call(self, op: PinOp) -> Tuple[Any, list]:
+        scripts = { "add"             : self._add_script
+                  , "remove"          : self._remove_script
+                  , "replace_same_id" : self._replace_script
+                  , "clear_keep_last" : self._keep_last_script
+                  , "is_pinned"       : self._is_pinned_script
+                  }
+        args = self._op_args(op)
+        return (scripts[op.name], args)
+
+    # arguments of the script for a pin operation
+    @staticmethod
+    def _op_args(op: PinOp) -> list:
+        if op.name == "add":
+            msg, = op.args
+            return [msg.dumps(), msg.m_id]
+        elif op.name == "remove":
+            m_id, hint = op.args
+            return [m_id, hint, Storage.Deleted]
+        elif op.name == "replace_same_id":
+            edited, = op.args
+            return [edited.m_id, edited.dumps()]
+        elif op.name == "clear_keep_last":
+            return []
+        elif op.name == "is_pinned":
+            m_id, = op.args
+            return [m_id]
+        else:
+            raise ValueError(f"Unknown pin operation {op.name}")
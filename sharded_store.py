@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+
+from typing import *
+from bisect import bisect
+from hashlib import md5
+from message_info import MessageInfo
+from chat_state import ChatState
+from remote_store import Storage as RemoteStorage
+from redis_pool import PoolConfig
+import os
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: storage spread over several other storages, usually redis
+servers. This presents the same interface as local_store.
+Each chat lives on one shard, so everything done to a chat is as atomic as
+that shard makes it. Shards are picked with consistent hashing: every shard
+owns many points on a ring of hashes, and a chat goes to the shard owning the
+first point after the chat's hash. When a shard is added, it takes over only
+the chats that fall before its points, about 1/N of them; rebalance.py moves
+them.
+"""
+
+
+# stable between processes, unlike hash()
+def ring_hash(key: str) -> int:
+    return int.from_bytes(md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    # points of each node on the ring. More points spread chats more evenly
+    VirtualNodes = 160
+
+    _hashes: List[int]
+    _nodes: List[str]
+
+    def __init__(self, nodes: Iterable[str]
+                ,virtual_nodes: int = VirtualNodes
+                ) -> None:
+        points = sorted( (ring_hash(f"{node}#{index}"), node)
+                         for node in nodes
+                         for index in range(virtual_nodes)
+                       )
+        if points == []:
+            raise ValueError("Hash ring needs at least one node")
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node(self, chat_id: int) -> str:
+        index = bisect(self._hashes, ring_hash(str(chat_id)))
+        return self._nodes[index % len(self._nodes)]
+
+
+class Storage:
+    # name of every shard and storage on it
+    shards: Dict[str, Any]
+    _ring: HashRing
+
+    def __init__(self, shards: Dict[str, Any]
+                ,virtual_nodes: int = HashRing.VirtualNodes
+                ) -> None:
+        self.shards = shards
+        self._ring = HashRing(shards, virtual_nodes)
+
+    # REDIS_SHARDS is a comma-separated list of address:port of redis
+    # servers. Shards are named by these strings, so the list can be
+    # reordered but names must stay the same
+    @staticmethod
+    def from_env(env: Mapping[str, str] = os.environ) -> 'Storage':
+        pool_config = PoolConfig.from_env(env)
+        db = int(env.get("REDIS_DB", RemoteStorage.RedisDb))
+        shards = {}
+        for node in env["REDIS_SHARDS"].split(","):
+            node = node.strip()
+            addr, _, port = node.partition(":")
+            shards[node] = RemoteStorage( addr = addr
+                                        , port = int(port or RemoteStorage.RedisPort)
+                                        , db = db
+                                        , pool_config = pool_config
+                                        )
+        return Storage(shards)
+
+    def shard_name(self, chat_id: int) -> str:
+        return self._ring.node(chat_id)
+    def shard(self, chat_id: int):
+        return self.shards[self._ring.node(chat_id)]
+
+
+    def has(self, chat_id: int) -> bool:
+        return self.shard(chat_id).has(chat_id)
+    def get(self, chat_id: int) -> List[MessageInfo]:
+        return self.shard(chat_id).get(chat_id)
+    def is_pinned(self, chat_id: int, m_id: int) -> bool:
+        return self.shard(chat_id).is_pinned(chat_id, m_id)
+
+    def add(self, chat_id: int, msg: MessageInfo) -> None:
+        self.shard(chat_id).add(chat_id, msg)
+
+    def clear(self, chat_id: int) -> None:
+        self.shard(chat_id).clear(chat_id)
+
+    def clear_keep_last(self, chat_id: int) -> None:
+        self.shard(chat_id).clear_keep_last(chat_id)
+
+    def remove(self, chat_id: int, m_id: int, hint: int = 0) -> None:
+        self.shard(chat_id).remove(chat_id, m_id, hint)
+
+    def replace_same_id(self, chat_id: int, edited: MessageInfo) -> None:
+        self.shard(chat_id).replace_same_id(chat_id, edited)
+
+    # get and set id of message that you need to edit
+    def get_message_id(self, chat_id: int) -> int:
+        return self.shard(chat_id).get_message_id(chat_id)
+    def set_message_id(self, chat_id: int, m_id: int) -> None:
+        self.shard(chat_id).set_message_id(chat_id, m_id)
+    def has_message_id(self, chat_id: int) -> bool:
+        return self.shard(chat_id).has_message_id(chat_id)
+    def remove_message_id(self, chat_id: int) -> None:
+        self.shard(chat_id).remove_message_id(chat_id)
+
+    # status of last message
+    def did_user_message(self, chat_id: int) -> bool:
+        return self.shard(chat_id).did_user_message(chat_id)
+    def user_message_added(self, chat_id: int) -> None:
+        self.shard(chat_id).user_message_added(chat_id)
+
+    # chats that have anything stored
+    def chats(self) -> Iterator[int]:
+        for shard in self.shards.values():
+            yield from shard.chats()
+
+    # forget everything about chat
+    def drop_chat(self, chat_id: int) -> None:
+        self.shard(chat_id).drop_chat(chat_id)
+
+    # whole chat state at once
+    def load(self, chat_id: int) -> ChatState:
+        return self.shard(chat_id).load(chat_id)
+    def commit(self, state: ChatState) -> None:
+        self.shard(state.chat_id).commit(state)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+from typing import *
+from contextlib import contextmanager
+from threading import Lock, local
+from message_info import MessageInfo
+from chat_state import ChatState
+from storage_error import StorageError
+import sqlite3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: proxy types to the means of storage.
+This presents the same interface as local_store, but keeps data in an sqlite
+database file.
+Every pin gets a sequence number in its chat, and newer pins get bigger
+numbers, so pins are found by message id or by position with indices instead
+of going through the list. Each thread has its own connection, and the
+database is in WAL mode, so reads don't wait for writes.
+Storage methods raise StorageError when the database stays locked for too
+long
+"""
+
+
+Schema = """
+CREATE TABLE IF NOT EXISTS pins
+    ( chat_id INTEGER NOT NULL
+    , seq INTEGER NOT NULL
+    , m_id INTEGER NOT NULL
+    , data BLOB NOT NULL
+    , PRIMARY KEY (chat_id, seq)
+    ) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS pins_by_m_id ON pins (chat_id, m_id);
+CREATE TABLE IF NOT EXISTS chats
+    ( chat_id INTEGER PRIMARY KEY
+    , message_id INTEGER
+    , no_user_wrote INTEGER NOT NULL DEFAULT 0
+    );
+"""
+
+# Statements are constant strings, so each connection prepares them once and
+# then takes them from its statement cache
+
+SelectPins = "SELECT data FROM pins WHERE chat_id = ? ORDER BY seq DESC"
+HasPins = "SELECT 1 FROM pins WHERE chat_id = ? LIMIT 1"
+IsPinned = "SELECT 1 FROM pins WHERE chat_id = ? AND m_id = ? LIMIT 1"
+InsertPin = """
+INSERT INTO pins (chat_id, seq, m_id, data)
+VALUES (?1, (SELECT IFNULL(MAX(seq), 0) + 1 FROM pins WHERE chat_id = ?1), ?2, ?3)
+"""
+# drop pins beyond the ?2 latest
+TrimPins = """
+DELETE FROM pins WHERE chat_id = ?1 AND seq <=
+    (SELECT seq FROM pins WHERE chat_id = ?1 ORDER BY seq DESC LIMIT 1 OFFSET ?2)
+"""
+DeletePins = "DELETE FROM pins WHERE chat_id = ?"
+KeepLastPin = """
+DELETE FROM pins WHERE chat_id = ?1 AND seq <
+    (SELECT MAX(seq) FROM pins WHERE chat_id = ?1)
+"""
+SelectSeqs = "SELECT seq FROM pins WHERE chat_id = ? AND m_id = ?"
+# position of pin in the list, latest first
+SelectPosition = "SELECT COUNT(*) FROM pins WHERE chat_id = ? AND seq > ?"
+DeletePin = "DELETE FROM pins WHERE chat_id = ? AND seq = ?"
+UpdatePins = "UPDATE pins SET data = ?3 WHERE chat_id = ?1 AND m_id = ?2"
+
+SelectChat = "SELECT message_id, no_user_wrote FROM chats WHERE chat_id = ?"
+# setting message id resets the flag
+UpsertMessageId = """
+INSERT INTO chats (chat_id, message_id, no_user_wrote) VALUES (?1, ?2, 1)
+ON CONFLICT (chat_id) DO UPDATE SET message_id = ?2, no_user_wrote = 1
+"""
+ClearMessageId = "UPDATE chats SET message_id = NULL WHERE chat_id = ?"
+SelectChats = "SELECT chat_id FROM pins UNION SELECT chat_id FROM chats"
+DeleteChat = "DELETE FROM chats WHERE chat_id = ?"
+UpsertNoUserWrote = """
+INSERT INTO chats (chat_id, no_user_wrote) VALUES (?1, ?2)
+ON CONFLICT (chat_id) DO UPDATE SET no_user_wrote = ?2
+"""
+
+
+class Storage:
+    DefaultPath = "pins.sqlite3"
+    # seconds to wait for a locked database before giving up
+    BusyTimeout = 5.0
+
+    _path: str
+    # how many pins a chat can have, unlimited if None
+    _max_pins: Optional[int]
+    # connection of each thread
+    _local: local
+    _connections: List[sqlite3.Connection]
+    _connections_lock: Lock
+
+    def __init__(self, path: str = DefaultPath
+                ,max_pins: Optional[int] = None
+                ) -> None:
+        self._path = path
+        self._max_pins = max_pins
+        self._local = local()
+        self._connections = []
+        self._connections_lock = Lock()
+        conn = self._conn()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(Schema)
+
+    def close(self) -> None:
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = local()
+
+    def has(self, chat_id: int) -> bool:
+        with self._transaction() as conn:
+            return conn.execute(HasPins, (chat_id,)).fetchone() is not None
+    def get(self, chat_id: int) -> List[MessageInfo]:
+        with self._transaction() as conn:
+            return self._get(conn, chat_id)
+    # whether message m_id is among chat's pins
+    def is_pinned(self, chat_id: int, m_id: int) -> bool:
+        with self._transaction() as conn:
+            return conn.execute(IsPinned, (chat_id, m_id)).fetchone() is not None
+
+    def add(self, chat_id: int, msg: MessageInfo) -> None:
+        with self._transaction(write=True) as conn:
+            self._add(conn, chat_id, msg)
+
+    def clear(self, chat_id: int) -> None:
+        with self._transaction(write=True) as conn:
+            self._clear(conn, chat_id)
+
+    def clear_keep_last(self, chat_id: int) -> None:
+        with self._transaction(write=True) as conn:
+            self._clear_keep_last(conn, chat_id)
+
+    def remove(self, chat_id: int, m_id: int, hint: int = 0) -> None:
+        with self._transaction(write=True) as conn:
+            self._remove(conn, chat_id, m_id, hint)
+
+    def replace_same_id(self, chat_id: int, edited: MessageInfo) -> None:
+        with self._transaction(write=True) as conn:
+            self._replace_same_id(conn, chat_id, edited)
+
+    # get and set id of message that you need to edit
+    def get_message_id(self, chat_id: int) -> int:
+        with self._transaction() as conn:
+            row = conn.execute(SelectChat, (chat_id,)).fetchone()
+        if row is None or row[0] is None:
+            raise KeyError(chat_id)
+        return row[0]
+    def set_message_id(self, chat_id: int, m_id: int) -> None:
+        with self._transaction(write=True) as conn:
+            conn.execute(UpsertMessageId, (chat_id, m_id))
+    def has_message_id(self, chat_id: int) -> bool:
+        try:
+            self.get_message_id(chat_id)
+            return True
+        except KeyError:
+            return False
+    def remove_message_id(self, chat_id: int) -> None:
+        with self._transaction(write=True) as conn:
+            conn.execute(ClearMessageId, (chat_id,))
+
+    # status of last message
+    def did_user_message(self, chat_id: int) -> bool:
+        with self._transaction() as conn:
+            row = conn.execute(SelectChat, (chat_id,)).fetchone()
+        return row is None or not row[1]
+    def user_message_added(self, chat_id: int) -> None:
+        with self._transaction(write=True) as conn:
+            conn.execute(UpsertNoUserWrote, (chat_id, 0))
+
+    # chats that have anything stored
+    def chats(self) -> Iterator[int]:
+        with self._transaction() as conn:
+            rows = conn.execute(SelectChats).fetchall()
+        return (chat_id for (chat_id,) in rows)
+
+    # forget everything about chat
+    def drop_chat(self, chat_id: int) -> None:
+        with self._transaction(write=True) as conn:
+            conn.execute(DeletePins, (chat_id,))
+            conn.execute(DeleteChat, (chat_id,))
+
+    # whole chat state at once, read in one transaction
+    def load(self, chat_id: int) -> ChatState:
+        with self._transaction() as conn:
+            pins = self._get(conn, chat_id)
+            row = conn.execute(SelectChat, (chat_id,)).fetchone()
+        message_id, no_user_wrote = row if row is not None else (None, 0)
+        return ChatState( chat_id, pins, message_id, not no_user_wrote
+                        , self._max_pins
+                        )
+
+    # all changes are written in one transaction
+    def commit(self, state: ChatState) -> None:
+        if not state.changed():
+            return
+        chat_id = state.chat_id
+        with self._transaction(write=True) as conn:
+            for op in state.pin_ops:
+                getattr(self, "_" + op.name)(conn, chat_id, *op.args)
+            if state.message_id_changed():
+                if state.message_id is None:
+                    conn.execute(ClearMessageId, (chat_id,))
+                else:
+                    conn.execute(UpsertMessageId, (chat_id, state.message_id))
+            if state.message_id_changed() or state.user_wrote_changed():
+                conn.execute( UpsertNoUserWrote
+                            , (chat_id, 0 if state.user_wrote else 1)
+                            )
+        state.mark_committed()
+
+    # operations inside a transaction
+
+    def _get(self, conn: sqlite3.Connection, chat_id: int) -> List[MessageInfo]:
+        rows = conn.execute(SelectPins, (chat_id,)).fetchall()
+        return [MessageInfo.loads(data, chat_id) for (data,) in rows]
+
+    def _add(self, conn: sqlite3.Connection, chat_id: int
+            ,msg: MessageInfo
+            ) -> None:
+        conn.execute(InsertPin, (chat_id, msg.m_id, msg.dumps()))
+        if self._max_pins is not None:
+            conn.execute(TrimPins, (chat_id, self._max_pins))
+
+    def _clear(self, conn: sqlite3.Connection, chat_id: int) -> None:
+        conn.execute(DeletePins, (chat_id,))
+
+    def _clear_keep_last(self, conn: sqlite3.Connection, chat_id: int) -> None:
+        conn.execute(KeepLastPin, (chat_id,))
+
+    def _remove(self, conn: sqlite3.Connection, chat_id: int
+               ,m_id: int, hint: int = 0
+               ) -> None:
+        seqs = [seq for (seq,) in conn.execute(SelectSeqs, (chat_id, m_id))]
+        if seqs == []:
+            return
+        elif len(seqs) == 1:
+            to_delete = seqs[0]
+        else:
+            # Same message pinned several times. Only now positions are
+            # needed, to find the one closest to hint
+            def position(seq: int) -> int:
+                return conn.execute(SelectPosition, (chat_id, seq)).fetchone()[0]
+            indices = {seq: position(seq) for seq in seqs}
+            to_delete = min(seqs, key=lambda seq:
+                            (abs(indices[seq] - hint), indices[seq]))
+        conn.execute(DeletePin, (chat_id, to_delete))
+
+    def _replace_same_id(self, conn: sqlite3.Connection, chat_id: int
+                        ,edited: MessageInfo
+                        ) -> None:
+        conn.execute(UpdatePins, (chat_id, edited.m_id, edited.dumps()))
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # transactions are started explicitly
+            conn = sqlite3.connect( self._path
+                                  , timeout=self.BusyTimeout
+                                  , isolation_level=None
+                                  , check_same_thread=False
+                                  , cached_statements=64
+                                  )
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    # Writers take the lock at once, so that two transactions never both
+    # read and then wait for each other to write
+    @contextmanager
+    def _transaction(self, write: bool = False) -> Iterator[sqlite3.Connection]:
+        conn = self._conn()
+        try:
+            conn.execute("BEGIN IMMEDIATE" if write else "BEGIN")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        except sqlite3.OperationalError as e:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise StorageError(f"Database unavailable: {e}") from e
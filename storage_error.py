@@ -0,0 +1,12 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: error raised by storages when the means of storage can't be
+reached in time. Handlers drop the update when they get it
+"""
+
+class StorageError(Exception):
+    pass
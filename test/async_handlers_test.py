@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+Description: same as handlers test, but with the handlers from
+async_handlers run in an event loop
+"""
+
+import asyncio
+import async_handlers
+import handlers
+import unittest
+from typing import *
+from unittest.mock import patch
+from async_store import InPlaceStorage
+
+from test.handlers_test import TestHandlers as LocalTestHandlers
+
+
+class TestHandlers(LocalTestHandlers):
+    """Tests call handlers from handlers module, they are replaced with
+    async handlers run to completion"""
+    Replaced = ["pinned", "button_pressed", "message_edited", "message"]
+
+    # asyncio storage working with the same data as storage
+    def get_async_storage(self, storage):
+        return InPlaceStorage(storage)
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+        for name in self.Replaced:
+            replacement = self.run_in_loop(getattr(async_handlers, name))
+            replacing = patch.object(handlers, name, replacement)
+            replacing.start()
+            self.addCleanup(replacing.stop)
+
+    def run_in_loop(self, curried):
+        def with_storage(storage):
+            handler = curried(self.get_async_storage(storage))
+            def run(update, context):
+                return self.loop.run_until_complete(handler(update, context))
+            return run
+        return with_storage
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+Description: handlers test with a cache in front of local storage, and tests
+of the cache itself
+"""
+
+import handlers
+import unittest
+from typing import *
+from unittest.mock import patch
+from cached_store import Storage
+from local_store import Storage as LocalStorage
+from message_info import MessageInfo
+
+from test.handlers_test import TestHandlers as LocalTestHandlers
+from test.handlers_test import Bot, Context, Update, gen_same_chat_messages
+
+
+class TestHandlers(LocalTestHandlers):
+    def get_storage(self):
+        return Storage(LocalStorage())
+
+
+class TestCache(unittest.TestCase):
+
+    def test_hits_after_write(self):
+        backend = LocalStorage()
+        storage = Storage(backend)
+        bot = Bot()
+        context = Context(bot)
+        pin_handler = handlers.pinned(storage)
+
+        msgs = gen_same_chat_messages(5)
+        chat_id = msgs[0].chat.id
+        for msg in msgs:
+            pin_handler(Update(msg, None), context)
+
+        # loaded once, everything else is from cache
+        self.assertEqual(storage.misses, 1)
+        self.assertEqual(storage.hits, len(msgs) - 1)
+        ids = lambda storage: [pin.m_id for pin in storage.get(chat_id)]
+        self.assertEqual(ids(storage), ids(backend))
+        self.assertEqual(storage.get_message_id(chat_id),
+                         backend.get_message_id(chat_id))
+
+    def test_write_through(self):
+        backend = LocalStorage()
+        storage = Storage(backend)
+        msgs = gen_same_chat_messages(3)
+        chat_id = msgs[0].chat.id
+        infos = list(map(MessageInfo, msgs))
+
+        self.assertFalse(storage.has(chat_id))
+        for info in infos:
+            storage.add(chat_id, info)
+        storage.remove(chat_id, infos[1].m_id)
+        storage.set_message_id(chat_id, 42)
+        self.assertFalse(storage.did_user_message(chat_id))
+        storage.user_message_added(chat_id)
+
+        self.assertEqual(storage.misses, 1)
+        ids = lambda storage: [pin.m_id for pin in storage.get(chat_id)]
+        self.assertEqual(ids(storage), ids(backend))
+        self.assertEqual(storage.get_message_id(chat_id), 42)
+        self.assertTrue(storage.did_user_message(chat_id))
+        self.assertTrue(backend.did_user_message(chat_id))
+
+    def test_eviction(self):
+        backend = LocalStorage()
+        storage = Storage(backend, max_chats=2, max_pins=3)
+        first, second, third = [gen_same_chat_messages(2) for _ in range(3)]
+        for msgs in [first, second]:
+            for msg in msgs:
+                backend.add(msg.chat.id, MessageInfo(msg))
+
+        storage.get(first[0].chat.id)
+        storage.get(second[0].chat.id)
+        # too many pins
+        self.assertEqual(storage.stats()["chats"], 1)
+        self.assertEqual(storage.evictions, 1)
+
+        storage.has(third[0].chat.id)
+        storage.has(first[0].chat.id)
+        # too many chats
+        self.assertEqual(storage.stats()["chats"], 2)
+        self.assertEqual(storage.evictions, 2)
+        self.assertEqual(len(storage.get(first[0].chat.id)), 2)
+        self.assertEqual(storage.misses, 4)
+
+    def test_invalidate(self):
+        backend = LocalStorage()
+        storage = Storage(backend)
+        msgs = gen_same_chat_messages(2)
+        chat_id = msgs[0].chat.id
+
+        storage.add(chat_id, MessageInfo(msgs[0]))
+        self.assertEqual(len(storage.get(chat_id)), 1)
+        # another process writes
+        backend.add(chat_id, MessageInfo(msgs[1]))
+        self.assertEqual(len(storage.get(chat_id)), 1)
+
+        storage.invalidate(chat_id)
+        self.assertEqual(len(storage.get(chat_id)), 2)
+        self.assertEqual(storage.invalidations, 1)
+
+    def test_pinned_ids(self):
+        backend = LocalStorage()
+        storage = Storage(backend, max_chats=1)
+        first, second = [gen_same_chat_messages(2) for _ in range(2)]
+        first_id, second_id = first[0].chat.id, second[0].chat.id
+        for msgs in [first, second]:
+            for msg in msgs:
+                backend.add(msg.chat.id, MessageInfo(msg))
+
+        with patch.object(backend, "is_pinned", side_effect=AssertionError):
+            # a chat not seen before is loaded once
+            self.assertTrue(storage.is_pinned(first_id, first[0].message_id))
+            self.assertFalse(storage.is_pinned(first_id, second[0].message_id))
+            self.assertEqual(storage.misses, 1)
+            # ids are kept when the state is evicted
+            self.assertTrue(storage.is_pinned(second_id, second[1].message_id))
+            self.assertEqual(storage.stats()["chats"], 1)
+            self.assertTrue(storage.is_pinned(first_id, first[1].message_id))
+            self.assertEqual(storage.misses, 2)
+
+        # changed without the state, and loaded again
+        storage.remove(first_id, first[0].message_id)
+        self.assertFalse(storage.is_pinned(first_id, first[0].message_id))
+        self.assertEqual(storage.misses, 3)
+        # changed by someone else
+        backend.add(second_id, MessageInfo(first[0]))
+        storage.invalidate(second_id)
+        self.assertTrue(storage.is_pinned(second_id, first[0].message_id))
+        self.assertEqual(storage.stats()["pinned_chats"], 2)
+
+    def test_pinned_ids_size(self):
+        backend = LocalStorage()
+        storage = Storage(backend, max_pinned_chats=2)
+        chats = [gen_same_chat_messages(1) for _ in range(3)]
+        for msgs in chats:
+            backend.add(msgs[0].chat.id, MessageInfo(msgs[0]))
+            storage.is_pinned(msgs[0].chat.id, msgs[0].message_id)
+        self.assertEqual(storage.stats()["pinned_chats"], 2)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+"""
+
+import handlers
+import unittest
+from threading import Event
+from time import sleep
+from typing import *
+from unittest.mock import patch
+from chat_executor import ChatExecutor
+
+from test.handlers_test import TestHandlers as LocalTestHandlers, Update, gen_message
+
+
+class TestChatExecutor(unittest.TestCase):
+    def setUp(self):
+        self.executor = ChatExecutor(workers=4)
+        self.addCleanup(self.executor.stop)
+
+    def test_chat_order(self):
+        done: Dict[int, List[int]] = {1: [], 2: []}
+        def task(chat_id, number):
+            def r():
+                # later tasks would finish first if run at once
+                sleep(0.001 * (10 - number))
+                done[chat_id].append(number)
+            return r
+        for number in range(10):
+            for chat_id in [1, 2]:
+                self.executor.submit(chat_id, task(chat_id, number))
+        self.executor.join()
+        self.assertEqual(done, {1: list(range(10)), 2: list(range(10))})
+
+    def test_busy_chat_doesnt_block(self):
+        release = Event()
+        others = Event()
+        for _ in range(10):
+            self.executor.submit(1, release.wait)
+        self.executor.submit(2, others.set)
+        # one worker waits in chat 1, and the rest are free for chat 2
+        self.assertTrue(others.wait(5))
+        self.assertEqual(self.executor.stats()["waiting"], 9)
+        release.set()
+        self.executor.join()
+
+    def test_turns(self):
+        executor = ChatExecutor(workers=1)
+        self.addCleanup(executor.stop)
+        order = []
+        release = Event()
+        executor.submit(1, release.wait)
+        for _ in range(3):
+            executor.submit(1, lambda: order.append(1))
+        executor.submit(2, lambda: order.append(2))
+        release.set()
+        executor.join()
+        # chat 2 goes right after chat 1's first update, not after all
+        self.assertEqual(order, [2, 1, 1, 1])
+
+    def test_errors(self):
+        def fail():
+            raise ValueError("expected in test")
+        with patch("traceback.print_exception"):
+            self.executor.submit(1, fail)
+            done = Event()
+            self.executor.submit(1, done.set)
+            self.assertTrue(done.wait(5))
+
+    def test_error_handler(self):
+        errors = []
+        executor = ChatExecutor(workers=2, on_error=lambda update, error: errors.append((update, error)))
+        self.addCleanup(executor.stop)
+        def fail(update, context):
+            raise ValueError("expected in test")
+        update = Update(gen_message(), None)
+        executor.handler(fail)(update, None)
+        executor.submit(1, lambda: fail(None, None))
+        executor.join()
+        self.assertEqual(len(errors), 2)
+        updates = [update for update, _ in errors]
+        self.assertIn(update, updates)
+        self.assertIn(None, updates)
+        self.assertTrue(all(isinstance(error, ValueError) for _, error in errors))
+
+    def test_error_handler_fails(self):
+        def on_error(update, error):
+            raise RuntimeError("expected in test")
+        executor = ChatExecutor(workers=1, on_error=on_error)
+        self.addCleanup(executor.stop)
+        def fail():
+            raise ValueError("expected in test")
+        with patch("traceback.print_exc") as print_exc:
+            executor.submit(1, fail)
+            executor.join()
+        print_exc.assert_called_once()
+
+    def test_stats(self):
+        release = Event()
+        self.executor.submit(1, release.wait)
+        self.executor.submit(1, lambda: None)
+        self.executor.submit(1, lambda: None)
+        sleep(0.01)
+        release.set()
+        self.executor.join()
+        stats = self.executor.stats()
+        self.assertEqual(stats["submitted"], 3)
+        # the first one may be taken before others come
+        self.assertIn(stats["max_depth"], [2, 3])
+        self.assertEqual(stats["mailboxes"], 0)
+        chat = self.executor.chat_stats(1)
+        self.assertEqual(chat["handled"], 3)
+        self.assertGreaterEqual(chat["max_wait"], 0.01)
+
+    def test_stop(self):
+        executor = ChatExecutor(workers=2)
+        done = []
+        for chat_id in range(10):
+            executor.submit(chat_id, lambda: done.append(1))
+        executor.stop()
+        self.assertEqual(len(done), 10)
+        with self.assertRaises(RuntimeError):
+            executor.submit(1, lambda: None)
+
+
+class TestHandlers(LocalTestHandlers):
+    """Handlers go through the executor, and tests wait for them"""
+    Replaced = ["pinned", "button_pressed", "message_edited", "message"]
+
+    def setUp(self):
+        self.executor = ChatExecutor()
+        self.addCleanup(self.executor.stop)
+        for name in self.Replaced:
+            replacing = patch.object(handlers, name, self.through_executor(getattr(handlers, name)))
+            replacing.start()
+            self.addCleanup(replacing.stop)
+
+    def through_executor(self, curried):
+        def with_storage(storage):
+            handler = self.executor.handler(curried(storage))
+            def run(update, context):
+                handler(update, context)
+                self.executor.join()
+            return run
+        return with_storage
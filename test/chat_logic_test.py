@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+"""
+
+import unittest
+from typing import *
+from chat_state import ChatState
+from chat_logic import changes_pins, edit_request, gen_post, needs_new_post, press_button
+from control import UnpinAll, KeepLast, ButtonsExpand, ButtonsCollapse, unpin_data
+from fingerprint import Change
+from message_info import MessageInfo
+from view_post import ButtonsStatus, EmptyPost
+
+from test.handlers_test import gen_same_chat_messages
+
+
+def gen_state(amount: int) -> ChatState:
+    infos = [MessageInfo(msg) for msg in gen_same_chat_messages(amount)]
+    return ChatState(infos[0].chat_id, list(reversed(infos)), 42, False)
+
+
+class TestChatLogic(unittest.TestCase):
+    def test_buttons(self):
+        state = gen_state(3)
+        self.assertFalse(changes_pins(ButtonsExpand))
+        self.assertEqual(press_button(state, ButtonsExpand), ButtonsStatus.Expanded)
+        self.assertEqual(press_button(state, ButtonsCollapse), ButtonsStatus.Collapsed)
+        self.assertFalse(state.changed())
+
+        removed = state.get()[1]
+        data = unpin_data(removed.m_id, 1)
+        self.assertTrue(changes_pins(data))
+        self.assertEqual(press_button(state, data), ButtonsStatus.Expanded)
+        self.assertNotIn(removed.m_id, [pin.m_id for pin in state.get()])
+
+        self.assertEqual(press_button(state, KeepLast), ButtonsStatus.Collapsed)
+        self.assertEqual(len(state.get()), 1)
+        self.assertEqual(press_button(state, UnpinAll), ButtonsStatus.Collapsed)
+        self.assertEqual(gen_post(state), EmptyPost)
+
+    def test_new_post(self):
+        state = gen_state(1)
+        self.assertFalse(needs_new_post(state))
+        state.user_message_added()
+        self.assertTrue(needs_new_post(state))
+        state = gen_state(1)
+        state.remove_message_id()
+        self.assertTrue(needs_new_post(state))
+
+    def test_edit_request(self):
+        text, layout = gen_post(gen_state(2))
+        method, kwargs = edit_request(Change.Markup, 1, 10, text, layout)
+        self.assertEqual(method, "edit_message_reply_markup")
+        self.assertNotIn("text", kwargs)
+        method, kwargs = edit_request(Change.Text, 1, 10, text, layout)
+        self.assertEqual(method, "edit_message_text")
+        self.assertEqual(kwargs["text"], text)
+        self.assertIs(kwargs["reply_markup"], layout)
+
+
+if __name__ == '__main__':
+    unittest.main()
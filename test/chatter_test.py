@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+"""
+
+import handlers
+import unittest
+from typing import *
+from unittest.mock import patch
+from chat_state import ChatState
+from chatter import Chatter
+from local_store import Storage
+
+from test.handlers_test import Bot, Context, Update, gen_message, gen_same_chat_messages
+
+
+class CountingStorage(Storage):
+    def __init__(self) -> None:
+        super().__init__()
+        self.user_messages = 0
+    def user_message_added(self, chat_id: int) -> None:
+        self.user_messages += 1
+        super().user_message_added(chat_id)
+
+
+class TestChatter(unittest.TestCase):
+    def test_wrote(self):
+        chatter = Chatter()
+        self.assertFalse(chatter.wrote(1, 10))
+        # storage wasn't told yet
+        self.assertFalse(chatter.wrote(1, 11))
+        chatter.written(1)
+        self.assertTrue(chatter.wrote(1, 12))
+        self.assertFalse(chatter.wrote(2, 12))
+        chatter.posted(1)
+        self.assertFalse(chatter.wrote(1, 14))
+        self.assertEqual(chatter.stats(), {"chats" : 2, "messages" : 5, "stored" : 1})
+
+    def test_size(self):
+        chatter = Chatter(size=2)
+        for chat_id in [1, 2, 3]:
+            chatter.wrote(chat_id, 10)
+            chatter.written(chat_id)
+        self.assertFalse(chatter.wrote(1, 11))
+        self.assertTrue(chatter.wrote(3, 11))
+
+    def test_check(self):
+        chatter = Chatter()
+        chatter.wrote(1, 10)
+        chatter.written(1)
+        # someone else posted after the message
+        state = ChatState(1, [], 12, False)
+        chatter.check(state)
+        self.assertFalse(state.did_user_message())
+        self.assertFalse(chatter.wrote(1, 11))
+        # and this message came after the post
+        chatter.wrote(1, 13)
+        state = ChatState(1, [], 12, False)
+        chatter.check(state)
+        self.assertTrue(state.did_user_message())
+        self.assertTrue(chatter.wrote(1, 14))
+        # nothing is known about other chats
+        state = ChatState(2, [], 12, False)
+        chatter.check(state)
+        self.assertFalse(state.did_user_message())
+
+
+class TestHandlers(unittest.TestCase):
+    def setUp(self):
+        replacing = patch.object(handlers, "chatter", Chatter())
+        replacing.start()
+        self.addCleanup(replacing.stop)
+
+    def test_storage_told_once(self):
+        storage = CountingStorage()
+        context = Context(Bot())
+        pin_handler = handlers.pinned(storage)
+        message_handler = handlers.message(storage)
+
+        pins = gen_same_chat_messages(2)
+        chat_id = pins[0].chat.id
+        pin_handler(Update(pins[0], None), context)
+        for _ in range(10):
+            msg = gen_message()
+            msg.chat.id = chat_id
+            message_handler(Update(msg, None), context)
+        self.assertEqual(storage.user_messages, 1)
+        self.assertTrue(storage.did_user_message(chat_id))
+
+        # a new post is sent, and the next message has to be stored again
+        pin_handler(Update(pins[1], None), context)
+        self.assertEqual(len(context.bot.sent), 2)
+        self.assertFalse(storage.did_user_message(chat_id))
+        for _ in range(10):
+            msg = gen_message()
+            msg.chat.id = chat_id
+            message_handler(Update(msg, None), context)
+        self.assertEqual(storage.user_messages, 2)
+
+    def test_post_from_elsewhere(self):
+        storage = CountingStorage()
+        context = Context(Bot())
+        pin_handler = handlers.pinned(storage)
+        message_handler = handlers.message(storage)
+
+        pins = gen_same_chat_messages(2)
+        chat_id = pins[0].chat.id
+        pin_handler(Update(pins[0], None), context)
+        first = gen_message()
+        first.chat.id = chat_id
+        message_handler(Update(first, None), context)
+        # another process sends a post, and a user writes after it
+        post = context.bot.send_message(chat_id, "post", "HTML", None)
+        storage.set_message_id(chat_id, post.message_id)
+        after = gen_message()
+        after.chat.id = chat_id
+        # this process thinks storage knows already
+        message_handler(Update(after, None), context)
+        self.assertEqual(storage.user_messages, 1)
+        self.assertFalse(storage.did_user_message(chat_id))
+
+        # the post is sent again below the message anyway
+        pin_handler(Update(pins[1], None), context)
+        self.assertEqual(len(context.bot.sent), 3)
+        self.assertEqual(context.bot.deleted[-1]["m_id"], post.message_id)
+        self.assertEqual(context.bot.edited, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
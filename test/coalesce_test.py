@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+"""
+
+import handlers
+import unittest
+from copy import copy
+from html import escape
+from time import sleep
+from typing import *
+from unittest.mock import patch
+from coalesce import Coalescer, Render
+from local_store import Storage
+from message_info import MessageInfo
+from test.handlers_test import ( Bot, Context, Update
+                               , gen_message, gen_same_chat_messages
+                               , gen_unpin_data
+                               )
+
+
+class TestCoalescer(unittest.TestCase):
+    def test_no_window(self):
+        coalescer = Coalescer()
+        rendered = []
+        self.assertFalse(coalescer.defer(1, Render.Post, lambda *args: rendered.append(args)))
+        self.assertEqual(rendered, [])
+
+    def test_coalesces(self):
+        coalescer = Coalescer(window=60)
+        rendered = []
+        render = lambda *args: rendered.append(args)
+        self.assertTrue(coalescer.defer(1, Render.Edit, render))
+        coalescer.defer(1, Render.Post, render)
+        coalescer.defer(1, Render.Edit, render)
+        coalescer.defer(2, Render.Edit, render)
+        coalescer.flush()
+        self.assertEqual(sorted(rendered), [(1, Render.Post), (2, Render.Edit)])
+        self.assertEqual(coalescer.stats()["coalesced"], 2)
+
+    def test_window_ends(self):
+        coalescer = Coalescer(window=0.05)
+        rendered = []
+        coalescer.defer(1, Render.Post, lambda *args: rendered.append(args))
+        self.assertEqual(rendered, [])
+        for _ in range(100):
+            if rendered != []:
+                break
+            sleep(0.01)
+        self.assertEqual(rendered, [(1, Render.Post)])
+
+
+class TestCoalescedHandlers(unittest.TestCase):
+    def setUp(self):
+        self.renders = Coalescer(window=60)
+        replacing = patch.object(handlers, "post_renders", self.renders)
+        replacing.start()
+        self.addCleanup(replacing.stop)
+
+    def test_burst_of_pins(self):
+        storage = Storage()
+        bot = Bot()
+        context = Context(bot)
+        pin_handler = handlers.pinned(storage)
+
+        msgs = gen_same_chat_messages(10)
+        chat_id = msgs[0].chat.id
+        for msg in msgs:
+            pin_handler(Update(msg, None), context)
+        # stored at once, rendered later
+        self.assertEqual(len(storage.get(chat_id)), len(msgs))
+        self.assertEqual(bot.sent + bot.edited + bot.pinned, [])
+
+        self.renders.flush()
+        self.assertEqual(len(bot.sent), 1)
+        self.assertEqual(len(bot.pinned), 1)
+        self.assertEqual(bot.edited, [])
+        for msg in msgs:
+            self.assertIn(escape(msg.text), bot.sent[0]["text"])
+
+        for msg in msgs:
+            pin_handler(Update(msg, None), context)
+        self.renders.flush()
+        self.assertEqual(len(bot.sent), 1)
+        self.assertEqual(len(bot.edited), 1)
+        self.assertEqual(len(bot.pinned), 2)
+
+    def test_edits_join_pins(self):
+        storage = Storage()
+        bot = Bot()
+        context = Context(bot)
+        pin_handler = handlers.pinned(storage)
+        edit_handler = handlers.message_edited(storage)
+
+        msgs = gen_same_chat_messages(3)
+        for msg in msgs:
+            pin_handler(Update(msg, None), context)
+        self.renders.flush()
+
+        for msg in msgs:
+            edited = copy(msg)
+            edited.text = "edited " + msg.text
+            edit_handler(Update(None, None, edited_message=edited), context)
+        pin_handler(Update(msgs[0], None), context)
+        self.renders.flush()
+        # one render for everything: edit and pin again
+        self.assertEqual(len(bot.edited), 1)
+        self.assertEqual(len(bot.pinned), 2)
+        self.assertIn("edited", bot.edited[0]["text"])
+
+    def test_buttons_not_delayed(self):
+        storage = Storage()
+        bot = Bot()
+        context = Context(bot)
+        pin_handler = handlers.pinned(storage)
+        button_handler = handlers.button_pressed(storage)
+
+        msgs = gen_same_chat_messages(3)
+        for msg in msgs:
+            pin_handler(Update(msg, None), context)
+        self.renders.flush()
+
+        button_handler(Update(None, gen_unpin_data(msgs[0])), context)
+        self.assertEqual(len(bot.edited), 1)
+        self.assertEqual(self.renders.stats()["pending"], 0)
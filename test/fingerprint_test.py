@@ -0,0 +1,47 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+"""
+
+import unittest
+from typing import *
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup # type: ignore
+from fingerprint import Change, RenderedPosts
+
+
+def markup(data: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton("button", callback_data=data)]])
+
+
+class TestRenderedPosts(unittest.TestCase):
+    def test_changes(self):
+        posts = RenderedPosts()
+        self.assertEqual(posts.change(1, 10, "text", markup("a")), Change.Text)
+        posts.remember(1, 10, "text", markup("a"))
+        self.assertEqual(posts.change(1, 10, "text", markup("a")), Change.Nothing)
+        self.assertEqual(posts.change(1, 10, "text", markup("b")), Change.Markup)
+        self.assertEqual(posts.change(1, 10, "other", markup("a")), Change.Text)
+        # another post in the same chat
+        self.assertEqual(posts.change(1, 11, "text", markup("a")), Change.Text)
+        self.assertEqual(posts.change(2, 10, "text", markup("a")), Change.Text)
+
+        stats = posts.stats()
+        self.assertEqual(stats["checked"], 6)
+        self.assertEqual(stats["skipped"], 1)
+        self.assertEqual(stats["markup_only"], 1)
+
+    def test_forget(self):
+        posts = RenderedPosts()
+        posts.remember(1, 10, "text", markup("a"))
+        posts.forget(1)
+        self.assertEqual(posts.change(1, 10, "text", markup("a")), Change.Text)
+
+    def test_size(self):
+        posts = RenderedPosts(size=2)
+        for chat_id in [1, 2, 3]:
+            posts.remember(chat_id, 10, "text", markup("a"))
+        self.assertEqual(posts.change(1, 10, "text", markup("a")), Change.Text)
+        self.assertEqual(posts.change(3, 10, "text", markup("a")), Change.Nothing)
+        self.assertEqual(posts.stats()["posts"], 2)
@@ -10,11 +10,453 @@ localhost
 import handlers
 import unittest
 from typing import *
+from unittest.mock import patch
+from redis.connection import Connection
+from random import choice, randint
+from copy import copy
 from remote_store import Storage
+from local_store import Storage as LocalStorage
+from cached_store import Storage as CachedStorage
+from redis import Redis
+from redis_pool import PoolConfig
+import migrate
+import rebalance
+from sharded_store import Storage as ShardedStorage
+from async_store import RedisStorage as AsyncStorage
+from storage_error import StorageError
+import asyncio
+
+from test.async_handlers_test import TestHandlers as AsyncTestHandlers
+from test.message_info_test import in_time_zone
+from message_info import MessageInfo
+from datetime import datetime, timedelta, timezone
 
 from test.handlers_test import TestHandlers as LocalTestHandlers
+from test.handlers_test import ( Bot, Context, Update
+                               , gen_message, gen_same_chat_messages
+                               , gen_unpin_data
+                               )
+
+
+class CommandCounter:
+    """Counts redis commands and round trips while active. Every round trip
+    sends everything at once, and every command is packed separately, even
+    inside pipelines"""
+    def __init__(self) -> None:
+        self.commands = 0
+        self.round_trips = 0
+
+    def __enter__(self) -> 'CommandCounter':
+        self.commands = 0
+        self.round_trips = 0
+        send_packed = Connection.send_packed_command
+        pack_command = Connection.pack_command
+        def counting_send(conn, *args, **kwargs):
+            self.round_trips += 1
+            return send_packed(conn, *args, **kwargs)
+        def counting_pack(conn, *args):
+            self.commands += 1
+            return pack_command(conn, *args)
+        self._patches = [ patch.object(Connection, "send_packed_command"
+                                      ,counting_send)
+                        , patch.object(Connection, "pack_command"
+                                      ,counting_pack)
+                        ]
+        for p in self._patches:
+            p.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        for p in self._patches:
+            p.stop()
+
+
+class TestCachedHandlers(LocalTestHandlers):
+    def get_storage(self):
+        return CachedStorage(Storage(addr="localhost"))
 
 
 class TestHandlers(LocalTestHandlers):
     def get_storage(self):
         return Storage(addr="localhost")
+
+    def test_round_trips(self):
+        storage = self.get_storage()
+        storage.load_scripts()
+        bot = Bot()
+        context = Context(bot)
+        pin_handler = handlers.pinned(storage)
+        button_handler = handlers.button_pressed(storage)
+        edit_handler = handlers.message_edited(storage)
+        message_handler = handlers.message(storage)
+
+        message_amount = 5
+        msgs = gen_same_chat_messages(message_amount)
+        upds = [Update(msg, None) for msg in msgs]
+
+        # one read and one write per pin, no matter how many pins there are
+        pin_commands = []
+        for update in upds:
+            with CommandCounter() as counter:
+                pin_handler(update, context)
+            self.assertEqual(counter.round_trips, 2)
+            pin_commands.append(counter.commands)
+        self.assertEqual(len(set(pin_commands[1:])), 1)
+
+        # checking that the message is pinned, then as with pins
+        msg = msgs[0]
+        with CommandCounter() as counter:
+            edit_handler(Update(msg, None, msg), context)
+        self.assertEqual(counter.round_trips, 3)
+
+        # messages that aren't pinned are only checked
+        not_pinned = copy(msg)
+        not_pinned.message_id = msg.message_id + 1000
+        with CommandCounter() as counter:
+            edit_handler(Update(not_pinned, None, not_pinned), context)
+        self.assertEqual(counter.round_trips, 1)
+
+        with CommandCounter() as counter:
+            button_handler(Update(None, gen_unpin_data(msg)), context)
+        self.assertEqual(counter.round_trips, 2)
+
+        user_message = gen_message()
+        user_message.chat.id = msg.chat.id
+        with CommandCounter() as counter:
+            message_handler(Update(user_message, None), context)
+        self.assertEqual(counter.round_trips, 1)
+
+        # pins after user message resend the post; still one write
+        with CommandCounter() as counter:
+            pin_handler(upds[1], context)
+        self.assertEqual(counter.round_trips, 2)
+
+    def test_scripts_reload(self):
+        storage = self.get_storage()
+        bot = Bot()
+        context = Context(bot)
+        pin_handler = handlers.pinned(storage)
+        button_handler = handlers.button_pressed(storage)
+        edit_handler = handlers.message_edited(storage)
+
+        message_amount = 3
+        msgs = gen_same_chat_messages(message_amount)
+        chat_id = msgs[0].chat.id
+        for msg in msgs:
+            pin_handler(Update(msg, None), context)
+
+        # as if the server restarted
+        storage._redis.script_flush()
+        edited = copy(msgs[0])
+        edited.text = "edited"
+        edit_handler(Update(edited, None, edited), context)
+        self.assertEqual(len(bot.edited), message_amount)
+
+        storage._redis.script_flush()
+        button_handler(Update(None, gen_unpin_data(msgs[0])), context)
+        self.assertEqual(len(storage.get(chat_id)), message_amount - 1)
+        storage.remove(chat_id, msgs[1].message_id)
+        self.assertEqual(len(storage.get(chat_id)), message_amount - 2)
+
+    def test_commit_scripts_reload(self):
+        storage = self.get_storage()
+        msgs = gen_same_chat_messages(3)
+        chat_id = msgs[0].chat.id
+        infos = list(map(MessageInfo, msgs))
+        storage.add(chat_id, infos[0])
+
+        # as if the server restarted; the whole commit is done in order
+        storage._redis.script_flush()
+        state = storage.load(chat_id)
+        state.add(infos[1])
+        state.clear()
+        state.set_message_id(42)
+        storage.commit(state)
+        self.assertFalse(storage.has(chat_id))
+        self.assertEqual(storage.get_message_id(chat_id), 42)
+
+        storage._redis.script_flush()
+        state = storage.load(chat_id)
+        state.clear()
+        state.add(infos[2])
+        storage.commit(state)
+        self.assertEqual([pin.m_id for pin in storage.get(chat_id)], [infos[2].m_id])
+        self.assertTrue(storage.is_pinned(chat_id, infos[2].m_id))
+
+    def test_index_matches_local(self):
+        storage = self.get_storage()
+        local = LocalStorage()
+
+        msgs = gen_same_chat_messages(5)
+        chat_id = msgs[0].chat.id
+        infos = list(map(MessageInfo, msgs))
+
+        def ids(storage) -> List[int]:
+            if not storage.has(chat_id):
+                return []
+            return [pin.m_id for pin in storage.get(chat_id)]
+
+        for _ in range(300):
+            action = randint(0, 9)
+            info = choice(infos)
+            hint = randint(0, 10)
+            for target in [storage, local]:
+                if action < 5:
+                    target.add(chat_id, info)
+                elif action < 8:
+                    target.remove(chat_id, info.m_id, hint)
+                elif action < 9:
+                    target.replace_same_id(chat_id, info)
+                elif hint < 5:
+                    target.clear_keep_last(chat_id)
+                else:
+                    target.clear(chat_id)
+            self.assertEqual(ids(storage), ids(local))
+
+    def test_index_of_old_pins(self):
+        storage = self.get_storage()
+
+        msgs = gen_same_chat_messages(3)
+        chat_id = msgs[0].chat.id
+        first, second, third = map(MessageInfo, msgs)
+        # pins written before there was an index, some of them in json
+        for info in [first, second]:
+            storage._redis.lpush(storage._pins_key(chat_id), info.dumps_json())
+        for info in [first, third]:
+            storage._redis.lpush(storage._pins_key(chat_id), info.dumps())
+
+        edited = copy(msgs[1])
+        edited.text = "edited"
+        storage.replace_same_id(chat_id, MessageInfo(edited))
+        storage.remove(chat_id, first.m_id, 2)
+        storage.add(chat_id, second)
+
+        pins = storage.get(chat_id)
+        self.assertEqual([pin.m_id for pin in pins],
+                         [second.m_id, third.m_id, second.m_id, first.m_id])
+        self.assertEqual(pins[2].preview.wrapped, "edited")
+
+    def test_is_pinned_reads_only(self):
+        storage = self.get_storage()
+
+        msgs = gen_same_chat_messages(3)
+        chat_id = msgs[0].chat.id
+        first, second, third = map(MessageInfo, msgs)
+        # pins written before there was an index
+        storage._redis.lpush(storage._pins_key(chat_id), first.dumps_json())
+        storage._redis.lpush(storage._pins_key(chat_id), second.dumps())
+
+        self.assertTrue(storage.is_pinned(chat_id, first.m_id))
+        self.assertTrue(storage.is_pinned(chat_id, second.m_id))
+        self.assertFalse(storage.is_pinned(chat_id, third.m_id))
+        self.assertEqual(storage._redis.exists(*storage._pin_keys(chat_id)[1:]), 0)
+        # the index is made by a write
+        storage.add(chat_id, third)
+        self.assertTrue(storage.is_pinned(chat_id, first.m_id))
+        self.assertTrue(storage.is_pinned(chat_id, third.m_id))
+
+    def test_migrate_pins(self):
+        storage = self.get_storage()
+
+        msgs = gen_same_chat_messages(3)
+        chat_id = msgs[0].chat.id
+        infos = list(map(MessageInfo, msgs))
+        for info in infos:
+            storage._redis.lpush(storage._pins_key(chat_id), info.dumps_json())
+        storage.add(chat_id, infos[0])
+        before = [pin.dumps() for pin in storage.get(chat_id)]
+
+        self.assertEqual(storage.migrate_pins(chat_id), len(infos))
+        self.assertEqual(storage.migrate_pins(chat_id), 0)
+        self.assertIn(chat_id, storage.pinned_chats())
+
+        dumps = storage._redis.lrange(storage._pins_key(chat_id), 0, -1)
+        self.assertFalse(any(map(MessageInfo.is_json, dumps)))
+        self.assertEqual(dumps, before)
+
+    def test_migrate_dates(self):
+        in_time_zone(self, "Asia/Tokyo")
+        storage = self.get_storage()
+
+        msgs = gen_same_chat_messages(3)
+        chat_id = msgs[0].chat.id
+        infos = list(map(MessageInfo, msgs))
+        noon = datetime(2019, 5, 1, 12, tzinfo=timezone.utc)
+        for days, info in enumerate(infos):
+            info.date = noon + timedelta(days=days)
+            storage._redis.lpush(storage._pins_key(chat_id), info.dumps_json())
+
+        self.assertEqual(storage.migrate_pins(chat_id), len(infos))
+        self.assertEqual([pin.date for pin in storage.get(chat_id)],
+                         [info.date for info in reversed(infos)])
+        self.assertEqual(storage._redis.lrange(storage._pins_key(chat_id), 0, -1),
+                         [info.dumps() for info in reversed(infos)])
+
+    def test_migrate_layout(self):
+        storage = self.get_storage()
+
+        msgs = gen_same_chat_messages(3)
+        chat_id = msgs[0].chat.id
+        other_id = chat_id + 1
+        infos = list(map(MessageInfo, msgs))
+        # the old layout: three databases with chat ids for keys
+        old_pins = Redis(host="localhost", db=migrate.OldPinsDb)
+        old_editables = Redis(host="localhost", db=migrate.OldEditablesDb)
+        old_flags = Redis(host="localhost", db=migrate.OldNoUserWroteDb)
+        for info in infos:
+            old_pins.lpush(str(chat_id), info.dumps_json())
+        old_editables.set(str(chat_id), "42")
+        old_flags.set(str(chat_id), ".")
+        old_editables.set(str(other_id), "43")
+
+        self.assertGreaterEqual(migrate.migrate_layout("localhost"), 4)
+        chats, pins = migrate.migrate_pins(storage)
+        self.assertGreaterEqual(pins, len(infos))
+
+        state = storage.load(chat_id)
+        self.assertEqual([pin.m_id for pin in state.pins],
+                         [info.m_id for info in reversed(infos)])
+        self.assertEqual(state.message_id, 42)
+        self.assertFalse(state.user_wrote)
+        state = storage.load(other_id)
+        self.assertEqual(state.message_id, 43)
+        self.assertTrue(state.user_wrote)
+        self.assertFalse(old_pins.exists(str(chat_id)))
+        self.assertFalse(old_editables.exists(str(chat_id)))
+
+        # the index works on moved pins
+        storage.remove(chat_id, infos[1].m_id)
+        self.assertEqual(len(storage.get(chat_id)), len(infos) - 1)
+
+    def test_pool_stats(self):
+        config = PoolConfig(size=2, health_check_interval=0)
+        storage = Storage(addr="localhost", pool_config=config)
+        msg = gen_message()
+
+        storage.add(msg.chat_id, MessageInfo(msg))
+        # connections are checked every time, and still work
+        storage._redis.client_kill_filter(_type="normal", skipme=False)
+        self.assertTrue(storage.has(msg.chat_id))
+
+        stats = storage.pool_stats()
+        self.assertGreaterEqual(stats["checkouts"], 2)
+        self.assertEqual(stats["in_use"], 0)
+        self.assertLessEqual(stats["max_in_use"], config.size)
+
+
+class TestShardedHandlers(LocalTestHandlers):
+    # shards are databases of the local redis, away from the main one
+    ShardDbs = [3, 4, 5]
+
+    def get_storage(self):
+        return ShardedStorage({ str(db) : Storage(addr="localhost", db=db)
+                                for db in self.ShardDbs
+                              })
+
+    def test_rebalance(self):
+        # moved pins are loaded and dumped again
+        in_time_zone(self, "Asia/Tokyo")
+        for db in self.ShardDbs:
+            Redis(host="localhost", db=db).flushdb()
+        msgs = gen_same_chat_messages(3)
+        chat_ids = [msgs[0].chat.id + n for n in range(30)]
+        small = ShardedStorage({ str(db) : Storage(addr="localhost", db=db)
+                                 for db in self.ShardDbs[:2]
+                               })
+        noon = datetime(2019, 5, 1, 12, tzinfo=timezone.utc)
+        dumps = {}
+        for chat_id in chat_ids:
+            for days, msg in enumerate(msgs):
+                info = MessageInfo(msg)
+                info.date = noon + timedelta(days=days)
+                small.add(chat_id, info)
+            small.set_message_id(chat_id, chat_id % 1000)
+            dumps[chat_id] = [pin.dumps() for pin in small.get(chat_id)]
+
+        storage = self.get_storage()
+        moved = rebalance.rebalance(storage)
+        self.assertGreater(moved, 0)
+        for name, shard in storage.shards.items():
+            for chat_id in shard.chats():
+                self.assertEqual(storage.shard_name(chat_id), name)
+        for chat_id in chat_ids:
+            state = storage.load(chat_id)
+            self.assertEqual([pin.m_id for pin in state.pins],
+                             [msg.message_id for msg in reversed(msgs)])
+            self.assertEqual(state.message_id, chat_id % 1000)
+            self.assertEqual([pin.dumps() for pin in state.pins], dumps[chat_id])
+            self.assertFalse(state.user_wrote)
+
+
+class TestAsyncHandlers(AsyncTestHandlers):
+    def get_storage(self):
+        return Storage(addr="localhost")
+
+    def get_async_storage(self, storage):
+        async_storage = AsyncStorage(addr="localhost")
+        self.addCleanup(lambda: self.loop.run_until_complete(async_storage.close()))
+        return async_storage
+
+    def test_matches_sync(self):
+        storage = self.get_storage()
+        async_storage = self.get_async_storage(storage)
+        run = self.loop.run_until_complete
+        msgs = gen_same_chat_messages(5)
+        chat_id = msgs[0].chat.id
+        infos = list(map(MessageInfo, msgs))
+
+        # scripts are loaded on the way
+        run(async_storage.add(chat_id, infos[0]))
+        state = run(async_storage.load(chat_id))
+        for info in infos[1:]:
+            state.add(info)
+        state.remove(infos[2].m_id)
+        state.set_message_id(42)
+        run(async_storage.commit(state))
+        self.assertEqual([pin.m_id for pin in storage.get(chat_id)],
+                         [info.m_id for info in reversed(infos) if info != infos[2]])
+        self.assertEqual(storage.get_message_id(chat_id), 42)
+        self.assertFalse(storage.did_user_message(chat_id))
+
+        run(async_storage.user_message_added(chat_id))
+        self.assertTrue(storage.did_user_message(chat_id))
+        self.assertEqual(run(async_storage.get_message_id(chat_id)), 42)
+        run(async_storage.clear(chat_id))
+        self.assertFalse(storage.has(chat_id))
+
+    def test_commit_scripts_reload(self):
+        storage = self.get_storage()
+        async_storage = self.get_async_storage(storage)
+        run = self.loop.run_until_complete
+        msgs = gen_same_chat_messages(2)
+        chat_id = msgs[0].chat.id
+        storage.add(chat_id, MessageInfo(msgs[0]))
+
+        storage._redis.script_flush()
+        state = run(async_storage.load(chat_id))
+        state.add(MessageInfo(msgs[1]))
+        state.clear()
+        run(async_storage.commit(state))
+        self.assertFalse(storage.has(chat_id))
+
+    def test_many_at_once(self):
+        async_storage = self.get_async_storage(None)
+        msg = gen_message()
+        chat_ids = [msg.chat.id + n for n in range(500)]
+        info = MessageInfo(msg)
+        async def pin_all():
+            await asyncio.gather(*(async_storage.add(chat_id, info)
+                                   for chat_id in chat_ids))
+            return await asyncio.gather(*(async_storage.load(chat_id)
+                                          for chat_id in chat_ids))
+        states = self.loop.run_until_complete(pin_all())
+        # every answer went to its request
+        self.assertEqual([state.chat_id for state in states], chat_ids)
+        self.assertTrue(all(len(state.pins) == 1 for state in states))
+
+    def test_unavailable(self):
+        config = PoolConfig(retries=1, backoff_base=0.01)
+        async_storage = AsyncStorage(addr="localhost", port=1, pool_config=config)
+        self.addCleanup(lambda: self.loop.run_until_complete(async_storage.close()))
+        with self.assertRaises(StorageError):
+            self.loop.run_until_complete(async_storage.has(1))
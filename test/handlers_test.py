@@ -8,11 +8,13 @@ License: published under GNU GPL-3
 import handlers
 import unittest
 import re
+from unittest.mock import patch
 from typing import *
-from random import randint, choice
+from random import randint, choice, sample
 from telegram import Message # type: ignore
 from datetime import datetime, timedelta
 from local_store import Storage
+from message_info import MessageInfo
 from copy import copy
 
 
@@ -93,11 +95,21 @@ class Update:
             self.message.pinned_message = copy(msg)
         self.callback_query = cb
 
+    @property
+    def effective_chat(self):
+        if self.message is not None:
+            return self.message.chat
+        if self.edited_message is not None:
+            return self.edited_message.chat
+        return self.callback_query.message.chat
+
 class Bot:
     def __init__(self):
+        self.id = 1
         self.sent = []
         self.pinned = []
         self.edited = []
+        self.markup_edited = []
         self.deleted = []
 
     def send_message(self, chat_id, text, parse_mode, reply_markup):
@@ -127,6 +139,12 @@ class Bot:
                         ,'markup'  : reply_markup
                         }]
         assert isinstance(text, str)
+    def edit_message_reply_markup(self, chat_id, message_id, reply_markup):
+        assert list(filter(lambda m: m["m_id"] == message_id, self.sent)) != []
+        self.markup_edited += [{'chat_id' : chat_id
+                               ,'m_id'    : message_id
+                               ,'markup'  : reply_markup
+                               }]
     def delete_message(self, chat_id, message_id):
         # assert that editing existing message
         assert list(filter(lambda m: m["m_id"] == message_id, self.sent)) != []
@@ -351,7 +369,7 @@ class TestHandlers(unittest.TestCase):
         message_amount = 5
         msgs = gen_same_chat_messages(message_amount)
         upds = [Update(msg, None) for msg in msgs]
-        msg1, msg2 = choice(msgs), choice(msgs)
+        msg1, msg2 = sample(msgs, 2)
 
         for update, number in zip(upds, range(message_amount)):
             pin_handler(update, context)
@@ -359,12 +377,91 @@ class TestHandlers(unittest.TestCase):
         already_edited = message_amount - 1
         self.assertEqual(len(bot.edited), already_edited)
 
-        upd1 = Update(msg1, None, msg1)
-        upd2 = Update(msg2, None, msg2)
+        edited1, edited2 = copy(msg1), copy(msg2)
+        edited1.text = "edited first"
+        edited2.text = "edited second"
+        upd1 = Update(edited1, None, edited1)
+        upd2 = Update(edited2, None, edited2)
 
         edit_handler(upd1, context)
         self.assertEqual(len(bot.edited), already_edited + 1)
         edit_handler(upd2, context)
         self.assertEqual(len(bot.edited), already_edited + 2)
+        # the post already shows it
         edit_handler(upd1, context)
-        self.assertEqual(len(bot.edited), already_edited + 3)
+        self.assertEqual(len(bot.edited), already_edited + 2)
+
+    def test_buttons_edit_markup(self):
+        storage = self.get_storage()
+        bot = Bot()
+        context = Context(bot)
+        pin_handler = handlers.pinned(storage)
+        button_handler = handlers.button_pressed(storage)
+
+        msgs = gen_same_chat_messages(3)
+        for msg in msgs:
+            pin_handler(Update(msg, None), context)
+        already_edited = len(bot.edited)
+
+        expand = Update(None, Update.CbQuery(msgs[0], handlers.ButtonsExpand))
+        collapse = Update(None, Update.CbQuery(msgs[0], handlers.ButtonsCollapse))
+        button_handler(expand, context)
+        self.assertEqual(len(bot.markup_edited), 1)
+        button_handler(expand, context)
+        self.assertEqual(len(bot.markup_edited), 1)
+        button_handler(collapse, context)
+        self.assertEqual(len(bot.markup_edited), 2)
+        self.assertEqual(len(bot.edited), already_edited)
+
+        button_handler(Update(None, gen_unpin_data(msgs[0])), context)
+        self.assertEqual(len(bot.edited), already_edited + 1)
+
+    def test_edit_not_pinned(self):
+        storage = self.get_storage()
+        bot = Bot()
+        context = Context(bot)
+        pin_handler = handlers.pinned(storage)
+        edit_handler = handlers.message_edited(storage)
+
+        msgs = gen_same_chat_messages(3)
+        chat_id = msgs[0].chat.id
+        for msg in msgs[:2]:
+            pin_handler(Update(msg, None), context)
+        self.assertTrue(storage.is_pinned(chat_id, msgs[0].message_id))
+        self.assertFalse(storage.is_pinned(chat_id, msgs[2].message_id))
+        self.assertFalse(storage.is_pinned(chat_id + 1, msgs[0].message_id))
+
+        # rejected before the message is even parsed
+        with patch.object(handlers, "MessageInfo", side_effect=AssertionError):
+            edit_handler(Update(msgs[2], None, msgs[2]), context)
+        self.assertEqual(len(bot.edited), 1)
+
+        storage.remove(chat_id, msgs[0].message_id)
+        self.assertFalse(storage.is_pinned(chat_id, msgs[0].message_id))
+
+    def test_remove_closest_to_hint(self):
+        storage = self.get_storage()
+
+        msgs = gen_same_chat_messages(3)
+        chat_id = msgs[0].chat.id
+        first, second, third = map(MessageInfo, msgs)
+        # pins are newest first: 0:first 1:second 2:first 3:third 4:first
+        for info in [first, third, first, second, first]:
+            storage.add(chat_id, info)
+
+        def ids() -> List[int]:
+            return [pin.m_id for pin in storage.get(chat_id)]
+
+        # equal distance: the lower index goes first
+        storage.remove(chat_id, first.m_id, 3)
+        self.assertEqual(ids(), [first.m_id, second.m_id, third.m_id, first.m_id])
+        storage.remove(chat_id, first.m_id, 2)
+        self.assertEqual(ids(), [first.m_id, second.m_id, third.m_id])
+        storage.remove(chat_id, second.m_id + 1000, 1)
+        self.assertEqual(ids(), [first.m_id, second.m_id, third.m_id])
+
+        edited = copy(msgs[1])
+        edited.text = "edited"
+        storage.replace_same_id(chat_id, MessageInfo(edited))
+        self.assertEqual(storage.get(chat_id)[1].preview.wrapped, "edited")
+        self.assertEqual(ids(), [first.m_id, second.m_id, third.m_id])
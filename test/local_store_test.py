@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+"""
+
+import handlers
+import os
+import tempfile
+import unittest
+from typing import *
+from local_store import Storage
+from message_info import MessageInfo
+from datetime import datetime, timedelta, timezone
+import durable_log
+from test.message_info_test import in_time_zone
+from test.handlers_test import TestHandlers as LocalTestHandlers
+from test.handlers_test import ( Bot, Context, Update
+                               , gen_message, gen_same_chat_messages
+                               , gen_unpin_data
+                               )
+
+
+class TestLocalStorage(unittest.TestCase):
+
+    def test_order(self):
+        storage = Storage()
+        msgs = gen_same_chat_messages(5)
+        chat_id = msgs[0].chat.id
+        for msg in msgs:
+            storage.add(chat_id, MessageInfo(msg))
+
+        # latest first
+        ids = [pin.m_id for pin in storage.get(chat_id)]
+        self.assertEqual(ids, [msg.message_id for msg in reversed(msgs)])
+
+        storage.clear_keep_last(chat_id)
+        ids = [pin.m_id for pin in storage.get(chat_id)]
+        self.assertEqual(ids, [msgs[-1].message_id])
+
+    def test_max_pins(self):
+        max_pins = 3
+        storage = Storage(max_pins)
+        msgs = gen_same_chat_messages(5)
+        chat_id = msgs[0].chat.id
+        for msg in msgs:
+            storage.add(chat_id, MessageInfo(msg))
+
+        ids = [pin.m_id for pin in storage.get(chat_id)]
+        self.assertEqual(ids, [msg.message_id for msg in reversed(msgs)][:max_pins])
+
+        # dropped pins are not in the index anymore
+        storage.remove(chat_id, msgs[0].message_id)
+        self.assertEqual(len(storage.get(chat_id)), max_pins)
+        storage.remove(chat_id, msgs[-1].message_id)
+        self.assertEqual(len(storage.get(chat_id)), max_pins - 1)
+
+    def test_max_pins_in_post(self):
+        max_pins = 3
+        storage = Storage(max_pins)
+        bot = Bot()
+        context = Context(bot)
+        pin_handler = handlers.pinned(storage)
+
+        msgs = gen_same_chat_messages(5)
+        for msg in msgs:
+            pin_handler(Update(msg, None), context)
+
+        # the post shows exactly what's stored
+        text = bot.edited[-1]["text"]
+        self.assertIn(f"[{max_pins}]", text)
+        self.assertNotIn(f"[{max_pins + 1}]", text)
+
+
+class TestDurableHandlers(LocalTestHandlers):
+    def get_storage(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        storage = Storage(directory=directory.name)
+        self.addCleanup(storage.close)
+        return storage
+
+
+# everything stored for chat, comparable between storages
+def chat_data(storage: Storage, chat_id: int) -> tuple:
+    state = storage.load(chat_id)
+    pins = [(pin.m_id, str(pin.sender), str(pin.preview)) for pin in state.pins]
+    return (pins, state.message_id, state.user_wrote)
+
+
+class TestDurableStorage(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def open(self, **kwargs) -> Storage:
+        return Storage(directory=self.directory.name, **kwargs)
+
+    # pin, unpin and write in several chats. Returns the chat ids
+    def fill(self, storage: Storage) -> List[int]:
+        bot = Bot()
+        context = Context(bot)
+        pin_handler = handlers.pinned(storage)
+        button_handler = handlers.button_pressed(storage)
+        message_handler = handlers.message(storage)
+
+        chat_ids = []
+        for _ in range(3):
+            msgs = gen_same_chat_messages(6)
+            chat_id = msgs[0].chat.id
+            chat_ids.append(chat_id)
+            for msg in msgs:
+                pin_handler(Update(msg, None), context)
+            button_handler(Update(None, gen_unpin_data(msgs[2])), context)
+            user_message = gen_message()
+            user_message.chat.id = chat_id
+            message_handler(Update(user_message, None), context)
+        storage.clear_keep_last(chat_ids[-1])
+        return chat_ids
+
+    def test_restore(self):
+        storage = self.open()
+        chat_ids = self.fill(storage)
+        expected = [chat_data(storage, chat_id) for chat_id in chat_ids]
+        storage.close()
+
+        restored = self.open()
+        self.addCleanup(restored.close)
+        self.assertEqual([chat_data(restored, chat_id) for chat_id in chat_ids]
+                        , expected)
+
+    def test_snapshot(self):
+        storage = self.open(snapshot_every=10)
+        chat_ids = self.fill(storage)
+        expected = [chat_data(storage, chat_id) for chat_id in chat_ids]
+        storage.close()
+
+        files = os.listdir(self.directory.name)
+        self.assertIn(durable_log.SnapshotName, files)
+        # logs before the snapshot are gone
+        generation, _ = durable_log.read_snapshot(self.directory.name)
+        logs = durable_log.log_generations(self.directory.name)
+        self.assertTrue(all(gen >= generation for gen in logs))
+
+        restored = self.open()
+        self.addCleanup(restored.close)
+        self.assertEqual([chat_data(restored, chat_id) for chat_id in chat_ids]
+                        , expected)
+
+    def test_dates_through_snapshots(self):
+        in_time_zone(self, "Asia/Tokyo")
+        msgs = gen_same_chat_messages(3)
+        chat_id = msgs[0].chat.id
+        infos = list(map(MessageInfo, msgs))
+        noon = datetime(2019, 5, 1, 12, tzinfo=timezone.utc)
+        storage = self.open()
+        for days, info in enumerate(infos):
+            info.date = noon + timedelta(days=days)
+            storage.add(chat_id, info)
+        expected = [pin.dumps() for pin in storage.get(chat_id)]
+
+        # restored pins are written to the next snapshot again
+        for _ in range(3):
+            storage.snapshot()
+            storage.close()
+            storage = self.open()
+            self.assertEqual([pin.dumps() for pin in storage.get(chat_id)], expected)
+        storage.close()
+        self.assertEqual(storage.get(chat_id)[-1].date, noon)
+
+    def test_flag_without_message_id(self):
+        storage = self.open()
+        storage.set_message_id(1, 10)
+        storage.remove_message_id(1)
+        storage.snapshot()
+        storage.close()
+
+        restored = self.open()
+        self.addCleanup(restored.close)
+        self.assertFalse(restored.has_message_id(1))
+        self.assertFalse(restored.did_user_message(1))
+
+    def test_broken_tail(self):
+        storage = self.open()
+        chat_ids = self.fill(storage)
+        expected = [chat_data(storage, chat_id) for chat_id in chat_ids]
+        last_log = durable_log.log_path(self.directory.name
+                                       ,durable_log.log_generations(self.directory.name)[-1])
+        storage.close()
+
+        # a record that was being written during a crash
+        with open(last_log, "ab") as file:
+            file.write(durable_log.frame(b"\x01" * 40)[:-5])
+
+        restored = self.open()
+        self.addCleanup(restored.close)
+        self.assertEqual([chat_data(restored, chat_id) for chat_id in chat_ids]
+                        , expected)
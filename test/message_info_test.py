@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+"""
+
+import os
+import time
+import unittest
+from typing import *
+from datetime import datetime, timedelta, timezone
+from random import choice, randint, random
+from message_info import Escaped, MaxLength, MessageInfo, gather_links, is_link
+from message_info import unix_time
+from test.handlers_test import Entity, gen_message
+
+
+# the old implementation of gather_links, to compare with
+
+def link_text(entity, all_text: str) -> Escaped:
+    start: int = entity.offset
+    end: int = start + entity.length
+    return Escaped(all_text[start : end])
+def make_link(href: Escaped, body: Escaped) -> Escaped:
+    return Escaped.from_escaped(f'<a href="{href}">{body}</a>')
+
+class MessagePart(NamedTuple):
+    text_repr: Escaped
+    repr_length: int
+    start: int
+
+def old_gather_links(entities, text: str) -> Escaped:
+    ent_parts: List[MessagePart] = []
+    for ent in entities:
+        if ent.url:
+            body = link_text(ent, text)
+            url = Escaped(ent.url)
+            part = MessagePart( text_repr = make_link(url, body)
+                              , repr_length = len(body.wrapped)
+                              , start = ent.offset
+                              )
+            ent_parts.append(part)
+        elif is_link(ent):
+            href = link_text(ent, text)
+            part = MessagePart( text_repr = make_link(href, href)
+                              , repr_length = len(href.wrapped)
+                              , start = ent.offset
+                              )
+            ent_parts.append(part)
+        else:
+            continue
+    ent_parts.sort(key = lambda x: x.start)
+    result = ""
+    cur_start = 0
+    too_long = False
+    for ent in ent_parts:
+        if not too_long:
+            cur_text = text[cur_start : ent.start]
+            result += cur_text
+            if len(result) > MaxLength:
+                result = result[:MaxLength].strip() + "...\n"
+                too_long = True
+            result += ent.text_repr.wrapped
+            if len(result) > MaxLength:
+                result = result.strip()
+                too_long = True
+            cur_start = ent.start + ent.repr_length
+        else:
+            result += "\n" + ent.text_repr.wrapped
+    if len(result) <= MaxLength:
+        cur_text = text[cur_start:]
+        result += Escaped(cur_text).wrapped
+        if len(result) + len(cur_text) > MaxLength:
+            result = result[:MaxLength].strip() + "..."
+    return Escaped.from_escaped(result)
+
+
+# Text with entities that don't overlap, some of them links
+def gen_entities(max_length: int) -> Tuple[str, List[Entity]]:
+    pieces = ["word", "  ", " ", "\n", "<b>", "&", "'quote'", "é", "💡", "a" * 40]
+    links = ["github.com", "https://kde.org/", "x.io/?a=1&b=<2>", "  spaced.org  "]
+    text = ""
+    entities = []
+    while len(text) < max_length:
+        if random() < 0.3:
+            link = choice(links)
+            entity = Entity(len(text), len(link))
+            entity.type = choice(["url", "url", "text_link", "bold", "mention"])
+            if random() < 0.3:
+                entity.url = choice(["https://a.b/", "https://c.d/?e=\"f\""])
+            entities.append(entity)
+            text += link
+        else:
+            text += choice(pieces) * randint(1, 3)
+    if random() < 0.2:
+        entities.reverse()
+    return (text, entities)
+
+
+# second is loaded from a dump of first
+def same_info(first: MessageInfo, second: MessageInfo) -> bool:
+    # dates are stored with precision of seconds
+    return ( first.m_id == second.m_id
+         and first.kind == second.kind
+         and first.link == second.link
+         and first.sender.wrapped == second.sender.wrapped
+         and first.icon == second.icon
+         and first.preview.wrapped == second.preview.wrapped
+         and unix_time(first.date) == unix_time(second.date)
+         and second.date.tzinfo == timezone.utc
+           )
+
+# local time is in zone name until the end of test
+def in_time_zone(test: unittest.TestCase, name: str) -> None:
+    old = os.environ.get("TZ")
+    def restore():
+        if old is None:
+            del os.environ["TZ"]
+        else:
+            os.environ["TZ"] = old
+        time.tzset()
+    os.environ["TZ"] = name
+    time.tzset()
+    test.addCleanup(restore)
+
+
+
+class TestMessageInfo(unittest.TestCase):
+
+    # pairs of chat id and message info
+    def gen_infos(self) -> List[Tuple[int, MessageInfo]]:
+        plain = gen_message()
+        plain.chat.id = -1001234567890
+        plain.from_user.last_name = "<Ünïcode & 💡>"
+        plain.text = "four score and twenty years ago"
+
+        link = gen_message()
+        link.text = "see github.com, it's good"
+        link.entities = [Entity(4, len("github.com"))]
+
+        return [(msg.chat_id, MessageInfo(msg)) for msg in [plain, link]]
+
+    def test_binary_round_trip(self):
+        for chat_id, msg in self.gen_infos():
+            loaded = MessageInfo.loads(msg.dumps(), chat_id)
+            self.assertTrue(same_info(msg, loaded))
+
+    def test_json_still_loads(self):
+        for chat_id, msg in self.gen_infos():
+            dump = msg.dumps_json()
+            self.assertTrue(MessageInfo.is_json(dump))
+            self.assertTrue(same_info(msg, MessageInfo.loads(dump, chat_id)))
+            self.assertTrue(same_info(msg, MessageInfo.loads(dump.encode(), chat_id)))
+
+    def test_dates_in_other_zone(self):
+        in_time_zone(self, "Asia/Tokyo")
+        noon = datetime(2019, 5, 1, 12, tzinfo=timezone.utc)
+        for chat_id, msg in self.gen_infos():
+            # telegram gives dates in UTC, tests make naive ones
+            for date in [noon, noon.replace(tzinfo=None)
+                        , noon.astimezone(timezone(timedelta(hours=-5)))]:
+                msg.date = date
+                loaded = MessageInfo.loads(msg.dumps(), chat_id)
+                self.assertEqual(loaded.date, noon)
+                again = MessageInfo.loads(loaded.dumps(), chat_id)
+                self.assertEqual(again.dumps(), msg.dumps())
+                loaded = MessageInfo.loads(msg.dumps_json(), chat_id)
+                again = MessageInfo.loads(loaded.dumps_json(), chat_id)
+                self.assertEqual(again.date, noon)
+
+    def test_json_without_chat(self):
+        for chat_id, msg in self.gen_infos():
+            loaded = MessageInfo.loads_json(msg.dumps_json())
+            self.assertTrue(same_info(msg, loaded))
+
+    def test_compact(self):
+        chat_id, msg = self.gen_infos()[0]
+        first = MessageInfo.loads(msg.dumps(), chat_id)
+        second = MessageInfo.loads(msg.dumps(), chat_id)
+        self.assertFalse(hasattr(first, "__dict__"))
+        self.assertFalse(hasattr(first.sender, "__dict__"))
+        # pins of one sender share the name
+        self.assertIs(first.sender.wrapped, second.sender.wrapped)
+
+    def test_binary_is_smaller(self):
+        for chat_id, msg in self.gen_infos():
+            self.assertFalse(MessageInfo.is_json(msg.dumps()))
+            self.assertLess(len(msg.dumps()), len(msg.dumps_json().encode()) / 2)
+
+    def test_links_same_as_before(self):
+        for _ in range(3000):
+            text, entities = gen_entities(choice([20, 200, 400, 2000]))
+            self.assertEqual( gather_links(entities, text).wrapped
+                            , old_gather_links(entities, text).wrapped
+                            , (text, [(e.offset, e.length, e.type, e.url) for e in entities])
+                            )
+
+    def test_kind_and_preview(self):
+        link = gen_message()
+        link.text = "see github.com, it's good"
+        link.entities = [Entity(4, len("github.com"))]
+        info = MessageInfo(link)
+        self.assertEqual(info.kind, MessageInfo.gen_kind(link))
+        self.assertEqual(info.preview.wrapped, 'see <a href="github.com">github.com</a>, it&#x27;s good')
+
+    def test_unknown_version(self):
+        chat_id, msg = self.gen_infos()[0]
+        dump = bytearray(msg.dumps())
+        dump[0] = 200
+        self.assertRaises(ValueError, MessageInfo.loads, bytes(dump), 0)
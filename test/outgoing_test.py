@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+"""
+
+import handlers
+import unittest
+from concurrent.futures import Future
+from threading import Event, Lock
+from time import monotonic, sleep
+from typing import *
+from unittest.mock import patch
+from telegram.error import RetryAfter # type: ignore
+from outgoing import Limits, Outbox, OutboxFull, Priority, TokenBucket
+from test.handlers_test import TestHandlers, Bot, Context, Update, gen_unpin_data
+from test.handlers_test import gen_same_chat_messages
+from local_store import Storage
+from fingerprint import RenderedPosts
+
+
+# limits that don't slow tests down
+Fast = Limits(global_rate=10000, global_burst=10000, chat_rate=10000, chat_burst=10000)
+
+
+class TestTokenBucket(unittest.TestCase):
+    def test_rate(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        now = monotonic()
+        for _ in range(2):
+            self.assertEqual(bucket.wait_time(now), 0)
+            bucket.take()
+        self.assertAlmostEqual(bucket.wait_time(now), 0.1)
+        self.assertEqual(bucket.wait_time(now + 0.1), 0)
+
+    def test_pause(self):
+        bucket = TokenBucket(rate=10, burst=2)
+        now = monotonic()
+        bucket.pause(now + 1)
+        self.assertAlmostEqual(bucket.wait_time(now), 1)
+        self.assertAlmostEqual(bucket.wait_time(now + 1), 0.1)
+
+
+class TestOutbox(unittest.TestCase):
+    def test_no_limits(self):
+        outbox = Outbox()
+        self.assertEqual(outbox.call(1, lambda x: x + 1, 1), 2)
+        self.assertEqual(outbox.stats()["submitted"], 0)
+
+    def test_priority(self):
+        outbox = Outbox(Fast._replace(workers=1))
+        order = []
+        # holds the only worker while everything else is queued
+        release = Event()
+        outbox.submit(1, release.wait)
+        futures = [ outbox.submit(1, order.append, "background", priority=Priority.Background)
+                  , outbox.submit(1, order.append, "normal")
+                  , outbox.submit(1, order.append, "interactive", priority=Priority.Interactive)
+                  ]
+        release.set()
+        for future in futures:
+            future.result()
+        self.assertEqual(order, ["interactive", "normal", "background"])
+
+    def test_chat_limit(self):
+        outbox = Outbox(Fast._replace(chat_rate=20, chat_burst=1))
+        start = monotonic()
+        futures = [outbox.submit(1, lambda: None) for _ in range(5)]
+        # other chats and unlimited requests don't wait for chat 1
+        outbox.call(2, lambda: None)
+        outbox.call(1, lambda: None, limited=False)
+        self.assertLess(monotonic() - start, 0.1)
+        for future in futures:
+            future.result()
+        self.assertGreaterEqual(monotonic() - start, 0.2)
+
+    def test_retry_after(self):
+        outbox = Outbox(Fast)
+        calls = []
+        def flooded():
+            calls.append(monotonic())
+            if len(calls) == 1:
+                raise RetryAfter(0.05)
+            return "sent"
+        self.assertEqual(outbox.call(1, flooded), "sent")
+        self.assertEqual(len(calls), 2)
+        self.assertGreaterEqual(calls[1] - calls[0], 0.05)
+        self.assertEqual(outbox.stats()["retried"], 1)
+
+    def test_retry_after_pauses_all(self):
+        outbox = Outbox(Fast)
+        calls = []
+        def flooded():
+            calls.append(monotonic())
+            if len(calls) == 1:
+                raise RetryAfter(0.1)
+        first = outbox.submit(1, flooded)
+        while calls == []:
+            sleep(0.001)
+        # requests to other chats wait too
+        outbox.call(2, lambda: calls.append(monotonic()))
+        first.result()
+        self.assertGreaterEqual(calls[1] - calls[0], 0.1)
+
+    def test_chat_in_order(self):
+        outbox = Outbox(Fast)
+        order = []
+        running = []
+        lock = Lock()
+        def request(number):
+            with lock:
+                running.append(number)
+                overlap = len(running) > 1
+            sleep(0.001)
+            with lock:
+                running.remove(number)
+            order.append((number, overlap))
+        futures = [outbox.submit(1, request, number) for number in range(20)]
+        for future in futures:
+            future.result()
+        self.assertEqual(order, [(number, False) for number in range(20)])
+
+    def test_join(self):
+        outbox = Outbox(Fast._replace(chat_rate=20, chat_burst=1))
+        done = []
+        for _ in range(3):
+            outbox.submit(1, lambda: done.append(1))
+        self.assertTrue(outbox.join(timeout=5))
+        self.assertEqual(len(done), 3)
+        self.assertTrue(Outbox().join())
+
+    def test_retries_end(self):
+        outbox = Outbox(Fast._replace(retries=1))
+        def flooded():
+            raise RetryAfter(0.01)
+        with self.assertRaises(RetryAfter):
+            outbox.call(1, flooded)
+        self.assertEqual(outbox.stats()["failed"], 1)
+
+    def test_full(self):
+        outbox = Outbox(Fast._replace(queue_size=1, put_timeout=0.05, chat_rate=0.01, chat_burst=1))
+        outbox.call(1, lambda: None)
+        # the chat has to wait 100 seconds now
+        outbox.submit(1, lambda: None)
+        with self.assertRaises(OutboxFull):
+            outbox.submit(1, lambda: None)
+        self.assertEqual(outbox.stats()["rejected"], 1)
+        self.assertEqual(outbox.stats()["max_depth"], 1)
+
+    def test_from_env(self):
+        limits = Limits.from_env({"OUTBOX_CHAT_RATE" : "0.5", "OUTBOX_WORKERS" : "2"})
+        self.assertEqual(limits.chat_rate, 0.5)
+        self.assertEqual(limits.workers, 2)
+        self.assertEqual(limits.global_rate, Limits().global_rate)
+
+
+class TestQueuedBot(unittest.TestCase):
+    def test_no_wait(self):
+        outbox = Outbox(Fast._replace(workers=1))
+        bot = outbox.bot(Bot())
+        release = Event()
+        outbox.submit(1, release.wait)
+        # edits don't wait for the queue, their failures are only printed
+        edited = bot.edit_message_reply_markup(chat_id=1, message_id=10, reply_markup=None)
+        self.assertIsInstance(edited, Future)
+        self.assertFalse(edited.done())
+        release.set()
+        with patch("traceback.print_exception") as printed:
+            self.assertIsInstance(edited.exception(), AssertionError)
+            outbox.join()
+        printed.assert_called_once()
+        # sent message is needed, and is waited for
+        sent = bot.send_message(1, "text", "HTML", None)
+        self.assertEqual(sent.message_id, bot._bot.sent[0]["m_id"])
+
+    def test_handler_doesnt_wait(self):
+        outbox = Outbox(Fast._replace(chat_rate=1, chat_burst=2))
+        storage = Storage()
+        bot = Bot()
+        pin_handler = handlers.pinned(storage)
+        msgs = gen_same_chat_messages(2)
+        with patch.object(handlers, "outbox", outbox):
+            # sending and pinning take the burst
+            pin_handler(Update(msgs[0], None), Context(bot))
+            start = monotonic()
+            pin_handler(Update(msgs[1], None), Context(bot))
+            self.assertLess(monotonic() - start, 0.5)
+            self.assertEqual(bot.edited, [])
+            self.assertTrue(outbox.join(timeout=5))
+        self.assertEqual(len(bot.edited), 1)
+        self.assertEqual(len(bot.pinned), 2)
+
+    def test_failed_edit_forgotten(self):
+        outbox = Outbox(Fast)
+        storage = Storage()
+        bot = Bot()
+        posts = RenderedPosts()
+        msgs = gen_same_chat_messages(2)
+        with patch.object(handlers, "outbox", outbox), \
+             patch.object(handlers, "rendered_posts", posts), \
+             patch("traceback.print_exception"):
+            handlers.pinned(storage)(Update(msgs[0], None), Context(bot))
+            outbox.join()
+            # the post is gone, and editing it fails
+            bot.sent.clear()
+            handlers.pinned(storage)(Update(msgs[1], None), Context(bot))
+            outbox.join()
+        self.assertEqual(posts.stats()["posts"], 0)
+
+
+class TestQueuedHandlers(TestHandlers):
+    def setUp(self):
+        self.outbox = Outbox(Fast)
+        replacing = patch.object(handlers, "outbox", self.outbox)
+        replacing.start()
+        self.addCleanup(replacing.stop)
+        # edits are not waited for, and tests look at them after handlers
+        for name in ["pinned", "button_pressed", "message_edited", "message"]:
+            replacing = patch.object(handlers, name, self.joined(getattr(handlers, name)))
+            replacing.start()
+            self.addCleanup(replacing.stop)
+
+    # curried handler that returns when the outbox made its requests
+    def joined(self, curried):
+        def with_storage(storage):
+            handler = curried(storage)
+            def joined_handler(*args, **kwargs):
+                handler(*args, **kwargs)
+                self.assertTrue(self.outbox.join(timeout=5))
+            return joined_handler
+        return with_storage
+
+    def test_all_queued(self):
+        storage = self.get_storage()
+        bot = Bot()
+        context = Context(bot)
+        pin_handler = handlers.pinned(storage)
+        button_handler = handlers.button_pressed(storage)
+
+        msgs = gen_same_chat_messages(3)
+        for msg in msgs:
+            pin_handler(Update(msg, None), context)
+        button_handler(Update(None, gen_unpin_data(msgs[0])), context)
+        # send and pin, edit and pin for each other pin, then answer, check
+        # permissions and edit
+        self.assertEqual(self.outbox.stats()["sent"], 2 + 2 * 2 + 1 + 2 + 1)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+"""
+
+import handlers
+import unittest
+from time import sleep
+from typing import *
+from unittest.mock import patch
+from permissions import Permissions, TtlCache
+from local_store import Storage
+from test.handlers_test import ( Bot, Context, Update
+                               , gen_same_chat_messages, gen_unpin_data
+                               )
+
+
+class CountingBot(Bot):
+    def __init__(self):
+        super().__init__()
+        self.asked = 0
+    def get_chat(self, chat_id):
+        self.asked += 1
+        return super().get_chat(chat_id)
+    def get_chat_member(self, chat_id, user_id):
+        self.asked += 1
+        return super().get_chat_member(chat_id, user_id)
+
+
+class MembersMessage:
+    def __init__(self, chat_id, joined, left) -> None:
+        self.chat_id = chat_id
+        self.new_chat_members = joined
+        self.left_chat_member = left
+
+
+class TestTtlCache(unittest.TestCase):
+    def test_ttl(self):
+        cache = TtlCache(ttl=0.05, size=10)
+        loads = []
+        load = lambda: loads.append(1) or len(loads)
+        self.assertEqual(cache.get("key", load), 1)
+        self.assertEqual(cache.get("key", load), 1)
+        sleep(0.05)
+        self.assertEqual(cache.get("key", load), 2)
+        self.assertEqual(cache.stats()["hits"], 1)
+        self.assertEqual(cache.stats()["misses"], 2)
+
+    def test_size(self):
+        cache = TtlCache(ttl=60, size=2)
+        for key in [1, 2, 1, 3]:
+            cache.get(key, lambda: key)
+        # 2 was used least recently
+        self.assertEqual(cache.get(1, lambda: "again"), 1)
+        self.assertEqual(cache.get(3, lambda: "again"), 3)
+        self.assertEqual(cache.get(2, lambda: "again"), "again")
+
+    def test_errors_not_cached(self):
+        cache = TtlCache(ttl=60, size=2)
+        def fail():
+            raise ValueError()
+        with self.assertRaises(ValueError):
+            cache.get(1, fail)
+        self.assertEqual(cache.get(1, lambda: 1), 1)
+
+    def test_invalidate(self):
+        cache = TtlCache(ttl=60, size=2)
+        cache.get(1, lambda: 1)
+        cache.invalidate(1)
+        self.assertEqual(cache.get(1, lambda: "again"), "again")
+
+
+class TestCachedPermissions(unittest.TestCase):
+    def setUp(self):
+        replacing = patch.object(handlers, "permissions", Permissions())
+        replacing.start()
+        self.addCleanup(replacing.stop)
+
+    def test_presses_ask_once(self):
+        storage = Storage()
+        bot = CountingBot()
+        context = Context(bot)
+        pin_handler = handlers.pinned(storage)
+        button_handler = handlers.button_pressed(storage)
+
+        msgs = gen_same_chat_messages(4)
+        for msg in msgs:
+            pin_handler(Update(msg, None), context)
+        for msg in msgs[:2]:
+            button_handler(Update(None, gen_unpin_data(msg)), context)
+        self.assertEqual(bot.asked, 2)
+        self.assertEqual(len(storage.get(msgs[0].chat.id)), 2)
+
+        # the user left and came back
+        user = msgs[0].from_user
+        joined = Update(MembersMessage(msgs[0].chat.id, [user], None), None)
+        handlers.members_changed(joined, context)
+        button_handler(Update(None, gen_unpin_data(msgs[2])), context)
+        self.assertEqual(bot.asked, 3)
+
+    def test_expand_not_checked(self):
+        storage = Storage()
+        bot = CountingBot()
+        context = Context(bot)
+        pin_handler = handlers.pinned(storage)
+        button_handler = handlers.button_pressed(storage)
+
+        msgs = gen_same_chat_messages(3)
+        for msg in msgs:
+            pin_handler(Update(msg, None), context)
+        for data in [handlers.ButtonsExpand, handlers.ButtonsCollapse]:
+            button_handler(Update(None, Update.CbQuery(msgs[0], data)), context)
+        self.assertEqual(bot.asked, 0)
+        self.assertEqual(len(bot.markup_edited), 2)
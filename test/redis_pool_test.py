@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+Description: failure handling of remote storage. Doesn't need a running redis
+"""
+
+import handlers
+import unittest
+from typing import *
+from time import monotonic
+from redis.exceptions import ConnectionError
+from redis_pool import PoolConfig, call_with_retries
+from remote_store import Storage
+from storage_error import StorageError
+from test.handlers_test import Bot, Context, Update, gen_message
+
+
+# nothing listens on this port
+UnusedPort = 1
+FastConfig = PoolConfig( wait_timeout = 0.1, socket_timeout = 0.1
+                       , socket_connect_timeout = 0.1
+                       , retries = 2, backoff_base = 0.01, backoff_max = 0.02
+                       )
+
+
+class TestRedisPool(unittest.TestCase):
+
+    def test_config_from_env(self):
+        env = { "REDIS_POOL_SIZE" : "3"
+              , "REDIS_POOL_SOCKET_TIMEOUT" : "0.5"
+              , "REDIS_ADDR" : "localhost"
+              }
+        config = PoolConfig.from_env(env)
+        self.assertEqual(config.size, 3)
+        self.assertEqual(config.socket_timeout, 0.5)
+        self.assertEqual(config.retries, PoolConfig().retries)
+
+    def test_retries(self):
+        calls = []
+        def failing() -> None:
+            calls.append(())
+            raise ConnectionError("down")
+
+        self.assertRaises(StorageError, call_with_retries, FastConfig, failing)
+        self.assertEqual(len(calls), FastConfig.retries + 1)
+
+        calls.clear()
+        self.assertRaises(StorageError, call_with_retries, FastConfig, failing,
+                          False)
+        self.assertEqual(len(calls), 1)
+
+        # success after a failure
+        def flaky() -> int:
+            calls.append(())
+            if len(calls) == 1:
+                raise ConnectionError("down")
+            return 5
+        calls.clear()
+        self.assertEqual(call_with_retries(FastConfig, flaky), 5)
+
+    def test_fails_fast(self):
+        storage = Storage(addr="localhost", port=UnusedPort
+                         ,pool_config=FastConfig)
+        start = monotonic()
+        self.assertRaises(StorageError, storage.has, 1)
+        self.assertRaises(StorageError, storage.load, 1)
+        self.assertLess(monotonic() - start, 2)
+        self.assertEqual(storage.pool_stats()["in_use"], 0)
+
+    def test_handlers_drop_updates(self):
+        storage = Storage(addr="localhost", port=UnusedPort
+                         ,pool_config=FastConfig)
+        bot = Bot()
+        context = Context(bot)
+        msg = gen_message()
+
+        handlers.pinned(storage)(Update(msg, None), context)
+        handlers.message(storage)(Update(msg, None), context)
+        self.assertEqual(bot.sent, [])
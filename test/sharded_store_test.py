@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+Description: same as handlers test, but uses storage sharded over several
+local storages
+"""
+
+import unittest
+from collections import Counter
+from typing import *
+from local_store import Storage as LocalStorage
+from message_info import MessageInfo
+from sharded_store import HashRing, Storage
+from rebalance import rebalance
+import handlers
+
+from test.handlers_test import TestHandlers as LocalTestHandlers
+from test.handlers_test import ( Bot, Context, Update
+                               , gen_message, gen_same_chat_messages
+                               )
+
+
+def local_shards(names: Iterable[str]) -> Dict[str, LocalStorage]:
+    return {name: LocalStorage() for name in names}
+
+# everything stored for chat, comparable between storages
+def chat_data(storage, chat_id: int) -> tuple:
+    state = storage.load(chat_id)
+    pins = [(pin.m_id, str(pin.sender)) for pin in state.pins]
+    return (pins, state.message_id, state.user_wrote)
+
+
+class TestHandlers(LocalTestHandlers):
+    def get_storage(self):
+        return Storage(local_shards(["a", "b", "c"]))
+
+
+class TestHashRing(unittest.TestCase):
+    def test_spread(self):
+        ring = HashRing(["a", "b", "c", "d"])
+        counts = Counter(ring.node(chat_id) for chat_id in range(-40000, 0))
+        self.assertEqual(set(counts), {"a", "b", "c", "d"})
+        for count in counts.values():
+            self.assertLess(abs(count - 10000), 2000)
+
+    def test_added_node_takes_little(self):
+        old = HashRing(["a", "b", "c"])
+        new = HashRing(["a", "b", "c", "d"])
+        chats = range(-10000, 0)
+        changed = [chat_id for chat_id in chats if old.node(chat_id) != new.node(chat_id)]
+        # only to the new node, and about a quarter
+        self.assertTrue(all(new.node(chat_id) == "d" for chat_id in changed))
+        self.assertLess(len(changed), len(chats) / 3)
+
+
+class TestRebalance(unittest.TestCase):
+    # pin and write in many chats. Returns the chat ids
+    def fill(self, storage) -> List[int]:
+        bot = Bot()
+        context = Context(bot)
+        pin_handler = handlers.pinned(storage)
+        message_handler = handlers.message(storage)
+        chat_ids = []
+        for _ in range(50):
+            msgs = gen_same_chat_messages(3)
+            chat_id = msgs[0].chat.id
+            chat_ids.append(chat_id)
+            for msg in msgs:
+                pin_handler(Update(msg, None), context)
+            if chat_id % 2 == 0:
+                user_message = gen_message()
+                user_message.chat.id = chat_id
+                message_handler(Update(user_message, None), context)
+        return chat_ids
+
+    def assert_placed(self, storage: Storage) -> None:
+        for name, shard in storage.shards.items():
+            for chat_id in shard.chats():
+                self.assertEqual(storage.shard_name(chat_id), name)
+
+    def test_add_node(self):
+        shards = local_shards(["a", "b", "c"])
+        storage = Storage(shards)
+        chat_ids = self.fill(storage)
+        expected = [chat_data(storage, chat_id) for chat_id in chat_ids]
+
+        grown = Storage(dict(shards, d=LocalStorage()))
+        moved = rebalance(grown)
+        self.assertGreater(moved, 0)
+        self.assertLess(moved, len(chat_ids))
+        self.assert_placed(grown)
+        self.assertEqual([chat_data(grown, chat_id) for chat_id in chat_ids]
+                        , expected)
+        # nothing left to move
+        self.assertEqual(rebalance(grown), 0)
+
+    def test_remove_node(self):
+        shards = local_shards(["a", "b", "c"])
+        storage = Storage(shards)
+        chat_ids = self.fill(storage)
+        expected = [chat_data(storage, chat_id) for chat_id in chat_ids]
+
+        shrunk = Storage({"a": shards["a"], "b": shards["b"]})
+        rebalance(shrunk, {"c": shards["c"]})
+        self.assertEqual(list(shards["c"].chats()), [])
+        self.assert_placed(shrunk)
+        self.assertEqual([chat_data(shrunk, chat_id) for chat_id in chat_ids]
+                        , expected)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+Description: same as handlers test, but uses sqlite storage
+"""
+
+import os
+import tempfile
+import unittest
+from random import choice, randint
+from typing import *
+from sql_store import Storage
+from local_store import Storage as LocalStorage
+from message_info import MessageInfo
+
+from test.handlers_test import TestHandlers as LocalTestHandlers
+from test.handlers_test import gen_same_chat_messages
+
+
+class TestHandlers(LocalTestHandlers):
+    def get_storage(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        storage = Storage(os.path.join(directory.name, "pins.sqlite3"))
+        self.addCleanup(storage.close)
+        return storage
+
+    def test_matches_local(self):
+        storage = self.get_storage()
+        local = LocalStorage()
+        msgs = gen_same_chat_messages(10)
+        chat_id = msgs[0].chat.id
+        infos = [MessageInfo(msg) for msg in msgs]
+
+        def ids(storage) -> List[int]:
+            return [pin.m_id for pin in storage.load(chat_id).pins]
+
+        # same messages pinned many times, so that remove has to use hint
+        for _ in range(200):
+            action = randint(0, 9)
+            if action < 5:
+                info = choice(infos)
+                storage.add(chat_id, info)
+                local.add(chat_id, info)
+            elif action < 9:
+                m_id = choice(infos).m_id
+                hint = randint(0, 10)
+                storage.remove(chat_id, m_id, hint)
+                local.remove(chat_id, m_id, hint)
+            else:
+                storage.clear_keep_last(chat_id)
+                local.clear_keep_last(chat_id)
+            self.assertEqual(ids(storage), ids(local))
+
+    def test_max_pins(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        storage = Storage(os.path.join(directory.name, "pins.sqlite3"), 3)
+        self.addCleanup(storage.close)
+        msgs = gen_same_chat_messages(5)
+        chat_id = msgs[0].chat.id
+        for msg in msgs:
+            storage.add(chat_id, MessageInfo(msg))
+
+        ids = [pin.m_id for pin in storage.get(chat_id)]
+        self.assertEqual(ids, [msg.message_id for msg in reversed(msgs)][:3])
+
+    def test_persists(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, "pins.sqlite3")
+        storage = Storage(path)
+        msgs = gen_same_chat_messages(3)
+        chat_id = msgs[0].chat.id
+        for msg in msgs:
+            storage.add(chat_id, MessageInfo(msg))
+        storage.set_message_id(chat_id, 42)
+        storage.close()
+
+        storage = Storage(path)
+        self.addCleanup(storage.close)
+        state = storage.load(chat_id)
+        self.assertEqual([pin.m_id for pin in state.pins]
+                        ,[msg.message_id for msg in reversed(msgs)])
+        self.assertEqual(state.message_id, 42)
+        self.assertFalse(state.user_wrote)
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+"""
+
+import unittest
+from copy import copy
+from datetime import timedelta, timezone
+from html import escape
+from typing import *
+from message_info import Escaped, MessageInfo
+from message_kind import Kind
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup # type: ignore
+from view_post import ButtonsStatus, best_split, pins_post, pins_text, single_pin
+import control
+
+from test.handlers_test import gen_message, gen_same_chat_messages
+
+
+# the old implementation, to compare output with
+
+def old_single_pin(msg_info: MessageInfo, index) -> str:
+    lines: List[str] = []
+    head_icon = "📌"
+
+    preview_line = ""
+    visual_kind = msg_info.kind in [Kind.Photo, Kind.File]
+    if len(msg_info.preview.wrapped) == 0 or visual_kind:
+        preview_line += f"{msg_info.icon} "
+    preview_line += msg_info.preview.wrapped
+    lines += [preview_line]
+
+    time_str = msg_info.date.strftime("%Y-%m-%d")
+    weekday = msg_info.date.strftime("%a")
+    header_line =  f'<a href="{msg_info.link}">'
+    header_line += f"{head_icon} "
+    header_line += f"[{index}] {time_str}"
+    header_line += "</a>"
+    header_line += "<i>"
+    header_line += f" - {escape(msg_info.sender.wrapped)}, {weekday}"
+    header_line += "</i>"
+    lines += [header_line]
+
+    return "\n".join(lines)
+
+def old_pins_text(pins) -> str:
+    return "\n\n".join(old_single_pin(pin, i + 1) for i, pin in enumerate(pins))
+
+
+def old_pins_markup(pins, button_status: ButtonsStatus) -> InlineKeyboardMarkup:
+    button_all = InlineKeyboardButton(
+        "❌ Unpin all", callback_data=control.UnpinAll)
+    button_keep_last = InlineKeyboardButton(
+        "Keep last 🔺", callback_data=control.KeepLast)
+    button_expand = InlineKeyboardButton(
+        "➕ Edit", callback_data=control.ButtonsExpand)
+    button_collapse = InlineKeyboardButton(
+        "➖ Close", callback_data=control.ButtonsCollapse)
+
+    if len(pins) == 1:
+        return InlineKeyboardMarkup([[button_all]])
+    if button_status == ButtonsStatus.Collapsed:
+        return InlineKeyboardMarkup([[button_expand]])
+
+    layout = [[button_collapse], [button_all, button_keep_last]]
+    def on_button(msg, index) -> str:
+        return f"{index + 1} {msg.icon}"
+    cb_data = control.unpin_message_data
+    texts = (on_button(msg, index) for index, msg in enumerate(pins))
+    cb_datas = (cb_data(msg, index) for index, msg in enumerate(pins))
+    buttons = [InlineKeyboardButton(text, callback_data=data)
+                for text, data in zip(texts, cb_datas)]
+    on_one_line = best_split(len(buttons))
+    rows = [buttons[i:i+on_one_line] for i in range(0, len(buttons), on_one_line)]
+    layout += rows
+    return InlineKeyboardMarkup(layout)
+
+
+def gen_pins(amount: int) -> List[MessageInfo]:
+    pins = [MessageInfo(msg) for msg in gen_same_chat_messages(amount)]
+    kinds = list(Kind)
+    for index, pin in enumerate(pins):
+        pin.kind = kinds[index % len(kinds)]
+        if index % 3 == 0:
+            pin.preview = Escaped("")
+        if index % 4 == 0:
+            pin.sender = Escaped("<b>&amp; 'friends'</b>")
+    return pins
+
+
+class TestPinsPost(unittest.TestCase):
+    def test_same_as_before(self):
+        self.assertEqual(pins_text([]), old_pins_text([]))
+        for amount in [1, 2, 7, 60]:
+            pins = gen_pins(amount)
+            for status in ButtonsStatus:
+                text, _ = pins_post(pins, 1, status)
+                self.assertEqual(text, old_pins_text(pins))
+
+    def test_markup_same_as_before(self):
+        for amount in [1, 2, 4, 5, 6, 7, 11, 13, 60]:
+            pins = gen_pins(amount)
+            for status in ButtonsStatus:
+                _, markup = pins_post(pins, 1, status)
+                expected = old_pins_markup(pins, status)
+                self.assertEqual(markup.to_json(), expected.to_json())
+                # the second time comes from cache
+                _, markup = pins_post(pins, 1, status)
+                self.assertEqual(markup.to_json(), expected.to_json())
+
+    def test_pin_buttons_shared(self):
+        pins = gen_pins(6)
+        _, first = pins_post(pins, 1, ButtonsStatus.Expanded)
+        _, second = pins_post(pins, 1, ButtonsStatus.Expanded)
+        self.assertIs(first.inline_keyboard[2][0], second.inline_keyboard[2][0])
+        # the same pin in another place has another button
+        _, moved = pins_post(pins[1:], 1, ButtonsStatus.Expanded)
+        self.assertEqual(moved.inline_keyboard[2][0].callback_data
+                        , control.unpin_message_data(pins[1], 0))
+
+    def test_indices_move(self):
+        pins = gen_pins(5)
+        pins_post(pins, 1)
+        # a pin added to the front moves the others
+        new = MessageInfo(gen_message())
+        text, _ = pins_post([new] + pins, 1)
+        self.assertEqual(text, old_pins_text([new] + pins))
+
+    def test_changed_pin(self):
+        pin = gen_pins(1)[0]
+        before = single_pin(pin, 1)
+        edited = copy(pin)
+        edited.preview = Escaped("edited text")
+        self.assertNotEqual(single_pin(edited, 1), before)
+        self.assertEqual(single_pin(edited, 3), old_single_pin(edited, 3))
+
+    def test_time_zones(self):
+        pin = gen_pins(1)[0]
+        pin.date = pin.date.replace(hour=23, tzinfo=timezone.utc)
+        moved = copy(pin)
+        moved.date = pin.date.astimezone(timezone(timedelta(hours=3)))
+        self.assertEqual(pin.date, moved.date)
+        self.assertEqual(single_pin(pin, 1), old_single_pin(pin, 1))
+        self.assertEqual(single_pin(moved, 1), old_single_pin(moved, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+"""
+
+import handlers
+import json
+import unittest
+from http.client import HTTPConnection
+from queue import Queue
+from threading import Event, Lock, Thread
+from time import monotonic, time
+from typing import *
+from telegram.ext import Dispatcher, MessageHandler, Filters # type: ignore
+from local_store import Storage
+from webhook import SecretHeader, WebhookConfig, WebhookServer
+from test.handlers_test import Bot
+
+
+Secret = "very secret"
+# supergroups have ids like this
+ChatId = -1001234567890
+
+# Update with a pinned message, as telegram sends it
+def recorded_pin(update_id: int, chat_id: int, m_id: int, text: str) -> Dict[str, Any]:
+    user = {"id" : 1001, "is_bot" : False, "first_name" : "John"}
+    chat = {"id" : chat_id, "type" : "supergroup", "title" : "test chat"}
+    now = int(time())
+    return { "update_id" : update_id
+           , "message" : { "message_id" : m_id + 1
+                         , "from" : user
+                         , "chat" : chat
+                         , "date" : now
+                         , "pinned_message" : { "message_id" : m_id
+                                              , "from" : user
+                                              , "chat" : chat
+                                              , "date" : now
+                                              , "text" : text
+                                              }
+                         }
+           }
+
+
+def post(port: int, path: str, body: bytes, secret: Optional[str] = Secret) -> int:
+    connection = HTTPConnection("127.0.0.1", port)
+    headers = {"Content-Type" : "application/json"}
+    if secret is not None:
+        headers[SecretHeader] = secret
+    connection.request("POST", path, body, headers)
+    status = connection.getresponse().status
+    connection.close()
+    return status
+
+
+class TestWebhook(unittest.TestCase):
+    def start(self, **config) -> Tuple[WebhookServer, Queue, int]:
+        queue: Queue = Queue()
+        config = WebhookConfig(listen="127.0.0.1", port=0, secret=Secret)._replace(**config)
+        server = WebhookServer(config, Bot(), queue)
+        port = server.start()
+        self.addCleanup(server.stop)
+        return (server, queue, port)
+
+    def test_accepts(self):
+        server, queue, port = self.start()
+        body = json.dumps(recorded_pin(1, ChatId, 10, "text")).encode()
+        self.assertEqual(post(port, "/telegram", body), 200)
+        update = queue.get_nowait()
+        self.assertEqual(update.update_id, 1)
+        self.assertEqual(update.message.pinned_message.text, "text")
+        self.assertEqual(server.stats()["received"], 1)
+
+    def test_refuses(self):
+        server, queue, port = self.start()
+        body = json.dumps(recorded_pin(1, ChatId, 10, "text")).encode()
+        self.assertEqual(post(port, "/telegram", body, secret=None), 403)
+        self.assertEqual(post(port, "/telegram", body, secret="guess"), 403)
+        self.assertEqual(post(port, "/other", body), 404)
+        self.assertEqual(post(port, "/telegram", b"{not json"), 400)
+        self.assertTrue(queue.empty())
+        stats = server.stats()
+        self.assertEqual(stats["refused"], 2)
+        self.assertEqual(stats["malformed"], 1)
+
+    def test_busy(self):
+        server, queue, port = self.start(max_connections=1)
+        # the only connection is taken
+        server._connections.acquire()
+        body = json.dumps(recorded_pin(1, ChatId, 10, "text")).encode()
+        self.assertEqual(post(port, "/telegram", body), 503)
+        server._connections.release()
+        self.assertEqual(post(port, "/telegram", body), 200)
+
+    def test_stats(self):
+        server, queue, port = self.start()
+        for update_id in range(3):
+            body = json.dumps(recorded_pin(update_id, ChatId, 10, "text")).encode()
+            post(port, "/telegram", body)
+        connection = HTTPConnection("127.0.0.1", port)
+        connection.request("GET", "/telegram", headers={SecretHeader : Secret})
+        stats = json.loads(connection.getresponse().read())
+        connection.close()
+        self.assertEqual(stats["queue_depth"], 3)
+
+    def test_from_env(self):
+        config = WebhookConfig.from_env({"WEBHOOK_PORT" : "80", "WEBHOOK_SECRET" : "s"})
+        self.assertEqual(config.port, 80)
+        self.assertEqual(config.secret, "s")
+        self.assertEqual(config.path, WebhookConfig().path)
+
+
+class TestWebhookHandlers(unittest.TestCase):
+    def test_latency(self):
+        amount = 50
+        storage = Storage()
+        bot = Bot()
+        queue: Queue = Queue()
+        dispatcher = Dispatcher(bot, queue, use_context=True)
+        pinned = handlers.pinned(storage)
+
+        posted: Dict[int, float] = {}
+        latencies: List[float] = []
+        lock = Lock()
+        done = Event()
+        def timed_pinned(update, context):
+            pinned(update, context)
+            with lock:
+                latencies.append(monotonic() - posted[update.update_id])
+                if len(latencies) == amount:
+                    done.set()
+        pin_filter = Filters.status_update.pinned_message
+        dispatcher.add_handler(MessageHandler(pin_filter, timed_pinned))
+
+        config = WebhookConfig(listen="127.0.0.1", port=0, secret=Secret)
+        server = WebhookServer(config, bot, queue)
+        port = server.start()
+        self.addCleanup(server.stop)
+        Thread(target=dispatcher.start, daemon=True).start()
+        self.addCleanup(dispatcher.stop)
+
+        for update_id in range(amount):
+            body = json.dumps(recorded_pin(update_id, ChatId, 1000 + update_id, "text")).encode()
+            with lock:
+                posted[update_id] = monotonic()
+            self.assertEqual(post(port, "/telegram", body), 200)
+        self.assertTrue(done.wait(10))
+
+        self.assertEqual(len(storage.get(ChatId)), amount)
+        self.assertLess(max(latencies), 5)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+"""
+
+import handlers
+import multiprocessing
+import os
+import unittest
+from functools import partial
+from queue import Empty
+from typing import *
+from telegram import Update # type: ignore
+from local_store import Storage
+from workers import Supervisor, Worker, worker_of
+
+from test.handlers_test import Bot
+from test.webhook_test import ChatId, recorded_pin
+
+
+"""
+Workers are made in other processes, so their setups are defined here for
+pickle to find them. Workers tell what they do through results queue
+"""
+
+def recording_setup(results, index: int, workers: int) -> Worker:
+    def record(update, context) -> None:
+        results.put((update.effective_chat.id, update.update_id, index))
+    def crash(update, context) -> None:
+        # what's recorded is sent by a thread of the queue, wait for it
+        results.close()
+        results.join_thread()
+        os._exit(1)
+    return Worker(None, {"record" : record, "crash" : crash}, lambda: None)
+
+
+class QueueBot(Bot):
+    def __init__(self, results) -> None:
+        super().__init__()
+        self.results = results
+    def send_message(self, chat_id, *args, **kwargs):
+        self.results.put(("sent", chat_id))
+        return super().send_message(chat_id, *args, **kwargs)
+    def edit_message_text(self, chat_id, *args, **kwargs):
+        self.results.put(("edited", chat_id))
+        return super().edit_message_text(chat_id, *args, **kwargs)
+
+
+def handlers_setup(results, index: int, workers: int) -> Worker:
+    named = {"pinned" : handlers.pinned(Storage())}
+    return Worker(QueueBot(results), named, lambda: None)
+
+
+class TestWorkers(unittest.TestCase):
+    def start(self, setup, workers: int = 3) -> Tuple[Supervisor, Any]:
+        results = multiprocessing.get_context("spawn").Queue()
+        supervisor = Supervisor(partial(setup, results), workers, check_every=0.05)
+        supervisor.start()
+        self.addCleanup(supervisor.stop)
+        return (supervisor, results)
+
+    def receive(self, results, amount: int) -> List[Any]:
+        return [results.get(timeout=30) for _ in range(amount)]
+
+    def test_worker_of(self):
+        self.assertEqual(worker_of(None, 4), 0)
+        for chat_id in [ChatId, -5, 0, 7, 1 << 40]:
+            index = worker_of(chat_id, 4)
+            self.assertTrue(0 <= index < 4)
+            self.assertEqual(index, worker_of(chat_id, 4))
+
+    def test_chats_stay_in_workers(self):
+        supervisor, results = self.start(recording_setup)
+        chats = [ChatId - i for i in range(6)]
+        for update_id in range(60):
+            data = recorded_pin(update_id, chats[update_id % 6], 1000 + update_id, "text")
+            supervisor.send("record", Update.de_json(data, None))
+        handled = self.receive(results, 60)
+
+        self.assertEqual(sorted(u for _, u, _ in handled), list(range(60)))
+        by_chat: Dict[int, Set[int]] = {}
+        for chat_id, update_id, index in handled:
+            by_chat.setdefault(chat_id, set()).add(index)
+        self.assertEqual(by_chat, {c: {worker_of(c, 3)} for c in chats})
+        # updates of one chat are handled in order
+        for chat_id in chats:
+            ids = [u for c, u, _ in handled if c == chat_id]
+            self.assertEqual(ids, sorted(ids))
+        self.assertEqual(supervisor.stats()["sent"], 60)
+
+    def test_restarts(self):
+        supervisor, results = self.start(recording_setup, workers=1)
+        pin = lambda i: Update.de_json(recorded_pin(i, ChatId, 1000 + i, "text"), None)
+        supervisor.send("record", pin(1))
+        supervisor.send("crash", pin(2))
+        supervisor.send("record", pin(3))
+        handled = self.receive(results, 2)
+        self.assertEqual([u for _, u, _ in handled], [1, 3])
+        stats = supervisor.stats()
+        self.assertEqual(stats["restarts"], 1)
+        self.assertEqual(stats["alive"], 1)
+
+    def test_handlers(self):
+        supervisor, results = self.start(handlers_setup, workers=2)
+        chats = [ChatId, ChatId - 1]
+        for i in range(4):
+            data = recorded_pin(i, chats[i % 2], 1000 + i, f"text {i}")
+            supervisor.send("pinned", Update.de_json(data, None))
+        done = self.receive(results, 4)
+        # the first pin in each chat sends the post, the second one edits it
+        self.assertEqual( sorted(done)
+                        , sorted([("sent", c) for c in chats] + [("edited", c) for c in chats])
+                        )
+        with self.assertRaises(Empty):
+            results.get(timeout=0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
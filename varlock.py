@@ -15,6 +15,7 @@ the threads consequently.
 
 from threading import Lock
 from typing import Dict, Any
+import asyncio
 
 class VarLock:
     _locks: Dict[Any, Lock]
@@ -42,3 +43,18 @@ class VarLock:
             if var not in self._locks:
                 self._locks[var] = Lock()
         return self._locks[var]
+
+
+class AsyncVarLock:
+    """The same for asyncio tasks. Only used from one event loop, so the
+    locks need no lock of their own"""
+    _locks: Dict[Any, asyncio.Lock]
+
+    def __init__(self) -> None:
+        self._locks = {}
+
+    # to be used in async with statements
+    def lock(self, var: Any) -> asyncio.Lock:
+        if var not in self._locks:
+            self._locks[var] = asyncio.Lock()
+        return self._locks[var]
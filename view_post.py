@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
 from typing import *
+from datetime import datetime
+from functools import lru_cache
 from html import escape
-from message_info import MessageInfo
+from message_info import MessageInfo, gen_icon, message_link
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton # type: ignore
 from enum import Enum
 from message_kind import Kind
@@ -14,37 +16,69 @@ Author: d86leader@mail.com, 2019
 License: published under GNU GPL-3
 
 Description: functions to present data in chat
-The important ones are single_pin and pins_post
+The important ones are single_pin and pins_post. Rendered pins are cached
+by what they show, so each pin is rendered once and only numbered again
 """
 
 
-def single_pin(msg_info: MessageInfo, index) -> str:
-    lines: List[str] = []
+# How many rendered pins to keep
+FragmentsCached = 100000
+
+# A pin's text is the same for every index it has, so it's rendered once as
+# the text before the index and the text after it
+def pin_fragment(msg_info: MessageInfo) -> Tuple[str, str]:
+    # dates in different time zones are equal when they are the same moment,
+    # but are shown differently
+    date = msg_info.date
+    return _fragment( msg_info.kind, msg_info.preview.wrapped
+                    , msg_info.chat_id, msg_info.m_id
+                    , date, date.tzinfo, msg_info.sender.wrapped
+                    )
+
+@lru_cache(maxsize=FragmentsCached)
+def _fragment(kind: Kind, preview: str, chat_id: int, m_id: int
+             ,date: datetime, tzinfo: Any, sender: str
+             ) -> Tuple[str, str]:
     head_icon = "📌"
+    icon = gen_icon(kind)
+    link = message_link(chat_id, m_id)
 
     # first line: preview
     preview_line = ""
     # these require disambiguation with icon
-    visual_kind = msg_info.kind in [Kind.Photo, Kind.File]
-    if len(msg_info.preview.wrapped) == 0 or visual_kind:
+    visual_kind = kind in [Kind.Photo, Kind.File]
+    if len(preview) == 0 or visual_kind:
         # populate it with icon
-        preview_line += f"{msg_info.icon} "
-    preview_line += msg_info.preview.wrapped
-    lines += [preview_line]
+        preview_line += f"{icon} "
+    preview_line += preview
 
     # second line - header line: icon, sender and date and index
-    time_str = msg_info.date.strftime("%Y-%m-%d")
-    weekday = msg_info.date.strftime("%a")
-    header_line =  f'<a href="{msg_info.link}">'
-    header_line += f"{head_icon} "
-    header_line += f"[{index}] {time_str}"
-    header_line += "</a>"
-    header_line += "<i>"
-    header_line += f" - {escape(msg_info.sender.wrapped)}, {weekday}"
-    header_line += "</i>"
-    lines += [header_line]
+    time_str = date.strftime("%Y-%m-%d")
+    weekday = date.strftime("%a")
+    before =  f'{preview_line}\n<a href="{link}">'
+    before += f"{head_icon} "
+    before += "["
+    after =  f"] {time_str}"
+    after += "</a>"
+    after += "<i>"
+    after += f" - {escape(sender)}, {weekday}"
+    after += "</i>"
+
+    return (before, after)
+
+def single_pin(msg_info: MessageInfo, index) -> str:
+    before, after = pin_fragment(msg_info)
+    return f"{before}{index}{after}"
 
-    return "\n".join(lines)
+# all pins, numbered from 1
+def pins_text(pins) -> str:
+    parts: List[str] = []
+    for index, pin in enumerate(pins, 1):
+        before, after = pin_fragment(pin)
+        parts += [before, str(index), after, "\n\n"]
+    if parts != []:
+        parts.pop()
+    return "".join(parts)
 
 
 EmptyPost: Tuple[str, InlineKeyboardMarkup] = (
@@ -57,56 +91,59 @@ class ButtonsStatus(Enum):
     Collapsed = 1
     Expanded = 2
 
+# buttons for pin control, the same in every post
+ButtonAll = InlineKeyboardButton("❌ Unpin all", callback_data=control.UnpinAll)
+ButtonKeepLast = InlineKeyboardButton("Keep last 🔺", callback_data=control.KeepLast)
+ButtonExpand = InlineKeyboardButton("➕ Edit", callback_data=control.ButtonsExpand)
+ButtonCollapse = InlineKeyboardButton("➖ Close", callback_data=control.ButtonsCollapse)
+
+# Markups are shared by posts, so nobody may change them
+OnePinMarkup = InlineKeyboardMarkup([[ButtonAll]])
+CollapsedMarkup = InlineKeyboardMarkup([[ButtonExpand]])
+
+# How many buttons of pins to keep
+ButtonsCached = 100000
+
 # used event handlers to generate view
 def pins_post(pins, chat_id: int
              ,button_status: ButtonsStatus = ButtonsStatus.Collapsed
              ) -> Tuple[str, InlineKeyboardMarkup]:
-    text = "\n\n".join(single_pin(pin, i + 1) for i, pin in enumerate(pins))
-
-    # generate buttons for pin control
-    button_all = InlineKeyboardButton(
-        "❌ Unpin all", callback_data=control.UnpinAll)
-    button_keep_last = InlineKeyboardButton(
-        "Keep last 🔺", callback_data=control.KeepLast)
-    button_expand = InlineKeyboardButton(
-        "➕ Edit", callback_data=control.ButtonsExpand)
-    button_collapse = InlineKeyboardButton(
-        "➖ Close", callback_data=control.ButtonsCollapse)
+    text = pins_text(pins)
 
     # special button case when only one pin:
     if len(pins) == 1:
-        layout = [[button_all]]
-        return (text, InlineKeyboardMarkup(layout))
+        return (text, OnePinMarkup)
 
     # when buttons are set to not shown
     if button_status == ButtonsStatus.Collapsed:
-        layout = [[button_expand]]
-        return (text, InlineKeyboardMarkup(layout))
+        return (text, CollapsedMarkup)
 
     # generate all expanded buttons
 
     # first two rows: those buttons
-    layout = [[button_collapse], [button_all, button_keep_last]]
-
-    # other buttons: this style with special data
-    def on_button(msg, index) -> str:
-        return f"{index + 1} {msg.icon}"
-    cb_data = control.unpin_message_data
-
-    texts = (on_button(msg, index) for index, msg in enumerate(pins))
-    cb_datas = (cb_data(msg, index) for index, msg in enumerate(pins))
+    layout = [[ButtonCollapse], [ButtonAll, ButtonKeepLast]]
 
-    buttons = [InlineKeyboardButton(text, callback_data=data)
-                for text, data in zip(texts, cb_datas)]
+    # other buttons: one for each pin
+    buttons = [pin_button(index, msg.kind, msg.m_id) for index, msg in enumerate(pins)]
 
     # split buttons by lines
-    on_one_line = best_split(len(buttons))
-    rows = [buttons[i:i+on_one_line] for i in range(0, len(buttons), on_one_line)]
-
-    layout += rows
+    layout += [buttons[start:end] for start, end in rows_of(len(buttons))]
 
     return (text, InlineKeyboardMarkup(layout))
 
+# button to unpin a message, with special data
+@lru_cache(maxsize=ButtonsCached)
+def pin_button(index: int, kind: Kind, m_id: int) -> InlineKeyboardButton:
+    return InlineKeyboardButton( f"{index + 1} {gen_icon(kind)}"
+                               , callback_data=control.unpin_data(m_id, index)
+                               )
+
+# start and end of buttons in each row
+@lru_cache(maxsize=None)
+def rows_of(amount: int) -> Tuple[Tuple[int, int], ...]:
+    on_one_line = best_split(amount)
+    return tuple( (i, i + on_one_line) for i in range(0, amount, on_one_line) )
+
 # choose the best way to split buttons between lines
 def best_split(amount: int) -> int:
     best_per_line = 5
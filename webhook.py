@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+from typing import *
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from hmac import compare_digest
+from queue import Queue
+from threading import BoundedSemaphore, Lock, Thread
+from time import monotonic
+from telegram import Update # type: ignore
+import json
+import os
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: receiving updates from telegram over http instead of asking for
+them. Telegram posts each update to the server as soon as it happens. The
+server checks that the request has the secret token given to telegram,
+puts the update into the dispatcher's queue and answers at once, without
+waiting for handlers.
+GET on the same path with the secret answers with statistics, including
+how many updates wait in the queue.
+"""
+
+
+class WebhookConfig(NamedTuple):
+    # address and port to listen on
+    listen: str = "0.0.0.0"
+    port: int = 8443
+    # path telegram posts to
+    path: str = "/telegram"
+    # sent by telegram in X-Telegram-Bot-Api-Secret-Token, requests without
+    # it are refused. Empty to accept any request
+    secret: str = ""
+    # address telegram posts to, as seen from outside. The webhook is not set
+    # if it's empty
+    url: str = ""
+    # most requests handled at once, telegram is asked not to send more
+    max_connections: int = 40
+    # largest update to accept, in bytes
+    max_body: int = 1 << 20
+
+    # Each field can be set with an environment variable, WEBHOOK_ followed
+    # by the field name in uppercase, like WEBHOOK_PORT=8080
+    @staticmethod
+    def from_env(env: Mapping[str, str] = os.environ) -> 'WebhookConfig':
+        values: Dict[str, Any] = {}
+        for field, kind in WebhookConfig.__annotations__.items():
+            name = "WEBHOOK_" + field.upper()
+            if name in env:
+                values[field] = kind(env[name])
+        return WebhookConfig(**values)
+
+
+SecretHeader = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class Server(ThreadingHTTPServer):
+    # connections waiting to be accepted; the default of 5 makes clients
+    # wait for a second to connect again
+    request_queue_size = 128
+    daemon_threads = True
+
+
+class WebhookServer:
+    config: WebhookConfig
+    _bot: Any
+    _queue: Queue
+    _server: Optional[Server]
+    _thread: Optional[Thread]
+    _connections: BoundedSemaphore
+    _lock: Lock
+
+    received: int
+    refused: int
+    malformed: int
+    busy: int
+    # longest time an answer took, seconds
+    max_answer_time: float
+
+    def __init__(self, config: WebhookConfig, bot, update_queue: Queue) -> None:
+        self.config = config
+        self._bot = bot
+        self._queue = update_queue
+        self._server = None
+        self._thread = None
+        self._connections = BoundedSemaphore(config.max_connections)
+        self._lock = Lock()
+        self.received = 0
+        self.refused = 0
+        self.malformed = 0
+        self.busy = 0
+        self.max_answer_time = 0.0
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            return { "queue_depth"     : self._queue.qsize()
+                   , "received"        : self.received
+                   , "refused"         : self.refused
+                   , "malformed"       : self.malformed
+                   , "busy"            : self.busy
+                   , "max_answer_time" : self.max_answer_time
+                   }
+
+    # Start serving in a thread of its own. Returns the port, which is chosen
+    # by the system if config's port is 0
+    def start(self) -> int:
+        self._server = Server( (self.config.listen, self.config.port)
+                             , self._request_handler()
+                             )
+        # short poll interval only makes stop faster
+        self._thread = Thread( target=self._server.serve_forever, args=(0.1,)
+                             , daemon=True
+                             )
+        self._thread.start()
+        return self._server.server_address[1]
+
+    def stop(self) -> None:
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    # tell telegram to post updates here
+    def set_webhook(self) -> None:
+        kwargs = {}
+        if self.config.secret != "":
+            kwargs["secret_token"] = self.config.secret
+        self._bot.set_webhook( url = self.config.url
+                             , max_connections = self.config.max_connections
+                             , **kwargs
+                             )
+
+    # (status, body) answer to a request
+    def _accept(self, path: str, secret: Optional[str], body: bytes) -> Tuple[int, bytes]:
+        if path != self.config.path:
+            return (404, b"")
+        if not self._authorized(secret):
+            with self._lock:
+                self.refused += 1
+            return (403, b"")
+        try:
+            update = Update.de_json(json.loads(body), self._bot)
+        except (ValueError, TypeError, KeyError):
+            update = None
+        if update is None:
+            with self._lock:
+                self.malformed += 1
+            return (400, b"")
+        # the dispatcher's queue is unbounded, this never waits
+        self._queue.put(update)
+        with self._lock:
+            self.received += 1
+        return (200, b"")
+
+    def _authorized(self, secret: Optional[str]) -> bool:
+        if self.config.secret == "":
+            return True
+        return secret is not None and compare_digest(secret, self.config.secret)
+
+    def _request_handler(self) -> Type[BaseHTTPRequestHandler]:
+        webhook = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self) -> None:
+                start = monotonic()
+                if not webhook._connections.acquire(blocking=False):
+                    with webhook._lock:
+                        webhook.busy += 1
+                    self._answer(503, b"")
+                    return
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    if length > webhook.config.max_body:
+                        self._answer(413, b"")
+                        return
+                    body = self.rfile.read(length)
+                    status, answer = webhook._accept( self.path
+                                                    , self.headers.get(SecretHeader)
+                                                    , body
+                                                    )
+                    self._answer(status, answer)
+                finally:
+                    webhook._connections.release()
+                with webhook._lock:
+                    webhook.max_answer_time = max( webhook.max_answer_time
+                                                 , monotonic() - start)
+
+            def do_GET(self) -> None:
+                if self.path != webhook.config.path:
+                    self._answer(404, b"")
+                elif not webhook._authorized(self.headers.get(SecretHeader)):
+                    self._answer(403, b"")
+                else:
+                    self._answer(200, json.dumps(webhook.stats()).encode())
+
+            def _answer(self, status: int, body: bytes) -> None:
+                self.send_response(status)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            # requests are counted in stats instead
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+        return Handler
@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+
+from typing import *
+from threading import Event, Lock, Thread
+from telegram import Update # type: ignore
+import multiprocessing
+import os
+import traceback
+
+"""
+Author: d86leader@mail.com, 2019
+License: published under GNU GPL-3
+
+Description: handling updates in several processes, so that rendering and
+decoding of different chats use different cores.
+The ingest process receives updates and passes each one to the worker
+process of its chat, chosen by chat id, over a queue of that worker. All
+updates of a chat go to the same worker, so chat locks and cached posts
+are kept by one process only and never need to be shared.
+A supervisor thread in the ingest process starts workers again when they
+die. The worker's queue stays, so updates sent while it was down are
+handled by the new one.
+"""
+
+
+Handler = Callable[[Any, Any], None]
+
+
+class Worker(NamedTuple):
+    # bot that handlers answer with
+    bot: Any
+    # handlers by names that ingest process sends updates with
+    handlers: Dict[str, Handler]
+    # called when there are no more updates, waits for handlers to finish
+    stop: Callable[[], None]
+
+
+# Makes the worker in the worker process, given its index and the amount of
+# workers. Must be picklable, like a function defined at module level
+Setup = Callable[[int, int], Worker]
+
+
+class WorkerContext(NamedTuple):
+    """What handlers use from telegram's CallbackContext"""
+    bot: Any
+
+
+# index of the worker handling the chat
+def worker_of(chat_id: Optional[int], amount: int) -> int:
+    if chat_id is None:
+        return 0
+    return chat_id % amount
+
+
+# Body of the worker process: handle updates from inbox until None comes
+def serve(index: int, workers: int, inbox: Any, setup: Setup) -> None:
+    worker = setup(index, workers)
+    context = WorkerContext(worker.bot)
+    while True:
+        item = inbox.get()
+        if item is None:
+            break
+        name, data = item
+        try:
+            update = Update.de_json(data, worker.bot)
+            worker.handlers[name](update, context)
+        except Exception:
+            traceback.print_exc()
+    worker.stop()
+
+
+class Supervisor:
+    # worker processes
+    Workers = 4
+    # seconds between checks that workers are alive
+    CheckEvery = 1.0
+
+    _setup: Setup
+    _inboxes: List[Any]
+    _processes: List[Any]
+    _lock: Lock
+    _stopping: Event
+    _watcher: Optional[Thread]
+
+    sent: int
+    restarts: int
+
+    def __init__(self, setup: Setup, workers: int = Workers
+                ,check_every: float = CheckEvery
+                ) -> None:
+        # workers are started from a process with threads, and forking it
+        # could copy a lock held by another thread
+        self._context = multiprocessing.get_context("spawn")
+        self._setup = setup
+        self._check_every = check_every
+        self._inboxes = [self._context.Queue() for _ in range(workers)]
+        self._processes = [None] * workers
+        self._lock = Lock()
+        self._stopping = Event()
+        self._watcher = None
+        self.sent = 0
+        self.restarts = 0
+
+    # WORKER_PROCESSES sets the amount of workers
+    @staticmethod
+    def from_env(setup: Setup, env: Mapping[str, str] = os.environ) -> 'Supervisor':
+        return Supervisor(setup, int(env.get("WORKER_PROCESSES", Supervisor.Workers)))
+
+    @property
+    def workers(self) -> int:
+        return len(self._inboxes)
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            alive = sum(1 for p in self._processes if p is not None and p.is_alive())
+            return { "workers"  : self.workers
+                   , "alive"    : alive
+                   , "waiting"  : sum(inbox.qsize() for inbox in self._inboxes)
+                   , "sent"     : self.sent
+                   , "restarts" : self.restarts
+                   }
+
+    def start(self) -> None:
+        with self._lock:
+            for index in range(self.workers):
+                self._spawn(index)
+        self._watcher = Thread(target=self._watch, daemon=True)
+        self._watcher.start()
+
+    # Pass the update to its chat's worker, to be handled by handler with
+    # given name
+    def send(self, name: str, update: Any) -> None:
+        chat = update.effective_chat
+        chat_id = chat.id if chat is not None else None
+        index = worker_of(chat_id, self.workers)
+        self._inboxes[index].put((name, update.to_dict()))
+        with self._lock:
+            self.sent += 1
+
+    # Handler for the ingest process's dispatcher that sends the update
+    def handler(self, name: str) -> Handler:
+        return lambda update, context: self.send(name, update)
+
+    # Let workers handle everything sent and wait for them to exit
+    def stop(self) -> None:
+        self._stopping.set()
+        if self._watcher is not None:
+            self._watcher.join()
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for process in self._processes:
+            if process is not None:
+                process.join()
+
+    # must hold the lock
+    def _spawn(self, index: int) -> None:
+        process = self._context.Process( target=serve
+                                       , args=(index, self.workers, self._inboxes[index], self._setup)
+                                       , name=f"worker-{index}"
+                                       , daemon=True
+                                       )
+        process.start()
+        self._processes[index] = process
+
+    def _watch(self) -> None:
+        while not self._stopping.wait(self._check_every):
+            with self._lock:
+                for index, process in enumerate(self._processes):
+                    if not process.is_alive():
+                        print(f"Worker {index} exited with {process.exitcode}, starting again")
+                        self.restarts += 1
+                        self._spawn(index)